@@ -1,21 +1,32 @@
-import bisect
 import copy
+import functools
 import hashlib
+import heapq
 import itertools
 import json
 import operator
 import time
 from collections import ChainMap
+from types import MappingProxyType
 
 from pmdefaults import *
 from policy import NEATProperty, PropertyArray, PropertyMultiArray, ImmutablePropertyError, term_separator
-from policy import dict_to_properties
+from policy import dict_to_properties, apply_json_patch, JSONPatchError, NEATPropertyError
+from pmprefix import AddressIndex, PrefixTree, ip_prefix
 
 
 class CIBEntryError(Exception):
     pass
 
 
+def score_bound(properties):
+    """
+    Upper bound of the score any merge with the given properties can contribute: every merged property either keeps
+    the score of one side or adds up both, so only positive scores can increase a candidate score.
+    """
+    return sum(p.score for p in properties.values() if p.score > 0)
+
+
 def load_json(filename):
     """
     Read CIB node from JSON file
@@ -140,25 +151,19 @@ class CIBNode(object):
     def json(self, indent=4):
         return json.dumps(self.dict(), indent=indent, sort_keys=True)
 
-    def resolve_paths(self, path=None):
-        """recursively find all paths from this CIBNode to all other matched CIBnodes in the CIB graph"""
-        if path is None:
-            path = []
-        # insert own index based on CIB node priority to resolve overlapping properties later
-        # FIXME priorities no longer work
-        pos = bisect.bisect([self.cib[uid].priority for uid in path], self.priority)
-        path.insert(pos, self.uid)
-
-        # no more links to check
-        if not (self.linked - set(path)):
-            return [path]
-
-        new_paths = []
-        for uid in self.linked:
-            if uid in path:
-                continue
-            new_paths.extend(self.cib[uid].resolve_links(path.copy()))
-        return new_paths
+    def patch(self, ops):
+        """
+        Apply a JSON patch to the node attributes in place. The uid and the links of the node are preserved.
+        """
+        try:
+            d = apply_json_patch(self.dict(), ops)
+            d['uid'] = self.uid
+            node = CIBNode(d)
+        except (JSONPatchError, NEATPropertyError, IndexError, TypeError, AttributeError, ValueError) as e:
+            raise CIBEntryError("invalid CIB patch: %s" % e)
+
+        node.linked = self.linked
+        self.__dict__.update(node.__dict__)
 
     def match_entry(self, entry):
         for match_properties in self.match:
@@ -171,14 +176,18 @@ class CIBNode(object):
             for p in pma.expand():
                 yield p
 
-    def update_links_from_match(self):
+    def update_links_from_match(self, nodes=None):
         """
         Look at the list elements in self.match and try to match all of its properties to another CIB entry. Generates a
          list containing the UIDs of the matched rows. The list is stored in self.linked.
+
+        If nodes is given only these CIB nodes are checked for matches.
         """
+        if nodes is None:
+            nodes = self.cib.nodes.values()
 
         for match_properties in self.match:
-            for node in self.cib.nodes.values():
+            for node in nodes:
                 if node.uid == self.uid: continue  # ??
                 for p in node.expand():
                     # Check if the properties in the match list are a full subset of some CIB properties.
@@ -186,52 +195,36 @@ class CIBNode(object):
                     if match_properties <= set(p.values()) | {NEATProperty(('uid', node.uid))}:
                         self.linked.add(node.uid)
 
-    def resolve_graph(self, path=None):
-        """new try """
-        if path is None:
-            path = []
-
-        path.append(self.uid)
-
-        remaining = set(self.cib.graph.get(self.uid, [])) - set(path)
-        if len(remaining) == 0:
-            return [path]
-
-        new_paths = []
-        for u in remaining:
-            paths = self.cib.nodes[u].resolve_graph(path.copy())
-            new_paths.extend(paths)
-        return new_paths
-
-    def resolve_links(self, path=None):
-        """find paths from current CIB to all linked CIBS """
-        if path is None:
-            path = []
-        # insert own index based on CIB node priority to resolve overlapping properties later
-        pos = bisect.bisect([self.cib[uid].priority for uid in path], self.priority)
-        path.insert(pos, self.uid)
-
-        # no more links to check
-        if not (self.linked - set(path)):
-            return [path]
-
-        new_paths = []
-        for uid in self.linked:
-            if uid in path:
-                continue
-            new_paths.extend(self.cib[uid].resolve_links(path.copy()))
-        return new_paths
+    def expansion_count(self):
+        """Return the number of property arrays generated by expand() without expanding them."""
+        return sum(functools.reduce(operator.mul, (len(ps) for ps in pma.values()), 1) for pma in self.properties)
+
+    def resolve_graph(self):
+        """Return all paths from this CIBNode to all other linked CIB nodes in the CIB graph"""
+        return list(self.cib.paths(self.uid))
 
     def expand_rows(self, apply_extended=True):
-        """Generate CIB rows by expanding all CIBs pointing to current CIB """
-        paths = self.resolve_graph()
+        """Generate CIB rows by expanding all CIBs pointing to current CIB
+
+        At most cib.max_rows rows are generated for each root node.
+        """
+        max_rows = self.cib.max_rows
+        path_count = self.cib.path_count(self.uid)
+        row_count = self.cib.row_count(self.uid)
+        if path_count > self.cib.max_paths or row_count > max_rows:
+            logging.warning("CIB node %s expands to %d paths and %d rows, limiting to %d paths and %d rows" %
+                            (self.uid, path_count, row_count, self.cib.max_paths, max_rows))
+
+        paths = self.cib.paths(self.uid)
 
         # for storing expanded rows
         rows = []
 
         for path in paths:
-            expanded_properties = (self.cib[uid].expand() for uid in path)
-            for pas in itertools.product(*expanded_properties):
+            if len(rows) >= max_rows:
+                break
+            expanded_properties = (self.cib.nodes[uid].expand() for uid in path)
+            for pas in itertools.islice(itertools.product(*expanded_properties), max_rows - len(rows)):
                 chain = ChainMap(*pas)
 
                 # For debugging purposes, add the path list to the chain.
@@ -249,26 +242,29 @@ class CIBNode(object):
         if not apply_extended:
             return rows
 
-        if not self.cib.extenders:
+        extender_index = self.cib.extender_index
+        if not extender_index.extenders:
             # no extender CIB nodes loaded
             return rows
 
-        # TODO optimize
         extended_rows = rows.copy()
         for entry in rows:
             # TODO take priorities into account
-            # iterate extender cib_nodes
-            for uid, xs in self.cib.extenders.items():
-                for pa in xs.expand():
-                    if xs.match_entry(entry):
-                        entry_copy = copy.deepcopy(entry)
-                        chain = ChainMap(pa, entry_copy)
-                        new_pa = PropertyArray(*(p for p in chain.values()))
-                        try:
-                            del new_pa['uid']
-                        except KeyError:
-                            pass
-                        extended_rows.append(new_pa)
+            # iterate extender cib_nodes which may match the row
+            for xs, expansions in extender_index.candidates(entry):
+                if not xs.match_entry(entry):
+                    continue
+                for pa in expansions:
+                    # the base row is shared, extended rows only reference its properties
+                    chain = ChainMap(pa, entry)
+                    new_pa = PropertyArray(*(p for p in chain.values()))
+                    try:
+                        del new_pa['uid']
+                    except KeyError:
+                        pass
+                    extended_rows.append(new_pa)
+                    if len(extended_rows) >= max_rows:
+                        return extended_rows
 
         return extended_rows
 
@@ -279,6 +275,240 @@ class CIBNode(object):
         return s
 
 
+class ExtenderIndex(object):
+    """
+    Index of the extender CIB nodes by the values of their match properties.
+
+    Each match entry of an extender is indexed under one of its properties, so that a CIB row is only compared to
+    extenders which have a matching value for one of the row properties. Addresses and address prefixes are indexed
+    in radix trees. The expansions of each extender are computed
+    once and shared by all extended rows.
+    """
+
+    def __init__(self, extenders):
+        # list of (CIBNode, expansions) tuples, extenders are referenced by their position in this list
+        self.extenders = []
+        # key -> value -> positions of extenders matching the value
+        self.values = {}
+        # key -> radix tree of the positions of extenders matching addresses or address prefixes
+        self.prefixes = {}
+        # key -> positions of extenders matching any value of the key (ranges)
+        self.any_value = {}
+        # positions of extenders matching all rows
+        self.unindexed = set()
+
+        for node in extenders:
+            # extenders without match entries are never applied
+            if not node.match:
+                continue
+            self.extenders.append((node, tuple(node.expand())))
+            for match_properties in node.match:
+                self._add(len(self.extenders) - 1, match_properties)
+
+    def _add(self, pos, match_properties):
+        if not match_properties:
+            # an empty match entry matches every row
+            self.unindexed.add(pos)
+            return
+
+        # prefer single values, which are the most selective
+        anchor = min(match_properties.values(), key=lambda p: (not p._value.is_single, not p._value.is_set))
+        network = ip_prefix(anchor.value) if anchor._value.is_single else None
+        if network is not None:
+            self.prefixes.setdefault(anchor.key, PrefixTree()).add(network, pos)
+        elif anchor._value.is_single:
+            self.values.setdefault(anchor.key, {}).setdefault(anchor.value, set()).add(pos)
+        elif anchor._value.is_set:
+            for v in anchor.value:
+                self.values.setdefault(anchor.key, {}).setdefault(v, set()).add(pos)
+        else:
+            self.any_value.setdefault(anchor.key, set()).add(pos)
+
+    def candidates(self, row):
+        """
+        Return the (CIBNode, expansions) tuples of all extenders which may match the row, in their original order.
+        """
+        found = set(self.unindexed)
+        for key, p in row.items():
+            found.update(self.any_value.get(key, ()))
+
+            tree = self.prefixes.get(key)
+            if tree is not None:
+                if p._value.is_single:
+                    network = ip_prefix(p.value)
+                    if network is not None:
+                        found.update(tree.overlapping(network))
+                elif p._value.is_set:
+                    for v in p.value:
+                        network = ip_prefix(v)
+                        if network is not None:
+                            found.update(tree.overlapping(network))
+
+            values = self.values.get(key)
+            if values is None:
+                continue
+            if p._value.is_single:
+                found.update(values.get(p.value, ()))
+            elif p._value.is_set:
+                for v in p.value:
+                    found.update(values.get(v, ()))
+            else:
+                # ranges may overlap any value
+                for positions in values.values():
+                    found.update(positions)
+
+        return [self.extenders[pos] for pos in sorted(found)]
+
+
+class CIBShard(object):
+    """
+    Partition of the CIB rows with the same value of the first shard key property (see CIB_SHARD_KEYS), e.g., all
+    rows of one interface.
+
+    The rows of a shard are ranked by their score bound. For each shard key property the shard records the immutable
+    values used by its rows, so that lookups requiring other values can skip the whole shard. An immutable request
+    property overrides an optional row value, so shards with optional values are never skipped.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        # (score bound, row position, row) tuples, best first
+        self.rows = []
+        # shard key property -> values used by the shard rows, None if any row uses a set or range value or a value
+        # which is not immutable
+        self.values = {k: set() for k in CIB_SHARD_KEYS}
+
+    def add(self, entry):
+        """Add a (score bound, row position, row) tuple"""
+        self.rows.append(entry)
+        row = entry[2]
+        for k, values in self.values.items():
+            if k not in row or values is None:
+                continue
+            if row[k]._value.is_single and row[k].precedence == NEATProperty.IMMUTABLE:
+                values.add(row[k].value)
+            else:
+                self.values[k] = None
+
+    def sort(self):
+        self.rows.sort(key=lambda r: (-r[0], r[1]))
+
+    def matches(self, required):
+        """Return False if no shard row can provide all required shard key properties."""
+        for k, values in self.values.items():
+            if k not in required or values is None:
+                continue
+            if not any(required[k] == NEATProperty((k, v)) for v in values):
+                return False
+        return True
+
+    def __repr__(self):
+        return 'CIBShard<%s: %d rows>' % (self.key, len(self.rows))
+
+
+class CIBSnapshot(object):
+    """
+    Immutable, versioned view of the CIB used for lookups.
+
+    Updates modify the CIB and then publish a new snapshot, containing the CIB nodes, the CIB graph and the expanded
+    CIB rows, by replacing the snapshot reference held by the CIB. A lookup holding a snapshot is never affected by
+    concurrent updates.
+    """
+
+    def __init__(self, generation=0, nodes=None, graph=None, rows=(), path_stats=None):
+        self.generation = generation
+        self.nodes = MappingProxyType(dict(nodes or {}))
+        self.graph = MappingProxyType({k: tuple(v) for k, v in (graph or {}).items()})
+        self.rows = tuple(rows)
+        self.roots = tuple(uid for uid, node in self.nodes.items() if node.root is True)
+        # number of paths and rows of each root node
+        self.path_stats = MappingProxyType(dict(path_stats or {}))
+
+        # (score bound, row position, row) tuples of all rows
+        self.ranked = tuple((score_bound(e), n, e) for n, e in enumerate(self.rows))
+
+        # partition rows by the value of the first shard key
+        shards = {}
+        shard_key = CIB_SHARD_KEYS[0] if CIB_SHARD_KEYS else None
+        for entry in self.ranked:
+            p = entry[2].get(shard_key)
+            key = p.value if p is not None and p._value.is_single else None
+            if key not in shards:
+                shards[key] = CIBShard(key)
+            shards[key].add(entry)
+        for shard in shards.values():
+            shard.sort()
+        self.shards = tuple(shards.values())
+
+        # index rows by their address properties
+        self.address_index = {k: AddressIndex(k, immutable=True) for k in ADDRESS_PROPERTIES}
+        for n, e in enumerate(self.rows):
+            for index in self.address_index.values():
+                index.add(n, e)
+
+    def lookup(self, input_properties, candidate_num=5):
+        """
+        CIB lookup logic implementation. Returns the candidate_num best connection candidates, i.e., the request
+        merged with the matching CIB rows, including the request itself.
+
+        Only the shards which can provide the required shard key properties of the request are searched. Their rows
+        are visited in order of their score bound; the search stops as soon as no remaining row can replace one of the
+        current candidates. Candidates with equal scores are ranked by row position as in a full sort.
+        """
+        assert isinstance(input_properties, PropertyArray)
+
+        # FIXME better check whether all input properties are included in row - improve matching
+        # ignore optional properties in input request
+        required = PropertyArray(*(p for p in input_properties.values() if p.precedence > NEATProperty.OPTIONAL))
+        request_bound = score_bound(input_properties)
+
+        # min-heap of (score, -position, candidate), the request itself is at position 0
+        best = [(input_properties.score, 0, input_properties)]
+        # restrict the lookup to rows with overlapping addresses if the request requires an address
+        selected = None
+        for k, index in self.address_index.items():
+            if k in required:
+                positions = index.select(required[k])
+                if positions is not None:
+                    selected = positions if selected is None else selected & positions
+
+        if selected is not None:
+            rows = sorted((self.ranked[n] for n in selected), key=lambda r: (-r[0], r[1]))
+        else:
+            shards = [shard.rows for shard in self.shards if shard.matches(required)]
+            rows = heapq.merge(*shards, key=lambda r: (-r[0], r[1]))
+
+        for bound, n, e in rows:
+            if candidate_num is not None and len(best) >= candidate_num:
+                bound += request_bound
+                if (bound, bound) < best[0][0]:
+                    break
+
+            try:
+                if len(required & e) != len(required):
+                    continue
+            except ImmutablePropertyError:
+                continue
+
+            try:
+                candidate = e + input_properties
+                candidate.cib_node = e.cib_node
+                candidate.meta['cib_uids'] = e.meta.get('cib_uids')
+            except ImmutablePropertyError:
+                continue
+
+            item = (candidate.score, -n - 1, candidate)
+            if candidate_num is None or len(best) < candidate_num:
+                heapq.heappush(best, item)
+            elif item[:2] > best[0][:2]:
+                heapq.heapreplace(best, item)
+
+        return [c for _, _, c in sorted(best, key=lambda b: b[:2], reverse=True)][:candidate_num]
+
+    def __repr__(self):
+        return 'CIBSnapshot<%d: %d rows, %d shards>' % (self.generation, len(self.rows), len(self.shards))
+
+
 class CIB(object):
     """
     Internal representation of the CIB for testing
@@ -288,7 +518,7 @@ class CIB(object):
     cib_dir = './cib/example/'
     CIB_EXTENSIONS = ('.cib', '.local', '.connection', '.remote', '.slim')
 
-    def __init__(self, cib_dir=None):
+    def __init__(self, cib_dir=None, load=True):
         # dictionary containing all loaded CIB nodes, keyed by their uid
         self.nodes = {}
         # track CIB files
@@ -297,22 +527,43 @@ class CIB(object):
         CIBNode.cib = self
 
         self.graph = {}
+        # strongly connected components, memoized paths and path/row counts of the CIB graph
+        self._components = {}
+        self._paths = {}
+        self._path_counts = {}
+        self._row_counts = {}
+        # path and row budgets for each root node
+        self.max_paths = CIB_MAX_PATHS
+        self.max_rows = CIB_MAX_ROWS
+
+        # set if CIB files were imported but not loaded yet
+        self.pending_reload = False
+
+        # published view of the CIB used by lookups
+        self.snapshot = CIBSnapshot()
+        # called between chunks of ingest work, e.g., to let lookups run first (see pmlanes.Lanes.checkpoint)
+        self.checkpoint = lambda: None
+        # expanded rows and reachable CIB nodes of each root node, used to update snapshots incrementally
+        self._rows = {}
+        self._reach = {}
+        self._extender_index = None
 
         if cib_dir:
             self.cib_dir = cib_dir
-            self.reload_files()
+            if load:
+                self.reload_files()
 
     def __getitem__(self, uid):
-        return self.nodes[uid]
+        return self.snapshot.nodes[uid]
 
     def items(self):
-        return self.nodes.items()
+        return self.snapshot.nodes.items()
 
     def keys(self):
-        return self.nodes.keys()
+        return self.snapshot.nodes.keys()
 
     def values(self):
-        return self.nodes.values()
+        return self.snapshot.nodes.values()
 
     @property
     def roots(self):
@@ -325,14 +576,67 @@ class CIB(object):
     @property
     def rows(self):
         """
-        Returns a generator containing all expanded root CIB nodes
+        Returns all expanded root CIB nodes of the current snapshot
         """
+        return self.snapshot.rows
 
+    @property
+    def extender_index(self):
+        """
+        Returns the index of extender CIB nodes, which is rebuilt after extenders have changed
+        """
+        if self._extender_index is None:
+            self._extender_index = ExtenderIndex(self.extenders.values())
+        return self._extender_index
+
+    def reachable(self, uid):
+        """
+        Return the uids of all CIB nodes reachable from the CIB node uid in the CIB graph.
+        """
+        seen = {uid}
+        stack = [uid]
+        while stack:
+            for u in self.graph.get(stack.pop(), []):
+                if u not in seen:
+                    seen.add(u)
+                    stack.append(u)
+        return seen
+
+    def publish(self, changed=None):
+        """
+        Expand the CIB rows and publish a new snapshot of the current CIB state.
+
+        If changed is a set of CIB node uids, only the rows of root nodes which reach (or previously reached) one of
+        these nodes are expanded again. The rows of all other root nodes are taken from the previous snapshot.
+        """
+        if changed is not None:
+            nodes = [n for uid in changed for n in (self.nodes.get(uid), self.snapshot.nodes.get(uid)) if n]
+            if any(not n.link and n.match for n in nodes):
+                # extender nodes may be applied to any row
+                changed = None
+
+        if changed is None:
+            self._extender_index = None
+
+        reach = {uid: self.reachable(uid) for uid in self.roots}
+        rows = {}
         for uid, r in self.roots.items():
+            if changed is not None and uid in self._rows and not (reach[uid] | self._reach.get(uid, set())) & changed:
+                rows[uid] = self._rows[uid]
+                continue
+
             # expand all cib nodes
-            for entry in r.expand_rows():
+            self.checkpoint()
+            rows[uid] = tuple(r.expand_rows())
+            for entry in rows[uid]:
                 entry.cib_node = uid
-                yield entry
+
+        self._rows = rows
+        self._reach = reach
+
+        self.snapshot = CIBSnapshot(self.snapshot.generation + 1, self.nodes, self.graph,
+                                    itertools.chain.from_iterable(rows.values()), self.path_stats())
+        logging.debug("published %s" % self.snapshot)
 
     def reload_files(self, cib_dir=None):
         """
@@ -340,6 +644,7 @@ class CIB(object):
         """
         cib_dir = self.cib_dir if not cib_dir else cib_dir
         full_names = set()
+        self.pending_reload = False
 
         logging.info("checking for CIB updates...")
 
@@ -354,10 +659,12 @@ class CIB(object):
                     if self.files[full_name] != stat.st_mtime_ns:
                         logging.info("CIB node %s has changed", full_name)
                         self.files[full_name] = stat.st_mtime_ns
+                        self.checkpoint()
                         self.load_cib_file(full_name)
                 else:
                     logging.info("new CIB node %s. loading...", full_name)
                     self.files[full_name] = stat.st_mtime_ns
+                    self.checkpoint()
                     self.load_cib_file(full_name)
 
         removed_files = self.files.keys() - full_names
@@ -367,13 +674,46 @@ class CIB(object):
             deleted_cs = [cs for cs in self.nodes.values() if cs.filename == filename]
             # remove corresponding CIBNode object
             for cs in deleted_cs:
-                self.nodes.pop(uid, None)
+                self.nodes.pop(cs.uid, None)
 
         # update links for all registered CIBs
         for cs in self.nodes.values():
+            cs.linked = set()
             cs.update_links_from_match()
 
         self.update_graph()
+        self.publish()
+
+    def load_image(self, nodes, files, rows):
+        """
+        Restore the CIB from a compiled image (see pmimage): the node dicts, the modification times of the CIB files
+        and the expanded rows. Rows are published as they are, without expanding the CIB graph.
+        """
+        self.nodes = {}
+        for d in nodes:
+            # the expiration time of nodes loaded without one was set when the image was compiled
+            if d.get('expire') is not None and d['expire'] != -1 and d['expire'] < time.time():
+                d['expire'] = None
+            cib_node = CIBNode(d)
+            self.nodes[cib_node.uid] = cib_node
+        self.files = dict(files)
+
+        for cs in self.nodes.values():
+            cs.linked = set()
+            cs.update_links_from_match()
+        self.update_graph()
+        self._extender_index = None
+
+        self._rows = {uid: [] for uid in self.roots}
+        for row in rows:
+            self._rows.setdefault(row.cib_node, []).append(row)
+        self._rows = {uid: tuple(r) for uid, r in self._rows.items()}
+        self._reach = {uid: self.reachable(uid) for uid in self.roots}
+        self.pending_reload = False
+
+        self.snapshot = CIBSnapshot(self.snapshot.generation + 1, self.nodes, self.graph,
+                                    itertools.chain.from_iterable(self._rows.values()), self.path_stats())
+        logging.debug("published %s" % self.snapshot)
 
     def load_cib_file(self, filename):
         cs = load_json(filename)
@@ -390,6 +730,7 @@ class CIB(object):
         self.register(cib_node)
 
     def update_graph(self):
+        self.graph = {}
         for i in self.nodes.values():
             if not i.link:
                 continue
@@ -399,83 +740,305 @@ class CIB(object):
                 if i.uid not in self.graph[r]:
                     self.graph[r].append(i.uid)
 
-    def import_json(self, slim, uid=None):
+        self.find_cycles()
+
+        # invalidate memoized paths
+        self._paths = {}
+        self._path_counts = {}
+        self._row_counts = {}
+
+    def find_cycles(self):
         """
-        Import JSON formatted CIB entries into current cib.
+        Compute the strongly connected components of the CIB graph (Tarjan).
+
+        A path leaving a component can never return to it, so only the visited nodes of the current component affect
+        how a path continues. All other paths are shared between root nodes.
+        """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        self._components = {}
+
+        for start in itertools.chain(self.graph, self.nodes):
+            if start in index:
+                continue
+            index[start] = low[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+            work = [(start, iter(self.graph.get(start, ())))]
+
+            while work:
+                uid, successors = work[-1]
+                for u in successors:
+                    if u not in index:
+                        index[u] = low[u] = len(index)
+                        stack.append(u)
+                        on_stack.add(u)
+                        work.append((u, iter(self.graph.get(u, ()))))
+                        break
+                    elif u in on_stack:
+                        low[uid] = min(low[uid], index[u])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[uid])
+                    if low[uid] != index[uid]:
+                        continue
+
+                    component = []
+                    while True:
+                        u = stack.pop()
+                        on_stack.discard(u)
+                        component.append(u)
+                        if u == uid:
+                            break
+                    component = frozenset(component)
+                    for u in component:
+                        self._components[u] = component
+                    if len(component) > 1:
+                        logging.info("CIB graph contains a cycle between nodes %s" % ', '.join(sorted(component)))
+
+    def _successors(self, uid, visited):
+        """Return the successors of uid which are not yet part of a path, and the visited nodes relevant to them."""
+        component = self._components.get(uid, frozenset())
+        visited = (visited & component) | {uid}
+        return [u for u in self.graph.get(uid, ()) if u not in visited], frozenset(visited)
+
+    def paths(self, uid, visited=frozenset()):
+        """
+        Return all paths (tuples of CIB node uids) from the CIB node uid through the CIB graph, excluding the nodes
+        in visited.
+
+        Paths are memoized for each CIB node, so that sub-paths are shared between all root nodes. At most max_paths
+        paths are returned.
+        """
+        successors, visited = self._successors(uid, visited)
+        key = (uid, visited)
+        try:
+            return self._paths[key]
+        except KeyError:
+            pass
+
+        if not successors:
+            paths = ((uid,),)
+        else:
+            paths = tuple(itertools.islice(((uid,) + p for u in successors for p in self.paths(u, visited)),
+                                           self.max_paths))
+
+        self._paths[key] = paths
+        return paths
+
+    def path_count(self, uid, visited=frozenset()):
+        """
+        Return the number of paths from the CIB node uid without enumerating them.
+        """
+        successors, visited = self._successors(uid, visited)
+        key = (uid, visited)
+        if key not in self._path_counts:
+            self._path_counts[key] = sum(self.path_count(u, visited) for u in successors) if successors else 1
+        return self._path_counts[key]
+
+    def row_count(self, uid, visited=frozenset()):
+        """
+        Return the number of CIB rows generated by expanding all paths from the CIB node uid, excluding extensions.
+        """
+        successors, visited = self._successors(uid, visited)
+        key = (uid, visited)
+        if key not in self._row_counts:
+            count = sum(self.row_count(u, visited) for u in successors) if successors else 1
+            self._row_counts[key] = self.nodes[uid].expansion_count() * count
+        return self._row_counts[key]
+
+    def path_stats(self):
+        """
+        Return the number of paths and rows of each root node, e.g., to detect CIB topologies that are about to blow up.
+        """
+        return {uid: {'paths': self.path_count(uid), 'rows': self.row_count(uid), 'max_paths': self.max_paths,
+                      'max_rows': self.max_rows} for uid in self.roots}
+
+    def import_json(self, slim, uid=None, reload=True):
         """
+        Import JSON formatted CIB entries into current cib.
 
-        # TODO optimize
+        If reload is False the imported entries are only written to the CIB directory and are loaded by the next call
+        to reload_files(). Returns True if any CIB files were written.
+        """
 
         try:
             json_slim = json.loads(slim)
         except json.decoder.JSONDecodeError:
             logging.warning('invalid CIB file format')
-            return
+            return False
 
         # check if we received multiple objects in a list
         if isinstance(json_slim, list):
+            written = False
             for c in json_slim:
-                self.import_json(json.dumps(c))
-            return
+                written |= self.import_json(json.dumps(c), reload=False)
+            if written and reload:
+                self.reload_files()
+            return written
+
+        # partial update of an existing CIB node: {"uid": <uid>, "patch": [<JSON patch operations>]}
+        if isinstance(json_slim, dict) and 'patch' in json_slim:
+            if self.pending_reload:
+                # the node may have been imported without reloading
+                self.reload_files()
+            try:
+                self.patch(json_slim.get('uid', uid), json_slim['patch'])
+            except KeyError:
+                logging.warning("cannot patch unknown CIB node %s" % json_slim.get('uid', uid))
+            except CIBEntryError as e:
+                logging.warning(e)
+            return False
 
         # convert to CIB node object to do sanity check
         try:
             cs = CIBNode(json_slim)
         except CIBEntryError as e:
             print(e)
-            return
-
+            return False
 
         if uid is not None:
             cs.uid = uid
 
-        filename = cs.uid
+        self.save_node(cs)
+        self.pending_reload = True
+        if reload:
+            self.reload_files()
+        return True
+
+    def save_node(self, cs, full_name=None):
+        """
+        Write a CIB node to the CIB directory, or to full_name if given. Returns the full name of the written file.
+        """
         slim = cs.json()
 
-        if not filename:
-            logging.warning("CIB entry has no UID")
-            # generate CIB filename
-            filename = hashlib.md5(slim.encode('utf-8')).hexdigest()
+        if full_name is None:
+            filename = cs.uid
+            if not filename:
+                logging.warning("CIB entry has no UID")
+                # generate CIB filename
+                filename = hashlib.md5(slim.encode('utf-8')).hexdigest()
 
-        filename = '%s.cib' % filename.lower()
+            filename = '%s.cib' % filename.lower()
+            full_name = os.path.join(self.cib_dir, filename)
+        else:
+            filename = full_name
 
-        with open(os.path.join(self.cib_dir, '%s' % filename), 'w') as f:
+        with open(full_name, 'w') as f:
             f.write(slim)
             logging.info("CIB entry saved as \"%s\"." % filename)
 
-        self.reload_files()
+        return full_name
 
-    def register(self, cib_node):
-        if cib_node in self.nodes:
-            logging.debug("overwriting existing CIB with uid %s" % cib_node.uid)
-        self.nodes[cib_node.uid] = cib_node
-
-    def lookup(self, input_properties, candidate_num=5):
+    def apply_delta(self, updated=(), removed=()):
         """
-        CIB lookup logic implementation. Appends a list of connection candidates to the query object. TODO
+        Apply a set of changed CIB nodes without rescanning the CIB directory.
 
+        updated is a list of CIB node dicts which are added or replace existing nodes with the same uid, removed is
+        a list of uids of CIB nodes to delete. Only links from and to the affected nodes are recomputed.
         """
-        assert isinstance(input_properties, PropertyArray)
-        candidates = [input_properties]
-        for e in self.rows:
+        changed = dict()
+        for node_dict in updated:
             try:
-                # FIXME better check whether all input properties are included in row - improve matching
-                # ignore optional properties in input request
-                i = PropertyArray(*(p for p in input_properties.values() if p.precedence > NEATProperty.OPTIONAL))
-                if len(i & e) != len(i):
-                    continue
+                cs = CIBNode(node_dict)
+            except CIBEntryError as e:
+                logging.error("Unable to import CIB node: %s" % e)
+                continue
+            # overwrite the file of an existing node with the same uid
+            old = self.nodes.get(cs.uid)
+            full_name = self.save_node(cs, old.filename if old is not None and old.filename else None)
+            cs.filename = full_name
+            self.files[full_name] = os.stat(full_name).st_mtime_ns
+            changed[cs.uid] = cs
+
+        deleted = set()
+        for uid in removed:
+            cs = self.nodes.pop(uid, None)
+            if cs is None:
+                continue
+            deleted.add(uid)
+            if cs.filename in self.files:
+                del self.files[cs.filename]
+                try:
+                    os.remove(cs.filename)
+                except OSError as e:
+                    logging.warning("Could not remove CIB file %s: %s" % (cs.filename, e))
+
+        if not changed and not deleted:
+            return
 
-            except ImmutablePropertyError:
+        for cs in changed.values():
+            self.register(cs)
+
+        # recompute links of the changed nodes and links from unchanged nodes to changed nodes
+        for cs in self.nodes.values():
+            if cs.uid in changed:
+                cs.linked = set()
+                cs.update_links_from_match()
+            else:
+                cs.linked -= changed.keys() | deleted
+                cs.update_links_from_match(changed.values())
+
+        self.update_graph()
+        self.publish(changed.keys() | deleted)
+        logging.info("CIB delta applied: %d updated, %d removed" % (len(changed), len(deleted)))
+
+    def patch(self, uid, ops):
+        """
+        Apply a JSON patch to the CIB node uid and return the patched node.
+
+        Patches are applied in memory only, i.e., the CIB file is not rewritten. Links are recomputed for the patched
+        node if its match field changed, and for nodes whose match fields reference one of the patched properties.
+        """
+        old_node = self.nodes[uid]
+
+        # copy on write, published snapshots keep referencing the unpatched node
+        node = copy.copy(old_node)
+        node.linked = set(old_node.linked)
+        node.patch(ops)
+
+        before = old_node.dict()
+        old_properties = {(k, json.dumps(v, sort_keys=True)) for p in old_node.properties for k, v in p.dict().items()}
+        new_properties = {(k, json.dumps(v, sort_keys=True)) for p in node.properties for k, v in p.dict().items()}
+        changed_keys = {k for k, v in old_properties ^ new_properties}
+
+        self.nodes[uid] = node
+
+        # uids of all nodes whose links have to be updated
+        relinked = set()
+        if before['match'] != node.dict()['match'] or before['link'] != node.link:
+            node.linked = set()
+            node.update_links_from_match()
+            relinked.add(uid)
+
+        for cs in self.nodes.values():
+            if cs is node or not any(changed_keys & m.keys() for m in cs.match):
                 continue
+            cs.linked.discard(uid)
+            cs.update_links_from_match([node])
+            relinked.add(cs.uid)
 
-            try:
-                candidate = e + input_properties
-                candidate.cib_node = e.cib_node
-                candidates.append(candidate)
-            except ImmutablePropertyError:
-                pass
+        if relinked:
+            self.update_graph()
+        self.publish(relinked | {uid})
+
+        logging.info("CIB node %s patched (%s)" % (uid, ', '.join(sorted(changed_keys))))
+        return node
+
+    def register(self, cib_node):
+        if cib_node in self.nodes:
+            logging.debug("overwriting existing CIB with uid %s" % cib_node.uid)
+        self.nodes[cib_node.uid] = cib_node
 
-        return sorted(candidates, key=operator.attrgetter('score'), reverse=True)[:candidate_num]
+    def lookup(self, input_properties, candidate_num=5):
+        """
+        CIB lookup using the current snapshot.
+        """
+        return self.snapshot.lookup(input_properties, candidate_num=candidate_num)
 
     def dump(self, show_all=False):
         print(term_separator("CIB START"))
@@ -500,7 +1063,7 @@ if __name__ == "__main__":
     code.interact(local=locals(), banner='CIB')
 
     for uid in cib.roots:
-        z = cib[uid].resolve_links([])
+        z = cib.paths(uid)
         print(z)
 
     query = PropertyArray()
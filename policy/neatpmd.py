@@ -1,19 +1,32 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import functools
 import io
 import logging
 import os
 import signal
 import sys
+import time
+from collections import Counter
 from copy import deepcopy
 from operator import attrgetter
 
 import pmdefaults as PM
+import pmimage
 import pmrest
 import policy
 from cib import CIB
 from pib import PIB
+from pmadmission import AdmissionControl, peer_credentials
+from pmcache import NegativeCache, SingleFlight, canonical_request
+from pmcapture import Capture
+from pmdeadline import Deadline, request_budget
+from pmencoding import BINARY_ENCODING, ENCODING_HEADER, EncodingError, encode_reply, split_headers
+from pmlanes import Lanes
+from pmprofile import Profiler, ProfilerError
+from pmtrace import Tracer
+from pmupdate import Updater
 from policy import PropertyMultiArray
 
 
@@ -31,6 +44,9 @@ parser.add_argument('--rest-ip', type=str, default=None, help='set local managem
 parser.add_argument('--debug', type=bool, default=None, help='enable debugging')
 parser.add_argument('--rest', type=bool, default=None, help='enable REST API')
 parser.add_argument('--bypass', type=bool, default=False, help='enable debugging')
+parser.add_argument('--capture', type=str, default=None, help='record all socket messages to the given file')
+parser.add_argument('--image', type=str, default=None,
+                    help='load the CIB and PIB from a compiled image file shared with other PM processes')
 args = parser.parse_args()
 
 if args.cib:
@@ -50,6 +66,8 @@ if args.debug:
     PM.DEBUG = args.debug
 if args.rest:
     PM.REST_ENABLE = args.rest
+if args.image:
+    PM.IMAGE_FILE = args.image
 
 try:
     os.makedirs(os.path.dirname(PM.DOMAIN_SOCK), exist_ok=True)
@@ -72,6 +90,12 @@ except OSError as e:
     raise SystemExit()
 
 
+# set once the CIB, profiles and PIB have been loaded after startup
+ready = False
+# time in seconds after startup at which each startup phase completed
+startup_phases = {}
+
+
 def process_special_properties(r):
     if 'local_endpoint' in r:
         # the local_endpoint property has the format a.b.c.d@eth0 so we need to split it
@@ -108,15 +132,38 @@ def cleanup_special_properties(r):
         del r['uid']
 
 
-def process_request(json_str, num_candidates=10):
-    """Process JSON requests from NEAT logic"""
+def process_request(json_str, num_candidates=10, deadline=None):
+    """
+    Process JSON requests from NEAT logic. If a deadline is given, processing stops once it has expired and the best
+    candidates found so far are returned, or None if no candidate was found.
+    """
     logging.debug(json_str)
+    # sampled requests are traced, trace is None otherwise
+    trace = tracer.start(json_str)
+
+    # run all lookups of this request against the same CIB/PIB snapshots
+    profiles_view, cib_view, pib_view = profiles.snapshot, cib.snapshot, pib.snapshot
+
+    # skip requests which did not yield any candidates since the last profile/CIB/PIB update
+    start = time.perf_counter()
+    request_key = canonical_request(json_str)
+    cache_key = (request_key, num_candidates) if request_key else None
+    generations = (profiles_view.generation, cib_view.generation, pib_view.generation)
+    if negative_cache.get(cache_key, generations):
+        logging.info("request did not yield any candidates before, skipping lookup")
+        if trace:
+            trace.stage('negative_cache', generations=generations)
+        tracer.finish(trace)
+        return []
 
     # list which will hold all requests
     requests = []
     try:
         properties_list = policy.json_to_properties(json_str)
     except policy.InvalidPropertyError:
+        if trace:
+            trace.stage('parse', error='invalid request')
+        tracer.finish(trace)
         return
 
     try:
@@ -131,6 +178,9 @@ def process_request(json_str, num_candidates=10):
 
     except policy.NEATPropertyError as e:
         print(e)
+        if trace:
+            trace.stage('parse', error=str(e))
+        tracer.finish(trace)
         return
 
     # local_endpoint handling
@@ -139,6 +189,8 @@ def process_request(json_str, num_candidates=10):
         process_special_properties(r)
 
     print('Received %d NEAT requests' % len(requests))
+    if trace:
+        trace.stage('parse', requests=len(requests), generations=generations)
     # for i, request in enumerate(requests):
     #    print("%d: " % i, request)
 
@@ -146,18 +198,25 @@ def process_request(json_str, num_candidates=10):
 
     # main lookup sequence
     for i, request in enumerate(requests):
+        if deadline is not None and deadline.expired('profile'):
+            break
         print(policy.term_separator("processing request %d/%d" % (i + 1, len(requests)), offset=0, line_char='─'))
         logging.info("    %s" % request)
 
         print('Profile lookup...')
-        updated_requests = profiles.lookup(request, tag='(profile)')
+        profile_trace = [] if trace else None
+        updated_requests = profiles_view.lookup(request, tag='(profile)', trace=profile_trace)
         for ur in updated_requests:
             logging.debug("updated request %s" % (ur))
+        if trace:
+            trace.stage('profile', request=i, profiles=profile_trace, requests=len(updated_requests))
 
         cib_candidates = []
         print('CIB lookup...')
         for ur in updated_requests:
-            for c in cib.lookup(ur):
+            if deadline is not None and deadline.expired('cib'):
+                break
+            for c in cib_view.lookup(ur):
                 if c in cib_candidates: continue
                 cib_candidates.append(c)
 
@@ -165,14 +224,32 @@ def process_request(json_str, num_candidates=10):
         print('    CIB lookup returned %d candidates:' % len(cib_candidates))
         for c in cib_candidates:
             logging.debug('   %s %.1f %.1f' % (c, *c.score))
+        if trace:
+            trace.stage('cib', request=i, generation=cib_view.generation, candidates=len(cib_candidates),
+                        rows=[{'cib_node': c.cib_node, 'path': c.meta.get('cib_uids'), 'score': c.score}
+                              for c in cib_candidates if hasattr(c, 'cib_node')])
 
         print('PIB lookup...')
+        policy_trace = [] if trace else None
         for j, candidate in enumerate(cib_candidates):
+            if deadline is not None and deadline.expired('pib'):
+                break
             cand_id = 'CIB candidate %s' % (j + 1)
-            for c in pib.lookup(candidate, tag=cand_id):
+            for c in pib_view.lookup(candidate, tag=cand_id, trace=policy_trace):
                 if c in candidates: continue
                 candidates.append(c)
                 logging.debug(c)
+        if trace:
+            trace.stage('pib', request=i, policies=policy_trace, candidates=len(candidates))
+
+    truncated = deadline.truncated if deadline is not None else None
+    if truncated:
+        logging.info("request deadline expired during %s lookup, %d candidates found" % (truncated, len(candidates)))
+        if trace:
+            trace.stage('deadline', truncated=truncated, candidates=len(candidates))
+        if not candidates:
+            tracer.finish(trace)
+            return
 
     candidates.sort(key=attrgetter('score'), reverse=True)
     top_candidates = candidates[:num_candidates]
@@ -188,9 +265,22 @@ def process_request(json_str, num_candidates=10):
     # TODO check if candidates contain the minimum src/dst/transport tuple
     print(policy.term_separator())
 
+    if not top_candidates and not truncated:
+        negative_cache.add(cache_key, generations, time.perf_counter() - start)
+
+    if trace:
+        trace.stage('result', candidates=len(candidates), returned=len(top_candidates))
+    tracer.finish(trace)
+
     return top_candidates
 
 
+def log_import_failure(name, future):
+    """Log the failure of a CIB/PIB import received on a socket, whose result is not awaited otherwise"""
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("%s import failed: %s" % (name, future.exception()))
+
+
 class PIBProtocol(asyncio.Protocol):
     """
 
@@ -211,7 +301,9 @@ class PIBProtocol(asyncio.Protocol):
 
     def eof_received(self):
         logging.info("New PIB object received (%dB)." % len(self.slim))
-        pib.import_json(self.slim)
+        if capture:
+            capture.record('pib', self.slim)
+        pib_updater.import_json(self.slim).add_done_callback(functools.partial(log_import_failure, 'PIB'))
         self.transport.close()
 
 
@@ -228,7 +320,9 @@ class CIBProtocol(asyncio.Protocol):
 
     def eof_received(self):
         logging.info("New CIB object received (%dB)" % len(self.slim))
-        cib.import_json(self.slim)
+        if capture:
+            capture.record('cib', self.slim)
+        cib_updater.import_json(self.slim).add_done_callback(functools.partial(log_import_failure, 'CIB'))
         self.transport.close()
 
 
@@ -236,6 +330,10 @@ class PMProtocol(asyncio.Protocol):
     def connection_made(self, transport):
         self.transport = transport
         self.request = ''
+        # the request deadline is counted from the connection of the client
+        self.connected = time.monotonic()
+        # (pid, uid, gid) of the client process
+        self.credentials = peer_credentials(transport)
 
     def data_received(self, data):
         message = data.decode()
@@ -243,6 +341,13 @@ class PMProtocol(asyncio.Protocol):
 
     def eof_received(self):
         logging.info("New JSON request received (%dB)" % len(self.request))
+        if capture:
+            capture.record('pm', self.request)
+        if not ready and not PM.STARTUP_PARTIAL_REPLIES:
+            # close without reply, NEAT falls back to resolving the destination itself
+            logging.info("PM not ready, request dropped")
+            self.transport.close()
+            return
         # TODO remove for production
         # for debugging neat core skip all calls to CIB/PIB
         if args.bypass:
@@ -250,22 +355,108 @@ class PMProtocol(asyncio.Protocol):
             self.transport.write(data)
             self.transport.close()
             return
-        else:
-            candidates = process_request(self.request.strip())
 
-        # create JSON string for NEAT logic reply
+        if not admission.admit(self.credentials, functools.partial(self.reply, self.request.strip())):
+            # overloaded, close without reply so that NEAT falls back to resolving the destination itself
+            self.transport.close()
+            return
+        # keep the transport open until the reply has been sent
+        return True
+
+    async def reply(self, request):
+        # clients may request a binary reply encoding and a time budget in header lines preceding the JSON request
+        headers, json_str = split_headers(request)
+        encoding = headers.get(ENCODING_HEADER, 'json').lower()
+        if encoding != BINARY_ENCODING:
+            encoding = 'json'
+
+        deadline = Deadline(request_budget(headers), start=self.connected,
+                            sock=self.transport.get_extra_info('socket'))
+        # drop requests whose clients gave up while they were queued
+        if deadline.expired():
+            request_deadlines['disconnected' if deadline.disconnected() else 'timed_out'] += 1
+            self.transport.close()
+            return
+
+        # concurrent identical requests are processed only once
         try:
-            j = [policy.properties_to_json(c) for c in candidates]
-            candidates_json = '[' + ', '.join(j) + ']\n'
-        except TypeError:
+            candidates = await request_flights.run(canonical_request(json_str), profiler.call,
+                                                   functools.partial(lookup_request, deadline=deadline), json_str,
+                                                   deadline=deadline)
+        except Exception:
+            logging.exception("request processing failed")
+            self.transport.close()
             return
 
-        data = candidates_json.encode(encoding='utf-8')
+        if deadline.closed():
+            request_deadlines['disconnected'] += 1
+            self.transport.close()
+            return
+        if deadline.leader.truncated:
+            # the best candidates found before the deadline are returned, if any
+            request_deadlines['truncated' if candidates else 'timed_out'] += 1
+
+        # encode the reply for NEAT logic
+        try:
+            data = encode_reply(candidates, encoding)
+        except (TypeError, EncodingError):
+            self.transport.close()
+            return
+        reply_encodings[encoding] += 1
 
         self.transport.write(data)
         self.transport.close()
 
 
+def load_phase(name, load, start):
+    """Run a startup phase and record the time since startup after which it completed"""
+    load()
+    startup_phases[name] = round(time.perf_counter() - start, 3)
+    logging.info("startup: %s loaded after %.3fs" % (name, startup_phases[name]))
+
+
+async def load_all(start):
+    """
+    Load the profiles, PIB and CIB on the update threads, publishing each as soon as it has been loaded.
+
+    If an image file is configured and up to date, the CIB and PIB are restored from the image. Otherwise they are
+    loaded from their directories and compiled into a new image for other PM processes.
+    """
+    global ready
+
+    image = pmimage.open_image(PM.IMAGE_FILE, PM.CIB_DIR, PM.PIB_DIR) if PM.IMAGE_FILE else None
+    if image is not None:
+        logging.info("loading CIB and PIB from image %s" % PM.IMAGE_FILE)
+        phases = [pib_updater.call(load_phase, 'profiles', lambda: profiles.load_image(*image.pib_state('profiles')),
+                                   start),
+                  pib_updater.call(load_phase, 'pib', lambda: pib.load_image(*image.pib_state('pib')), start),
+                  cib_updater.call(load_phase, 'cib', lambda: cib.load_image(*image.cib_state()), start)]
+    else:
+        phases = [pib_updater.call(load_phase, 'profiles', profiles.load_policies, start),
+                  pib_updater.call(load_phase, 'pib', pib.load_policies, start),
+                  cib_updater.call(load_phase, 'cib', cib.reload_files, start)]
+    failed = False
+    for result in await asyncio.gather(*phases, return_exceptions=True):
+        if isinstance(result, Exception):
+            logging.error("startup failed: %s" % result)
+            failed = True
+
+    ready = True
+    startup_phases['ready'] = round(time.perf_counter() - start, 3)
+    print('Policy manager ready after %.3fs' % startup_phases['ready'])
+
+    if image is not None:
+        image.close()
+    elif PM.IMAGE_FILE and not failed:
+        try:
+            # each state is captured together with its snapshot on the thread updating it
+            states = await asyncio.gather(cib_updater.call(pmimage.cib_image_state, cib),
+                                          pib_updater.call(pmimage.pib_image_state, pib, profiles))
+            await asyncio.get_event_loop().run_in_executor(None, pmimage.write_image, PM.IMAGE_FILE, *states)
+        except OSError as e:
+            logging.error("unable to write PM image: %s" % e)
+
+
 def signal_handler():
     print()
     print(policy.term_separator('ENTERING INTERACTIVE DEBUG MODE', line_char='#'))
@@ -277,6 +468,25 @@ def signal_handler():
     print()
 
 
+def log_profiler_failure(future):
+    """Log the failure of a profiler run stopped by a signal"""
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("unable to write profile: %s" % future.exception())
+
+
+def profile_signal_handler():
+    """Start a sampling profiler run, or stop the running profiler"""
+    if profiler.running:
+        # stopping waits for the sampler thread and writes the profile, which must not block the event loop
+        future = asyncio.get_event_loop().run_in_executor(None, profiler.stop)
+        future.add_done_callback(log_profiler_failure)
+        return
+    try:
+        profiler.start('sample')
+    except ProfilerError as e:
+        print(e)
+
+
 def no_loop_test():
     """
     Dummy JSON request for testing
@@ -297,12 +507,40 @@ if __name__ == "__main__":
     logging.debug("PIB directory is %s" % PM.PIB_DIR)
     logging.debug("CIB directory is %s" % PM.CIB_DIR)
 
-    cib = CIB(PM.CIB_DIR)
-    profiles = PIB(PM.PIB_DIR, file_extension='.profile')
-    pib = PIB(PM.PIB_DIR, file_extension='.policy')
+    start = time.perf_counter()
+
+    # the CIB and PIB are loaded in the background once the sockets are available
+    cib = CIB(PM.CIB_DIR, load=False)
+    profiles = PIB(PM.PIB_DIR, file_extension='.profile', load=False)
+    pib = PIB(PM.PIB_DIR, file_extension='.policy', load=False)
+
+    # requests which did not yield any candidates
+    negative_cache = NegativeCache()
+    # lookups run in a lane which preempts CIB/PIB ingest
+    lanes = Lanes()
+    lookup_request = lanes.lookup(process_request)
+    # PM socket requests currently being processed
+    request_flights = SingleFlight(submit=lanes.submit)
+    # rate limits and fair scheduling of the requests of different clients
+    admission = AdmissionControl()
+    cib.checkpoint = profiles.checkpoint = pib.checkpoint = lanes.checkpoint
+    # live profiler, controlled using SIGUSR1 or the REST API
+    profiler = Profiler()
+    # sampled request traces
+    tracer = Tracer()
+    # number of replies sent using each reply encoding
+    reply_encodings = Counter()
+    # number of requests which timed out, were truncated at their deadline or whose clients disconnected
+    request_deadlines = Counter()
+    # record socket messages for pmreplay.py
+    capture = Capture(args.capture) if args.capture else None
 
     loop = asyncio.get_event_loop()
 
+    # CIB and PIB updates are applied on background threads
+    cib_updater = Updater(cib.import_json, cib.reload_files, name='CIB update', batch=lanes.ingest)
+    pib_updater = Updater(pib.import_json, pib.reload, name='PIB update', batch=lanes.ingest)
+
     # Each client connection creates a new protocol instance
     coro = loop.create_unix_server(PMProtocol, PM.DOMAIN_SOCK)
     server = loop.run_until_complete(coro)
@@ -313,12 +551,25 @@ if __name__ == "__main__":
     coro_cib = loop.create_unix_server(CIBProtocol, PM.CIB_SOCK)
     cib_server = loop.run_until_complete(coro_cib)
 
+    startup_phases['sockets'] = round(time.perf_counter() - start, 3)
+    asyncio.ensure_future(load_all(start))
+
     # interactive debug mode
     logging.debug('Use Ctrl-\\ to enter interactive debug mode.')
     loop.add_signal_handler(signal.SIGQUIT, signal_handler)
+    logging.debug('Use SIGUSR1 to start/stop the profiler.')
+    loop.add_signal_handler(signal.SIGUSR1, profile_signal_handler)
 
     # try to start the PM REST interface
-    pmrest.init_rest_server(loop, profiles, cib, pib, rest_port=PM.REST_PORT)
+    pmrest.init_rest_server(loop, profiles, cib, pib, rest_port=PM.REST_PORT,
+                            process_request_ref=profiler.wrap(lookup_request), cib_updater_ref=cib_updater,
+                            pib_updater_ref=pib_updater,
+                            stats_ref={'negative_cache': negative_cache.stats, 'request_flights': request_flights.stats,
+                                       'cib_updater': cib_updater.stats, 'pib_updater': pib_updater.stats,
+                                       'tracer': tracer.stats, 'startup': startup_phases,
+                                       'reply_encodings': reply_encodings, 'admission': admission.stats,
+                                       'lanes': lanes.stats, 'request_deadlines': request_deadlines},
+                            profiler_ref=profiler, tracer_ref=tracer, admission_ref=admission, lanes_ref=lanes)
 
     print('Waiting for PM requests on {} ...'.format(server.sockets[0].getsockname()))
     try:
@@ -337,6 +588,12 @@ if __name__ == "__main__":
         loop.run_until_complete(pib_server.wait_closed())
         cib_server.close()
         loop.run_until_complete(cib_server.wait_closed())
+
+        cib_updater.close()
+        pib_updater.close()
+        profiler.stop()
+        if capture:
+            capture.close()
     except (AttributeError, OSError) as e:
         pass
     except Exception as e:
@@ -1,12 +1,21 @@
 import bisect
+import copy
 import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
 import time
+from collections import namedtuple
+from operator import itemgetter
+from types import MappingProxyType
 
 import pmdefaults as PM
-from policy import PropertyArray, PropertyMultiArray, dict_to_properties, ImmutablePropertyError, term_separator
+from pmprefix import AddressIndex
+from policy import NEATProperty, PropertyArray, PropertyMultiArray, dict_to_properties, ImmutablePropertyError
+from policy import term_separator
+from policy import apply_json_patch, JSONPatchError, NEATPropertyError
 
 PIB_EXTENSIONS = ('.policy', '.profile', '.pib')
 
@@ -15,15 +24,17 @@ class NEATPIBError(Exception):
     pass
 
 
-def load_policy_json(filename):
-    """Read and decode a .policy JSON file and return a NEATPolicy object."""
+def load_policy_json(filename, data=None):
+    """Read and decode a .policy JSON file and return a NEATPolicy object. data may hold the file contents."""
     try:
-        policy_file = open(filename, 'r')
-        policy_dict = json.load(policy_file)
+        if data is None:
+            with open(filename, 'rb') as policy_file:
+                data = policy_file.read()
+        policy_dict = json.loads(data.decode('utf-8'))
     except OSError as e:
         logging.error('Policy ' + filename + ' not found.')
         raise NEATPIBError(e)
-    except json.decoder.JSONDecodeError as e:
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError) as e:
         logging.error('Error parsing policy file ' + filename)
         print(e)
         raise NEATPIBError(e)
@@ -32,6 +43,10 @@ def load_policy_json(filename):
     return p
 
 
+# state of a loaded policy file: modification time in ns, SHA1 digest of the contents and uid of its policy
+PolicyFile = namedtuple('PolicyFile', ['mtime', 'digest', 'uid'])
+
+
 class NEATPolicy(object):
     """NEAT policy representation"""
 
@@ -64,6 +79,8 @@ class NEATPolicy(object):
         properties = policy_dict.get('properties', {})
         self.properties = PropertyMultiArray()
         self.properties.add(*dict_to_properties(properties))
+        # all combinations of the policy properties merged into the candidates by lookups
+        self.expansions = tuple(self.properties.expand())
 
         # set UID
         self.uid = policy_dict.get('uid')
@@ -96,6 +113,18 @@ class NEATPolicy(object):
     def json(self):
         return json.dumps(self.dict(), indent=4, sort_keys=True)
 
+    def patch(self, ops):
+        """Apply a JSON patch to the policy attributes in place. The uid and filename of the policy are preserved."""
+        try:
+            d = apply_json_patch(self.dict(), ops)
+            d['uid'] = self.uid
+            policy = NEATPolicy(d)
+        except (JSONPatchError, NEATPropertyError, IndexError, TypeError, AttributeError, ValueError) as e:
+            raise NEATPIBError("invalid policy patch: %s" % e)
+
+        policy.filename = self.filename
+        self.__dict__.update(policy.__dict__)
+
     def match_len(self):
         """Use the number of match elements to sort the entries in the PIB.
         Entries with the smallest number of elements are matched first."""
@@ -139,22 +168,395 @@ class NEATPolicy(object):
         return repr({a: getattr(self, a) for a in ['uid', 'match', 'properties', 'priority']})
 
 
-class PIB(list):
-    def __init__(self, policy_dir, file_extension=('.policy', '.profile'), policy_type='policy'):
-        super().__init__()
-        self.policies = self
+def immutable_properties(properties):
+    """Return the immutable properties of a property array as a dict."""
+    return {k: p for k, p in properties.items() if p.precedence == NEATProperty.IMMUTABLE}
+
+
+def immutable_conflict(first, second):
+    """
+    Return True if merging second into first must fail, i.e., if both contain an immutable property with
+    non-overlapping values. Arguments are dicts returned by immutable_properties().
+    """
+    return any(k in second and not (p == second[k]) for k, p in first.items())
+
+
+def best_candidates(candidates, limit=None):
+    """
+    Return a list of the given candidates. If there are more than limit candidates (PIB_MAX_CANDIDATES by default),
+    only the limit candidates with the highest scores are kept, in their original order.
+    """
+    limit = PM.PIB_MAX_CANDIDATES if limit is None else limit
+    if not limit:
+        return list(candidates)
+    best = heapq.nlargest(limit, enumerate(candidates), key=lambda c: (c[1].score, -c[0]))
+    return [c for n, c in sorted(best, key=itemgetter(0))]
+
+
+class PIBAnalysis(object):
+    """
+    Load-time analysis of the policies of a PIB snapshot.
+
+    A policy conflicts with an earlier policy if any of their property expansions set the same immutable property to
+    non-overlapping values: a lookup matching both policies is always rejected. Lookups use the precomputed conflicts
+    to reject candidates without merging any properties.
+
+    In addition, the analysis reports
+
+    * dead policies, which conflict with an earlier or later policy matching whenever they match,
+    * shadowed policies, whose properties are always overwritten by a later policy matching whenever they match,
+    * no-op policies without any properties, which are skipped by lookups.
+
+    Dead and shadowed policies are derived from the policy definitions only and are reported for information.
+
+    If the analysis of a previous snapshot is given, only the conflicts of policies added or changed since are
+    computed, so that publishing a patched policy does not compare all pairs of policies again.
+    """
+
+    def __init__(self, policies=(), previous=None):
+        policies = [p for p in policies]
+        self.policies = {p.uid: p for p in policies}
+        # policies which are unchanged since the previous analysis keep their results, only the policies added or
+        # changed since are compared with the other policies
+        unchanged = set()
+        if previous is not None:
+            unchanged = {uid for uid, p in self.policies.items() if previous.policies.get(uid) is p}
+
+        # immutable properties of each expansion of the policy properties, by policy uid
+        self.immutables = {p.uid: previous.immutables[p.uid] if p.uid in unchanged else
+                           [immutable_properties(pa) for pa in p.expansions] for p in policies}
+
+        # uids of all conflicting policies, by policy uid
+        self.conflicting = {}
+        if previous is not None:
+            for uid in unchanged:
+                others = previous.conflicting.get(uid, set()) & unchanged
+                if others:
+                    self.conflicting[uid] = others
+        # conflicts of unchanged policies with added or changed policies, by uid of the unchanged policy
+        added = {}
+        # only policies setting immutable properties can conflict
+        immutable = [p for p in policies if not p.replace_matched and any(self.immutables[p.uid])]
+        changed = [p for p in immutable if p.uid not in unchanged]
+        for i, p in enumerate(changed):
+            for other in itertools.chain(changed[i + 1:], (q for q in immutable if q.uid in unchanged)):
+                if self._conflict(p.uid, other.uid):
+                    self.conflicting.setdefault(p.uid, set()).add(other.uid)
+                    self.conflicting.setdefault(other.uid, set()).add(p.uid)
+                    if other.uid in unchanged:
+                        added.setdefault(other.uid, []).append(p.uid)
+
+        # uids of the earlier policies conflicting with a policy, by policy uid. The relative order of unchanged
+        # policies is preserved, so that only conflicts with changed policies must be ordered again.
+        position = {p.uid: i for i, p in enumerate(policies)}
+        stale = (self.policies.keys() | previous.policies.keys()) - unchanged if previous is not None else set()
+        self.conflicts = {}
+        for uid, others in self.conflicting.items():
+            if uid in unchanged:
+                earlier = previous.conflicts.get(uid, set()) & unchanged
+                earlier.update(o for o in added.get(uid, ()) if position[o] < position[uid])
+            else:
+                earlier = {o for o in others if position[o] < position[uid]}
+            if earlier:
+                self.conflicts[uid] = earlier
+
+        self.noop = {p.uid for p in policies if not p.replace_matched and not p.properties}
+
+        # a policy dies with the first conflicting policy matching whenever it matches
+        self.dead = {}
+        for uid, others in self.conflicting.items():
+            if uid in unchanged and previous.dead.get(uid) not in stale:
+                others = added.get(uid, [])
+                if uid in previous.dead:
+                    others = others + [previous.dead[uid]]
+            covering = [o for o in others if self._covers(self.policies[o], self.policies[uid])]
+            if covering:
+                self.dead[uid] = min(covering, key=position.get)
+
+        # a policy can only be covered by policies with the same match keys, or without match properties
+        groups = {}
+        for i, p in enumerate(policies):
+            if not p.replace_matched:
+                groups.setdefault(frozenset(p.match.keys()), []).append((i, p))
+        self._groups = groups
+
+        self.shadowed = {}
+        if not unchanged:
+            for i, p in enumerate(policies):
+                self._shadow(i, p)
+            return
+
+        # keep the results of unchanged policies unless the policy shadowing them was changed or removed
+        changed = [(position[uid], self.policies[uid]) for uid in self.policies.keys() - unchanged]
+        for i, p in enumerate(policies):
+            other = previous.shadowed.get(p.uid)
+            if p.uid not in unchanged or other in stale:
+                self._shadow(i, p)
+            elif other is not None:
+                self.shadowed[p.uid] = other
+
+        # changed policies may shadow unchanged policies
+        for j, other in changed:
+            if other.replace_matched:
+                continue
+            targets = groups.values() if not other.match else [groups[frozenset(other.match.keys())]]
+            for i, p in itertools.chain.from_iterable(targets):
+                if i >= j or p.uid not in unchanged:
+                    continue
+                current = self.shadowed.get(p.uid)
+                if current is not None and position[current] < j:
+                    continue
+                if self._covers(other, p) and other.uid not in self.conflicting.get(p.uid, ()) and \
+                        self._overwrites(other, p):
+                    self.shadowed[p.uid] = other.uid
+
+    def _shadow(self, i, p):
+        """Find the first later policy covering policy p at position i and overwriting all of its properties."""
+        if p.replace_matched or not p.properties:
+            return
+        group = self._groups[frozenset(p.match.keys())]
+        wildcards = self._groups.get(frozenset(), [])
+        others = heapq.merge(group, wildcards, key=itemgetter(0)) if group is not wildcards else group
+        for j, other in others:
+            if j <= i or not self._covers(other, p) or other.uid in self.conflicting.get(p.uid, ()):
+                continue
+            if self._overwrites(other, p):
+                self.shadowed[p.uid] = other.uid
+                return
+
+    def _conflict(self, first_uid, second_uid):
+        return any(immutable_conflict(a, b) for a in self.immutables[first_uid] for b in self.immutables[second_uid])
+
+    @staticmethod
+    def _covers(policy, other):
+        """Return True if policy matches whenever other matches."""
+        if not policy.match:
+            return True
+        if policy.match.keys() != other.match.keys():
+            return False
+        return all((p.value, p.precedence) == (other.match[k].value, other.match[k].precedence)
+                   for k, p in policy.match.items())
+
+    @staticmethod
+    def _overwrites(policy, other):
+        """Return True if the properties of policy replace all properties of an earlier policy other."""
+        if not other.properties:
+            return False
+        for first in other.expansions:
+            for second in policy.expansions:
+                for k, p in first.items():
+                    q = second.get(k)
+                    if q is None or q.precedence < p.precedence or p == q:
+                        return False
+                    if p.precedence == q.precedence == NEATProperty.IMMUTABLE:
+                        return False
+        return True
+
+    def rejects(self, policy, applied, request_immutables=None):
+        """
+        Return True if applying policy is guaranteed to raise an ImmutablePropertyError, given the uids of the
+        policies already applied to the candidates and the immutable properties of the original request.
+        """
+        if policy.replace_matched:
+            return False
+        conflicts = self.conflicts.get(policy.uid)
+        if conflicts and not conflicts.isdisjoint(applied):
+            return True
+        if request_immutables:
+            return any(immutable_conflict(request_immutables, b) for b in self.immutables.get(policy.uid, ()))
+        return False
+
+    def report(self):
+        """Return the dead, shadowed and no-op policies."""
+        return {'dead': dict(self.dead), 'shadowed': dict(self.shadowed), 'noop': sorted(self.noop),
+                'conflicts': {uid: sorted(c) for uid, c in self.conflicts.items()}}
+
+
+class PIBSnapshot(object):
+    """
+    Immutable, versioned view of the ordered PIB policies used for lookups.
+
+    Updates modify the PIB and then publish a new snapshot by replacing the snapshot reference held by the PIB.
+    """
+
+    def __init__(self, generation=0, policies=(), previous=None):
+        self.generation = generation
+        self.policies = tuple(policies)
+        self.index = MappingProxyType({p.uid: p for p in self.policies})
+
+        # index policy positions by the addresses or address prefixes of their match properties
+        self.address_index = {k: AddressIndex(k) for k in PM.ADDRESS_PROPERTIES}
+        for n, p in enumerate(self.policies):
+            for index in self.address_index.values():
+                index.add(n, p.match)
+
+        # the analysis of the previous snapshot is updated for the changed policies only
+        self.analysis = PIBAnalysis(self.policies, previous.analysis if previous is not None else None)
+
+    def lookup(self, input_properties, apply=True, tag=None, trace=None):
+        """
+        Look through all installed policies to find the ones which match the properties of the given candidate.
+        If apply is True, append the matched policy properties. If trace is a list, a (uid, 'matched'/'rejected')
+        tuple is appended for each matched policy.
+
+        Returns all matched policies.
+        """
+
+        assert isinstance(input_properties, PropertyArray)
+        if tag is None:
+            tag = ''
+
+        logging.info("matching policies %s" % tag)
+        candidates = [input_properties]
+
+        # immutable request properties and uids of the policies applied since the last replace_matched policy, used
+        # to reject candidates without merging
+        request_immutables = immutable_properties(input_properties) if apply else None
+        applied = set()
+
+        for p in self.select(input_properties):
+            if p.match_query(input_properties):
+                policy_info = str(p.uid)
+                if hasattr(p, "description"):
+                    policy_info += ' (%s)' % p.description
+
+                if apply and self.analysis.rejects(p, applied, request_immutables):
+                    logging.info(' ' * 4 + policy_info + PM.STYLES.BOLD_START + ' *REJECTED*' + PM.STYLES.FORMAT_END)
+                    if trace is not None:
+                        trace.append((p.uid, 'rejected'))
+                    return []
+
+                if apply and p.uid not in self.analysis.noop:
+                    if p.replace_matched:
+                        applied = set()
+                        request_immutables = {k: v for k, v in request_immutables.items() if k not in p.match}
+                        # remove all matched properties from the candidates
+                        for candidate in candidates:
+                            for key in p.match:
+                                del candidate[key]
+                    applied.add(p.uid)
+
+                    # merge the precomputed policy expansions into the candidates one at a time
+                    merged = (candidate + policy_properties for candidate in reversed(candidates)
+                              for policy_properties in p.expansions)
+                    try:
+                        candidates = best_candidates(merged)
+                    except ImmutablePropertyError:
+                        logging.info(' ' * 4 + policy_info + PM.STYLES.BOLD_START + ' *REJECTED*' + PM.STYLES.FORMAT_END)
+                        if trace is not None:
+                            trace.append((p.uid, 'rejected'))
+                        return []
+
+                logging.info(' ' * 4 + policy_info)
+                if trace is not None:
+                    trace.append((p.uid, 'matched'))
+        return candidates
+
+    def select(self, input_properties):
+        """
+        Return the policies which may match the input properties in PIB order, skipping policies whose match address
+        properties are missing from the input or do not overlap with the input addresses.
+        """
+        positions = None
+        for k, index in self.address_index.items():
+            if not index.tree and not index.unindexed:
+                # no policy matches this property
+                continue
+            if k in input_properties:
+                selected = index.select(input_properties[k])
+                if selected is None:
+                    continue
+                selected |= index.without
+            else:
+                selected = index.without
+            positions = selected if positions is None else positions & selected
+
+        if positions is None:
+            return self.policies
+        return [self.policies[n] for n in sorted(positions)]
+
+    def __repr__(self):
+        return 'PIBSnapshot<%d: %d policies>' % (self.generation, len(self.policies))
+
+
+class PolicyStore(object):
+    """
+    Registered policies ordered by (priority, uid), i.e., in the order in which they are applied by lookups.
+
+    Positions are found by binary search on a sorted list of keys kept in parallel to the policies. Adding a policy
+    replaces any stored policy with the same uid.
+    """
+
+    def __init__(self, policies=()):
+        self.keys = []
+        self.policies = []
+        # policies by uid
         self.index = {}
+        for p in policies:
+            self.add(p)
+
+    @staticmethod
+    def key(policy):
+        return policy.priority, policy.uid
+
+    def add(self, policy):
+        """Insert a policy. Returns the replaced policy with the same uid, or None."""
+        old_policy = self.index.get(policy.uid)
+        if old_policy is not None:
+            self._remove(old_policy)
+
+        key = self.key(policy)
+        pos = bisect.bisect_left(self.keys, key)
+        self.keys.insert(pos, key)
+        self.policies.insert(pos, policy)
+        self.index[policy.uid] = policy
+        return old_policy
+
+    def remove(self, uid):
+        """Remove and return the policy uid. Raises KeyError if the policy is unknown."""
+        policy = self.index.pop(uid)
+        self._remove(policy)
+        return policy
+
+    def _remove(self, policy):
+        pos = bisect.bisect_left(self.keys, self.key(policy))
+        assert self.policies[pos] is policy
+        del self.keys[pos]
+        del self.policies[pos]
+
+    def __contains__(self, uid):
+        return uid in self.index
+
+    def __iter__(self):
+        return iter(self.policies)
+
+    def __len__(self):
+        return len(self.policies)
+
+    def __repr__(self):
+        return 'PolicyStore<%d policies>' % len(self.policies)
+
+
+class PIB(object):
+    def __init__(self, policy_dir, file_extension=('.policy', '.profile'), policy_type='policy', load=True):
+        self.policies = PolicyStore()
+        self.index = self.policies.index
+
+        # published view of the PIB used by lookups
+        self.snapshot = PIBSnapshot()
+        # called between chunks of ingest work, e.g., to let lookups run first (see pmlanes.Lanes.checkpoint)
+        self.checkpoint = lambda: None
+        # set if policy files were imported but not loaded yet
+        self.pending_reload = False
 
         self.file_extension = file_extension
-        # track PIB files
+        # loaded PIB files by full filename
+        self.files = {}
 
         self.policy_type = policy_type
         self.policy_dir = policy_dir
-        self.load_policies(self.policy_dir)
-
-    @property
-    def files(self):
-        return {v.filename: v for uid, v in self.index.items()}
+        if load:
+            self.load_policies(self.policy_dir)
 
     def load_policies(self, policy_dir=None):
         """Load all policies in policy directory."""
@@ -165,22 +567,57 @@ class PIB(list):
             if filename.endswith(self.file_extension) and not filename.startswith(('.', '#')):
                 self.load_policy(os.path.join(policy_dir, filename))
 
-    def import_json(self, slim, uid=None):
+        self.publish()
+
+    def publish(self):
+        """Publish a new snapshot of the current PIB policies."""
+        previous = self.snapshot.analysis
+        self.snapshot = PIBSnapshot(self.snapshot.generation + 1, self.policies, previous=self.snapshot)
+        logging.debug("published %s" % self.snapshot)
+
+        analysis = self.snapshot.analysis
+        for uid, other in analysis.dead.items():
+            if previous.dead.get(uid) != other:
+                logging.warning("%s %s is dead: it always conflicts with %s" % (self.policy_type, uid, other))
+        for uid, other in analysis.shadowed.items():
+            if previous.shadowed.get(uid) != other:
+                logging.warning("%s %s is shadowed by %s" % (self.policy_type, uid, other))
+
+    def import_json(self, slim, uid=None, reload=True):
         """
         Import a JSON formatted PIB entry into current pib.
+
+        If reload is False the imported policies are only written to the policy directory and are loaded by the next
+        call to reload(). Returns True if any policy files were written.
         """
 
         try:
             pib_entry = json.loads(slim)
         except json.decoder.JSONDecodeError:
             logging.warning('invalid PIB file format')
-            return
+            return False
 
         # check if we received multiple objects in a list
         if isinstance(pib_entry, list):
+            written = False
             for p in pib_entry:
-                self.import_json(json.dumps(p))
-            return
+                written |= self.import_json(json.dumps(p), reload=False)
+            if written and reload:
+                self.reload()
+            return written
+
+        # partial update of an existing policy: {"uid": <uid>, "patch": [<JSON patch operations>]}
+        if isinstance(pib_entry, dict) and 'patch' in pib_entry:
+            if self.pending_reload:
+                # the policy may have been imported without reloading
+                self.reload()
+            try:
+                self.patch(pib_entry.get('uid', uid), pib_entry['patch'])
+            except KeyError:
+                logging.warning("cannot patch unknown policy %s" % pib_entry.get('uid', uid))
+            except NEATPIBError as e:
+                logging.warning(e)
+            return False
 
         policy = NEATPolicy(pib_entry)
         if uid is not None:
@@ -203,38 +640,80 @@ class PIB(list):
         logging.info("Policy saved as \"%s\"." % filename)
 
         # FIXME register
-        self.reload()
+        self.pending_reload = True
+        if reload:
+            self.reload()
+        return True
+
+    def load_image(self, policies, files):
+        """Restore the policies and the loaded files from a compiled image (see pmimage) and publish them."""
+        self.policies = PolicyStore(policies)
+        self.index = self.policies.index
+        self.files = dict(files)
+        self.pending_reload = False
+        self.publish()
 
     def load_policy(self, filename):
-        """Load policy.
         """
-        if not filename.endswith(self.file_extension) and filename.startswith(('.', '#')):
-            return
-        stat = os.stat(filename)
+        Load a policy file if it is new or its contents changed since it was last loaded.
 
-        t = stat.st_mtime_ns
-        if filename not in self.files or self.files[filename].timestamp != t:
-            logging.info("Loading policy %s...", filename)
-            try:
-                p = load_policy_json(filename)
-            except NEATPIBError as e:
-                logging.error("Unable not load policy %s" % filename)
-                return
+        Unchanged files are detected by their modification time, or by the digest of their contents if only the
+        modification time changed.
+        """
+        if not filename.endswith(self.file_extension) or os.path.basename(filename).startswith(('.', '#')):
+            return
+        try:
+            t = os.stat(filename).st_mtime_ns
+        except OSError as e:
+            logging.error("Unable to load policy %s: %s" % (filename, e))
+            return
 
-            # update filename and timestamp
-            p.filename = filename
-            p.timestamp = t
-            if p:
-                self.register(p)
-        else:
-            pass
+        loaded = self.files.get(filename)
+        if loaded is not None and loaded.mtime == t:
             # logging.debug("Policy %s is up-to-date", filename)
+            return
+
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logging.error("Unable to load policy %s: %s" % (filename, e))
+            return
+
+        digest = hashlib.sha1(data).hexdigest()
+        if loaded is not None and loaded.digest == digest:
+            self.files[filename] = loaded._replace(mtime=t)
+            return
+
+        logging.info("Loading policy %s...", filename)
+        self.checkpoint()
+        try:
+            p = load_policy_json(filename, data)
+        except NEATPIBError as e:
+            logging.error("Unable not load policy %s" % filename)
+            return
+
+        # the file may have defined a policy with a different uid before
+        if loaded is not None and loaded.uid != p.uid:
+            self._unregister_file(filename)
+
+        p.filename = filename
+        self.register(p, publish=False)
+        self.files[filename] = PolicyFile(t, digest, p.uid)
+
+    def _unregister_file(self, filename):
+        """Forget a policy file and unregister its policy unless it was replaced by a policy in another file."""
+        loaded = self.files.pop(filename)
+        policy = self.index.get(loaded.uid)
+        if policy is not None and policy.filename == filename:
+            self.unregister(loaded.uid, publish=False)
 
     def reload(self):
         """
-        Reload PIB files
+        Reload PIB files. Only new, modified and deleted files are processed.
         """
         current_files = set()
+        self.pending_reload = False
 
         for dir_path, dir_names, filenames in os.walk(self.policy_dir):
             for f in filenames:
@@ -247,77 +726,52 @@ class PIB(list):
 
         for f in deleted_files:
             logging.info("Policy file %s has been deleted", f)
-            # unregister policy
-            self.unregister(self.files[f].uid)
+            self._unregister_file(f)
+
+        self.publish()
 
-    def register(self, policy):
+    def register(self, policy, publish=True):
         """Register new policy
 
-        Policies are ordered by their priority attribute
+        Policies are ordered by their priority attribute and uid. A registered policy with the same uid is replaced.
+        If publish is False the policy is not visible to lookups until the next call to publish().
         """
-        # check for existing policies with identical match properties
-        if policy.match in [p.match for p in self.policies]:
-            # logging.debug("Policy match fields for policy %s already registered. " % (policy.uid))
-            pass
+        if self.policies.add(policy) is not None:
+            logging.debug("replaced policy %s" % policy.uid)
 
-        # TODO tie breaker using match_len?
-        uid = bisect.bisect([p.priority for p in self.policies], policy.priority)
-        self.policies.insert(uid, policy)
+        if publish:
+            self.publish()
 
-        # self.policies.sort(key=operator.methodcaller('match_len'))
-        self.index[policy.uid] = policy
-
-    def unregister(self, policy_uid):
-        del self.index[policy_uid]
-
-    def lookup(self, input_properties, apply=True, tag=None):
+    def patch(self, uid, ops):
         """
-        Look through all installed policies to find the ones which match the properties of the given candidate.
-        If apply is True, append the matched policy properties.
+        Apply a JSON patch to the registered policy uid in place and return the patched policy.
 
-        Returns all matched policies.
+        Patches are applied in memory only. The policy is moved if its priority changed.
         """
+        old_policy = self.index[uid]
 
-        assert isinstance(input_properties, PropertyArray)
-        if tag is None:
-            tag = ''
-
-        logging.info("matching policies %s" % tag)
-        candidates = [input_properties]
+        # copy on write, published snapshots keep referencing the unpatched policy
+        policy = copy.copy(old_policy)
+        policy.patch(ops)
 
-        for p in self.policies:
-            if p.match_query(input_properties):
-                tmp_candidates = []
+        self.policies.add(policy)
+        self.publish()
 
-                policy_info = str(p.uid)
-                if hasattr(p, "description"):
-                    policy_info += ' (%s)' % p.description
+        logging.info("Policy %s patched" % uid)
+        return policy
 
-                if apply:
-                    while candidates:
-                        candidate = candidates.pop()
-                        # if replace_matched is true, remove all matched properties from the candidate
-                        if p.replace_matched:
-                            for key in p.match:
-                                del candidate[key]
+    def unregister(self, policy_uid, publish=True):
+        """Remove the policy policy_uid. Raises KeyError if the policy is unknown."""
+        self.policies.remove(policy_uid)
 
-                        for policy_properties in p.properties.expand():
-                            try:
-                                new_candidate = candidate + policy_properties
-                            except ImmutablePropertyError:
-                                logging.info(
-                                    ' ' * 4 + policy_info + PM.STYLES.BOLD_START + ' *REJECTED*' + PM.STYLES.FORMAT_END)
-                                return []
-                            # TODO copy policies from candidate and policy_properties for debugging
-                            #  if hasattr(new_candidate, 'policies'):
-                            #      new_candidate.policies.append(p.uid)
-                            #  else:
-                            #      new_candidate.policies = [p.uid]
-                            tmp_candidates.append(new_candidate)
-                candidates.extend(tmp_candidates)
+        if publish:
+            self.publish()
 
-                logging.info(' ' * 4 + policy_info)
-        return candidates
+    def lookup(self, input_properties, apply=True, tag=None, trace=None):
+        """
+        PIB lookup using the current snapshot.
+        """
+        return self.snapshot.lookup(input_properties, apply=apply, tag=tag, trace=trace)
 
     def dump(self):
         print(term_separator("PIB START"))
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import socket
+import struct
+import time
+from collections import Counter
+
+import pmdefaults as PM
+
+_ucred = struct.Struct('3i')
+
+
+def peer_credentials(transport):
+    """Return the (pid, uid, gid) of the process connected to a Unix domain socket, or None if unavailable."""
+    sock = transport.get_extra_info('socket')
+    if sock is None or not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    try:
+        return _ucred.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _ucred.size))
+    except (OSError, struct.error):
+        return None
+
+
+class TokenBucket(object):
+    """Allow rate requests per second on average and bursts of up to burst requests (unlimited if rate is 0)."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def take(self, now=None):
+        """Take a token if one is available. Returns False if the request exceeds the rate limit."""
+        if not self.rate:
+            return True
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Client(object):
+    """A process sending requests to the PM socket, identified by its user and process id."""
+
+    def __init__(self, credentials, weight, rate, burst):
+        self.pid, self.uid, self.gid = credentials or (None, None, None)
+        self.weight = weight
+        self.bucket = TokenBucket(rate, burst)
+        # number of queued and running requests
+        self.queued = 0
+        self.running = 0
+        # virtual finish time of the last queued request
+        self.finish = 0.0
+        self.stats = Counter()
+
+    @property
+    def idle(self):
+        return not self.queued and not self.running
+
+    def dict(self):
+        d = {'pid': self.pid, 'uid': self.uid, 'weight': self.weight, 'queued': self.queued, 'running': self.running}
+        d.update(self.stats)
+        return d
+
+
+class AdmissionControl(object):
+    """
+    Per-client admission control and fair scheduling of PM requests.
+
+    Each client is limited by a token bucket and by the number of queued requests. Admitted requests are run with at
+    most MAX_CONCURRENT_REQUESTS requests at a time, in the order of their virtual finish times (self-clocked weighted
+    fair queuing): a client sending many requests only delays its own requests, while other clients keep their share
+    weighted by CLIENT_WEIGHTS.
+    """
+
+    # idle clients are forgotten once more clients are tracked
+    MAX_CLIENTS = 1024
+
+    def __init__(self, concurrency=None, rate=None, burst=None, queue_limit=None, weights=None):
+        self.concurrency = concurrency or PM.MAX_CONCURRENT_REQUESTS
+        self.rate = PM.CLIENT_RATE_LIMIT if rate is None else rate
+        self.burst = PM.CLIENT_BURST if burst is None else burst
+        self.queue_limit = PM.CLIENT_QUEUE_LIMIT if queue_limit is None else queue_limit
+        self.weights = PM.CLIENT_WEIGHTS if weights is None else weights
+
+        self.clients = {}
+        # (virtual finish time, sequence number, client, coroutine function, enqueue time)
+        self.queue = []
+        self.seq = itertools.count()
+        self.virtual_time = 0.0
+        self.running = 0
+        self.stats = Counter()
+
+    def client(self, credentials):
+        key = (credentials[1], credentials[0]) if credentials else None
+        client = self.clients.get(key)
+        if client is None:
+            if len(self.clients) >= self.MAX_CLIENTS:
+                for k in [k for k, c in self.clients.items() if c.idle]:
+                    del self.clients[k]
+            uid = credentials[1] if credentials else None
+            client = Client(credentials, self.weights.get(uid, 1), self.rate, self.burst)
+            self.clients[key] = client
+        return client
+
+    def admit(self, credentials, func):
+        """
+        Schedule the coroutine function func for the client with the given credentials. Returns False if the request
+        was rejected because the client exceeded its rate limit or its queue is full.
+        """
+        client = self.client(credentials)
+        client.stats['requests'] += 1
+
+        if not client.bucket.take():
+            reason = 'rate_limited'
+        elif client.queued >= self.queue_limit:
+            reason = 'queue_full'
+        else:
+            finish = max(self.virtual_time, client.finish) + 1.0 / client.weight
+            client.finish = finish
+            client.queued += 1
+            heapq.heappush(self.queue, (finish, next(self.seq), client, func, time.monotonic()))
+            self.stats['admitted'] += 1
+            self._dispatch()
+            self.stats['depth'] = len(self.queue)
+            return True
+
+        client.stats[reason] += 1
+        self.stats[reason] += 1
+        logging.info("request of client uid %s pid %s rejected: %s" % (client.uid, client.pid, reason))
+        return False
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self.queue:
+            finish, _, client, func, queued = heapq.heappop(self.queue)
+            self.virtual_time = finish
+            client.queued -= 1
+            client.running += 1
+            self.running += 1
+
+            wait = time.monotonic() - queued
+            self.stats['wait_ms'] += round(wait * 1000)
+            self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], round(wait * 1000))
+
+            task = asyncio.ensure_future(func())
+            task.add_done_callback(lambda t, client=client: self._done(client))
+
+    def _done(self, client):
+        client.running -= 1
+        client.stats['completed'] += 1
+        self.running -= 1
+        self.stats['completed'] += 1
+        self._dispatch()
+        self.stats['depth'] = len(self.queue)
+
+    def dict(self):
+        """Return the state and counters of all tracked clients."""
+        return {'%s:%s' % (c.uid, c.pid): c.dict() for c in self.clients.values()}
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+import pmdefaults as PM
+
+
+def canonical_request(json_str):
+    """Return a canonical string for a JSON request, or None if the request is not valid JSON."""
+    try:
+        return json.dumps(json.loads(json_str), sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return None
+
+
+class NegativeCache(object):
+    """
+    Remember requests which did not yield any candidates.
+
+    Entries are keyed by the canonical request and are only valid for the profile, CIB and PIB snapshot generations
+    they were computed with, i.e., an entry is dropped with the next profile/CIB/PIB update. The least recently used
+    entries are evicted once the cache holds more than size entries.
+    """
+
+    def __init__(self, size=None):
+        self.size = PM.NEGATIVE_CACHE_SIZE if size is None else size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def get(self, key, generations):
+        """Return True if the request is known to yield no candidates for the given snapshot generations."""
+        if key is None or not self.size:
+            return False
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return False
+            if entry[0] != generations:
+                del self.entries[key]
+                self.stats['misses'] += 1
+                self.stats['invalidated'] += 1
+                return False
+
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            # processing time which was saved by the cache
+            self.stats['avoided_seconds'] += entry[1]
+            return True
+
+    def add(self, key, generations, duration=0.0):
+        """Store a request which did not yield any candidates. duration is the time spent processing it."""
+        if key is None or not self.size:
+            return
+
+        with self.lock:
+            self.entries[key] = (generations, duration)
+            self.entries.move_to_end(key)
+            self.stats['stored'] += 1
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats['evicted'] += 1
+        logging.debug("negative cache: stored request (%d entries)" % len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent identical requests.
+
+    The first request for a key runs func in the default executor, requests for the same key arriving before it has
+    completed wait for the same future and share its result. The deadlines of coalesced requests are merged into the
+    deadline of the first request. If submit is given, submit(func, *args) is used to run func instead, which
+    returns a future.
+    """
+
+    def __init__(self, submit=None):
+        self.submit = submit
+        self.pending = {}
+        self.deadlines = {}
+        self.stats = Counter()
+
+    def run(self, key, func, *args, deadline=None):
+        """Run func(*args) in the executor unless a call for key is in flight. Returns a future for the result."""
+        if key is None:
+            self.stats['computed'] += 1
+            return self._submit(func, *args)
+
+        future = self.pending.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            if deadline is not None and self.deadlines.get(key) is not None:
+                self.deadlines[key].share(deadline)
+            return future
+
+        future = self._submit(func, *args)
+        self.pending[key] = future
+        self.deadlines[key] = deadline
+        self.stats['computed'] += 1
+        future.add_done_callback(lambda f: self._done(key))
+        return future
+
+    def _submit(self, func, *args):
+        if self.submit is not None:
+            return self.submit(func, *args)
+        return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def _done(self, key):
+        self.pending.pop(key, None)
+        self.deadlines.pop(key, None)
@@ -0,0 +1,48 @@
+import json
+import logging
+import time
+
+
+class Capture(object):
+    """
+    Record messages received on the PM, CIB and PIB sockets.
+
+    Each message is appended to the capture file as a JSON line of the form
+
+        {"t": <UNIX timestamp>, "socket": "pm"|"cib"|"pib", "data": <message>}
+
+    Capture files can be replayed against a running PM using pmreplay.py.
+    """
+
+    SOCKETS = ('pm', 'cib', 'pib')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'a', encoding='utf-8')
+        self.count = 0
+        logging.info("capturing socket messages to %s" % filename)
+
+    def record(self, socket, data):
+        assert socket in self.SOCKETS
+        self.file.write(json.dumps({'t': time.time(), 'socket': socket, 'data': data}) + '\n')
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        logging.info("captured %d messages to %s" % (self.count, self.filename))
+
+
+def read_capture(filename):
+    """Return the (timestamp, socket, data) tuples of all messages in a capture file."""
+    messages = []
+    with open(filename, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                m = json.loads(line)
+                messages.append((float(m['t']), m['socket'], m['data']))
+            except (ValueError, KeyError, TypeError):
+                logging.warning("skipping invalid capture line %d" % n)
+    return messages
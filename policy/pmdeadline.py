@@ -0,0 +1,75 @@
+import select
+import time
+
+import pmdefaults as PM
+
+TIMEOUT_HEADER = 'timeout'
+
+
+def peer_closed(sock):
+    """
+    Return True if the peer of a Unix domain socket closed the connection. A peer which only shut down writing, as
+    NEAT does after sending its request, is still connected.
+    """
+    try:
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return any(events & (select.POLLHUP | select.POLLERR | select.POLLNVAL) for _, events in poller.poll(0))
+    except (OSError, ValueError):
+        return True
+
+
+def request_budget(headers):
+    """Return the time budget in seconds requested using a 'timeout: <ms>' header line, or the default budget."""
+    try:
+        return max(float(headers[TIMEOUT_HEADER]) / 1000, 0.0)
+    except (KeyError, ValueError):
+        return PM.REQUEST_TIMEOUT
+
+
+class Deadline(object):
+    """
+    Time budget of a PM socket request.
+
+    The budget starts when the client connects. Processing stages call expired() before each unit of work and stop
+    early once the budget of every client waiting for the result has run out, or all of these clients have closed
+    their connections. The stage at which processing was stopped is stored in truncated.
+    """
+
+    def __init__(self, budget=None, start=None, sock=None):
+        start = time.monotonic() if start is None else start
+        self.expires = start + (PM.REQUEST_TIMEOUT if budget is None else budget)
+        self.sock = sock
+        # deadlines of the requests waiting for the result computed under this deadline
+        self.waiters = [self]
+        self.truncated = None
+        # deadline of the request whose result is shared with this request
+        self.leader = self
+
+    def share(self, other):
+        """
+        Share the result computed under this deadline with the request of the other deadline. Processing continues
+        until the later of both deadlines, clients which gave up waiting earlier are detected using closed().
+        """
+        other.leader = self
+        self.expires = max(self.expires, other.expires)
+        self.waiters.append(other)
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def closed(self):
+        """Return True if the client of this request has closed its connection."""
+        return self.sock is not None and peer_closed(self.sock)
+
+    def disconnected(self):
+        """Return True if all clients waiting for the result have closed their connections."""
+        return all(w.sock is not None for w in self.waiters) and all(w.closed() for w in self.waiters)
+
+    def expired(self, stage=None):
+        """Return True if processing should stop. If stage is given, it is recorded as the truncated stage."""
+        if self.remaining() > 0 and not self.disconnected():
+            return False
+        if stage is not None and self.truncated is None:
+            self.truncated = stage
+        return True
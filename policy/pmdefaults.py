@@ -17,13 +17,56 @@ CLIENT_UID = str(uuid.uuid3(uuid.NAMESPACE_OID, str(uuid.getnode())))
 
 # CIB expiration time in seconds
 CIB_DEFAULT_TIMEOUT = 10 * 60
+# maximum number of paths and rows expanded for each CIB root node
+CIB_MAX_PATHS = 1000
+CIB_MAX_ROWS = 10000
+# address properties which may hold address prefixes (e.g. 10.1.0.0/16) and are indexed using radix trees
+ADDRESS_PROPERTIES = ('remote_ip', 'local_ip')
+# properties used to partition CIB rows into shards, rows are partitioned by the first one
+CIB_SHARD_KEYS = ('interface', 'local_ip')
+# maximum number of candidates kept by PIB lookups, candidates with the lowest scores are dropped (no limit if 0)
+PIB_MAX_CANDIDATES = 100
+
+# maximum number of cached requests which did not yield any candidates (disabled if 0)
+NEGATIVE_CACHE_SIZE = 1000
 
 PIB_SOCK = os.environ['HOME'] + '/.neat/neat_pib_socket'
 CIB_SOCK = os.environ['HOME'] + '/.neat/neat_cib_socket'
 DOMAIN_SOCK = os.environ['HOME'] + '/.neat/neat_pm_socket'
 
+# output directory, default duration in seconds and sampling interval of the live profiler
+PROFILE_DIR = os.environ['HOME'] + '/.neat/profiles'
+PROFILE_SECONDS = 30
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# fraction of requests which are traced and number of request traces kept in memory
+TRACE_SAMPLE_RATE = 0.01
+TRACE_BUFFER_SIZE = 100
+
+# admission control on the PM socket: requests per second and burst size allowed for each client process (no limit
+# if the rate is 0), maximum number of queued requests per client and number of requests processed concurrently
+CLIENT_RATE_LIMIT = 100
+CLIENT_BURST = 200
+CLIENT_QUEUE_LIMIT = 64
+MAX_CONCURRENT_REQUESTS = 8
+# weights used to share the PM between the clients of different user ids, clients of other users have weight 1
+CLIENT_WEIGHTS = {}
+
+# maximum total time in seconds a batch of CIB/PIB ingest work waits for running lookups
+INGEST_MAX_YIELD = 0.1
+
+# time budget in seconds of PM socket requests, counted from the connection of the client. NEAT gives up waiting for
+# the PM after 3s (on_pm_timeout in neat_pm_socket.c), the remaining time is left for sending the reply. Clients may
+# request a different budget using a 'timeout: <ms>' header line.
+REQUEST_TIMEOUT = 2.5
+
+# answer requests using the partially loaded CIB/PIB while the PM is starting up, otherwise close the connection
+STARTUP_PARTIAL_REPLIES = True
+
 PIB_DIR = 'pib/example/'
 CIB_DIR = 'cib/example/'
+# compiled CIB/PIB image shared by all PM processes on a host (disabled if None), see pmimage.py
+IMAGE_FILE = None
 
 # default policy property attributes
 DEFAULT_SCORE = 0.0
@@ -40,6 +83,13 @@ CONTROLLER_REST = 'http://httpbin.org/post'
 CONTROLLER_USER = 'admin'
 CONTROLLER_PASS = 'admin'
 CONTROLLER_ANNOUNCE = 3 * 60
+# maximum number of concurrent connections to the controller
+CONTROLLER_MAX_CONNECTIONS = 4
+# controller URL from which CIB updates are pulled (disabled if None)
+CONTROLLER_CIB_FEED = None
+# CIB feed polling interval in seconds, doubled after each failed poll up to the maximum interval
+CONTROLLER_FEED_INTERVAL = 10
+CONTROLLER_FEED_MAX_INTERVAL = 5 * 60
 
 
 class STYLES(object):
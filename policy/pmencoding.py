@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Compact binary encoding of PM replies.
+
+A client requests the binary encoding by sending the line
+
+    encoding: neatbin1
+
+before its JSON request. Replies to other requests, and to requests for unknown encodings, are JSON encoded. Other
+header lines of the form 'name: value' may precede the JSON request as well.
+
+A binary reply starts with the magic bytes NPM1, followed by a table of interned strings and the candidates:
+
+    reply      := "NPM1" strings candidates
+    strings    := uint(n) (uint(length) utf-8 bytes){n}
+    candidates := uint(n) (uint(m) property{m}){n}
+    property   := uint(key string index) flags [float64 score] value
+    flags      := precedence (bits 0-1) | evaluated (bit 2) | score present (bit 3)
+    value      := 0x00 null | 0x01 false | 0x02 true | 0x03 sint | 0x04 float64 | 0x05 uint(string index)
+                | 0x06 value value (range start and end) | 0x07 uint(n) value{n} (set)
+
+uint is an unsigned LEB128 varint, sint a zigzag encoded varint, float64 is little-endian. Property keys and string
+values are interned, i.e., each distinct string is sent once per reply. Attributes are omitted exactly where the JSON
+encoding omits them.
+
+Run this module to compare the cost of both encodings.
+"""
+import argparse
+import json
+import struct
+import timeit
+
+import policy
+from pmdefaults import DEFAULT_PRECEDENCE, DEFAULT_SCORE, DEFAULT_EVALUATED
+
+ENCODING_HEADER = 'encoding'
+BINARY_ENCODING = 'neatbin1'
+MAGIC = b'NPM1'
+
+NULL, FALSE, TRUE, INT, FLOAT, STRING, RANGE, SET = range(8)
+SCORE_FLAG = 0x08
+EVALUATED_FLAG = 0x04
+
+_float = struct.Struct('<d')
+
+
+class EncodingError(Exception):
+    pass
+
+
+def split_headers(request):
+    """
+    Split a request into the header lines preceding the JSON request, as a dict of lowercase names and values, and
+    the JSON request.
+    """
+    headers = {}
+    while request and request[0] not in '{[' and ':' in request.partition('\n')[0]:
+        header, _, request = request.partition('\n')
+        name, _, value = header.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers, request
+
+
+def split_encoding(request):
+    """Split a request into the requested reply encoding ('json' if none was requested) and the JSON request."""
+    headers, json_str = split_headers(request)
+    return headers.get(ENCODING_HEADER, 'json').lower(), json_str
+
+
+def _uint(out, n):
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+class BinaryEncoder(object):
+    """Encoder of a single reply, interning strings as they are encountered."""
+
+    def __init__(self):
+        self.strings = {}
+        self.body = bytearray()
+
+    def intern(self, s):
+        try:
+            return self.strings[s]
+        except KeyError:
+            n = self.strings[s] = len(self.strings)
+            return n
+
+    def value(self, v):
+        out = self.body
+        if v is None:
+            out.append(NULL)
+        elif v is True:
+            out.append(TRUE)
+        elif v is False:
+            out.append(FALSE)
+        elif isinstance(v, int):
+            out.append(INT)
+            _uint(out, v << 1 if v >= 0 else (-v << 1) - 1)
+        elif isinstance(v, float):
+            out.append(FLOAT)
+            out += _float.pack(v)
+        elif isinstance(v, str):
+            out.append(STRING)
+            _uint(out, self.intern(v))
+        elif isinstance(v, tuple):
+            out.append(RANGE)
+            self.value(v[0])
+            self.value(v[1])
+        elif isinstance(v, (set, list)):
+            out.append(SET)
+            _uint(out, len(v))
+            for i in v:
+                self.value(i)
+        else:
+            raise EncodingError("cannot encode %s" % type(v))
+
+    def candidate(self, candidate):
+        out = self.body
+        _uint(out, len(candidate))
+        for p in candidate.values():
+            _uint(out, self.intern(p.key))
+            flags = p.precedence
+            if not 0 <= flags <= 3:
+                raise EncodingError("cannot encode precedence %s" % flags)
+            if p.evaluated != DEFAULT_EVALUATED:
+                flags |= EVALUATED_FLAG
+            if p.score != DEFAULT_SCORE:
+                out.append(flags | SCORE_FLAG)
+                out += _float.pack(p.score)
+            else:
+                out.append(flags)
+            self.value(p.value)
+
+    def reply(self, candidates):
+        _uint(self.body, len(candidates))
+        for c in candidates:
+            self.candidate(c)
+
+        out = bytearray(MAGIC)
+        _uint(out, len(self.strings))
+        for s in self.strings:
+            data = s.encode('utf-8')
+            _uint(out, len(data))
+            out += data
+        return bytes(out + self.body)
+
+
+def encode_binary(candidates):
+    """Encode a list of candidate PropertyArrays as a binary reply."""
+    return BinaryEncoder().reply(candidates)
+
+
+def encode_json(candidates):
+    """Encode a list of candidate PropertyArrays as a JSON reply, as expected by the NEAT library."""
+    return ('[' + ', '.join(policy.properties_to_json(c) for c in candidates) + ']\n').encode('utf-8')
+
+
+def encode_reply(candidates, encoding='json'):
+    if encoding == BINARY_ENCODING:
+        return encode_binary(candidates)
+    return encode_json(candidates)
+
+
+class BinaryDecoder(object):
+    """Reference decoder returning the same list of property dicts as json.loads() of the JSON reply."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.strings = []
+
+    def uint(self):
+        n = shift = 0
+        while True:
+            b = self.data[self.pos]
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def float(self):
+        v = _float.unpack_from(self.data, self.pos)[0]
+        self.pos += 8
+        return v
+
+    def value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == NULL:
+            return None
+        if tag == FALSE:
+            return False
+        if tag == TRUE:
+            return True
+        if tag == INT:
+            n = self.uint()
+            return n >> 1 if not n & 1 else -((n + 1) >> 1)
+        if tag == FLOAT:
+            return self.float()
+        if tag == STRING:
+            return self.strings[self.uint()]
+        if tag == RANGE:
+            return {'start': self.value(), 'end': self.value()}
+        if tag == SET:
+            return [self.value() for _ in range(self.uint())]
+        raise EncodingError("invalid value tag %d" % tag)
+
+    def reply(self):
+        if self.data[:4] != MAGIC:
+            raise EncodingError("not a binary PM reply")
+        self.pos = 4
+        for _ in range(self.uint()):
+            length = self.uint()
+            self.strings.append(self.data[self.pos:self.pos + length].tobytes().decode('utf-8'))
+            self.pos += length
+
+        candidates = []
+        for _ in range(self.uint()):
+            candidate = {}
+            for _ in range(self.uint()):
+                key = self.strings[self.uint()]
+                flags = self.data[self.pos]
+                self.pos += 1
+                d = {}
+                if flags & SCORE_FLAG:
+                    d['score'] = self.float()
+                d['value'] = self.value()
+                precedence = flags & 0x03
+                if precedence != DEFAULT_PRECEDENCE:
+                    d['precedence'] = precedence
+                if flags & EVALUATED_FLAG:
+                    d['evaluated'] = not DEFAULT_EVALUATED
+                candidate[key] = d
+            candidates.append(candidate)
+        return candidates
+
+
+def decode_binary(data):
+    try:
+        return BinaryDecoder(data).reply()
+    except (IndexError, UnicodeDecodeError, struct.error) as e:
+        raise EncodingError("truncated or invalid binary reply") from e
+
+
+def benchmark(candidates, number=200):
+    """Return the sizes and the encode/decode times per reply in ms of both encodings."""
+    results = {}
+    for name, encode, decode in (('json', encode_json, json.loads), ('binary', encode_binary, decode_binary)):
+        data = encode(candidates)
+        results[name] = {
+            'bytes': len(data),
+            'encode_ms': timeit.timeit(lambda: encode(candidates), number=number) / number * 1000,
+            'decode_ms': timeit.timeit(lambda: decode(data), number=number) / number * 1000,
+        }
+    return results
+
+
+def synthetic_candidates(count, addresses=4):
+    """Return count candidates resembling post-resolve PM replies, with one candidate per resolved address."""
+    candidates = []
+    for n in range(count):
+        c = policy.PropertyArray()
+        c.add(*policy.dict_to_properties({
+            'interface': {'value': 'eth%d' % (n % 2), 'precedence': 2, 'score': 1.0},
+            'local_ip': {'value': '10.0.%d.1' % (n % 2), 'precedence': 2},
+            'remote_ip': {'value': '203.0.113.%d' % (n % addresses), 'precedence': 2},
+            'transport': {'value': ['TCP', 'SCTP'][n % 2], 'precedence': 2, 'score': 2.0},
+            'port': {'value': 443, 'precedence': 2},
+            'MTU': {'value': {'start': 1500, 'end': 9000}},
+            'RTT': {'value': {'start': 0, 'end': 50}, 'score': 5},
+            'low_latency': {'value': True},
+            'capacity': {'value': 10000.0 + n},
+            'is_wired': {'value': bool(n % 2)},
+            'domain_name': {'value': 'www.example.org', 'precedence': 2},
+        }))
+        candidates.append(c)
+    return candidates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the JSON and binary PM reply encodings')
+    parser.add_argument('--candidates', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='number of candidates per reply')
+    parser.add_argument('--number', type=int, default=200, help='number of timed repetitions')
+    args = parser.parse_args()
+
+    print('%10s %-7s %9s %10s %10s' % ('candidates', 'format', 'bytes', 'encode ms', 'decode ms'))
+    for count in args.candidates:
+        results = benchmark(synthetic_candidates(count), number=max(args.number // count, 3))
+        for name, r in results.items():
+            print('%10d %-7s %9d %10.3f %10.3f' % (count, name, r['bytes'], r['encode_ms'], r['decode_ms']))
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+import pmdefaults as PM
+from cib import CIB
+from pib import NEATPolicy, PolicyFile
+from policy import NEATProperty, PropertyArray, PropertyMultiArray
+
+MAGIC = b'NEATIMG2'
+VERSION = 2
+# settings affecting the compiled CIB rows and property attributes, images compiled using other settings are ignored
+CONFIG = ('CIB_MAX_PATHS', 'CIB_MAX_ROWS', 'CIB_DEFAULT_TIMEOUT', 'DEFAULT_SCORE', 'DEFAULT_PRECEDENCE',
+          'DEFAULT_EVALUATED')
+# magic and length of the JSON header
+PREFIX = struct.Struct('<8sQ')
+
+
+class ImageError(Exception):
+    pass
+
+
+def source_files(directory, extensions):
+    """Return the modification times of all files with the given extensions below directory, by full filename."""
+    files = {}
+    for dir_path, dir_names, filenames in os.walk(directory):
+        for f in filenames:
+            if f.endswith(extensions) and not f.startswith(('.', '#')):
+                full_name = os.path.join(dir_path, f)
+                files[full_name] = os.stat(full_name).st_mtime_ns
+    return files
+
+
+def encode_value(value):
+    if isinstance(value, tuple):
+        return {'start': value[0], 'end': value[1]}
+    if isinstance(value, set):
+        return list(value)
+    return value
+
+
+def property_to_record(p):
+    """Encode a NEATProperty, including all attributes, as a JSON serializable list"""
+    return [p.key, encode_value(p.value), p.precedence, p.score, p.evaluated, [encode_value(b.value) for b in p.banned]]
+
+
+def record_to_property(record):
+    key, value, precedence, score, evaluated, banned = record
+    p = NEATProperty((key, value), precedence=precedence, score=score, banned=banned)
+    p.evaluated = evaluated
+    return p
+
+
+def row_to_record(row):
+    return {'cib_node': getattr(row, 'cib_node', None), 'meta': row.meta,
+            'properties': [property_to_record(p) for p in row.values()]}
+
+
+def record_to_row(record):
+    row = PropertyArray()
+    for r in record['properties']:
+        p = record_to_property(r)
+        row[p.key] = p
+    row.cib_node = record['cib_node']
+    row.meta.update(record['meta'])
+    return row
+
+
+def policy_to_record(policy):
+    attributes = {k: v for k, v in vars(policy).items() if isinstance(v, str)}
+    attributes.update(priority=policy.priority, replace_matched=policy.replace_matched)
+    return {'attributes': attributes, 'match': [property_to_record(p) for p in policy.match.values()],
+            'properties': [property_to_record(p) for ps in policy.properties.values() for p in ps]}
+
+
+def record_to_policy(record):
+    policy = NEATPolicy(record['attributes'])
+    policy.filename = record['attributes'].get('filename')
+    policy.match = PropertyArray(*(record_to_property(r) for r in record['match']))
+    policy.properties = PropertyMultiArray(*(record_to_property(r) for r in record['properties']))
+    policy.expansions = tuple(policy.properties.expand())
+    return policy
+
+
+def code_digest():
+    """Return a digest of the modules which compile and restore images, images of other code versions are ignored."""
+    digest = hashlib.sha1()
+    for name in ('cib', 'pib', 'policy', __name__):
+        with open(sys.modules[name].__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def image_config():
+    """Return the configuration the image contents depend on."""
+    config = {k: getattr(PM, k) for k in CONFIG}
+    config['code'] = code_digest()
+    return config
+
+
+class Image(object):
+    """
+    Compiled image of the CIB nodes and expanded CIB rows, the PIB policies and the profiles.
+
+    The image file consists of the magic bytes, the length of a JSON header and the header itself, followed by the
+    sections. Each section is a compact JSON list of records. Only the header is read when an image is opened, the
+    sections are read and decoded when the CIB and PIB are restored.
+    """
+
+    SECTIONS = ('cib_nodes', 'cib_rows', 'pib', 'profiles')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            magic, length = PREFIX.unpack(self.file.read(PREFIX.size))
+            if magic != MAGIC:
+                raise ImageError("%s is not a PM image" % filename)
+            self.header = json.loads(self.file.read(length).decode('utf-8'))
+            if self.header.get('version') != VERSION:
+                raise ImageError("incompatible image %s" % filename)
+            self.sections = {name: (offset, size) for name, (offset, size) in self.header['sections'].items()}
+        except (struct.error, ValueError, KeyError, TypeError) as e:
+            self.close()
+            raise ImageError("invalid image %s: %s" % (filename, e)) from e
+        except ImageError:
+            self.close()
+            raise
+
+    def is_current(self, cib_dir, pib_dir):
+        """
+        Return True if the image was compiled by the same code using the same configuration, and no source CIB or PIB
+        file was added, modified or removed since.
+        """
+        return (self.header.get('config') == image_config() and
+                self.header['sources']['cib'] == source_files(cib_dir, CIB.CIB_EXTENSIONS) and
+                self.header['sources']['pib'] == source_files(pib_dir, ('.policy', '.profile')))
+
+    def records(self, name):
+        offset, size = self.sections[name]
+        # sections are read concurrently by the CIB and PIB update threads
+        data = os.pread(self.file.fileno(), size, offset)
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            raise ImageError("invalid section %s in image %s" % (name, self.filename)) from e
+
+    def cib_state(self):
+        """Return the CIB nodes, files and expanded rows stored in the image."""
+        return (self.records('cib_nodes'), dict(self.header['files']['cib']),
+                [record_to_row(r) for r in self.records('cib_rows')])
+
+    def pib_state(self, name):
+        """Return the policies and files of the PIB name ('pib' or 'profiles') stored in the image."""
+        policies = [record_to_policy(r) for r in self.records(name)]
+        files = {f: PolicyFile(*v) for f, v in self.header['files'][name].items()}
+        return policies, files
+
+    def close(self):
+        self.file.close()
+
+
+def open_image(filename, cib_dir, pib_dir):
+    """Return the image stored in filename, or None if it does not exist, is invalid or is out of date."""
+    if not os.path.exists(filename):
+        return None
+    try:
+        image = Image(filename)
+    except (ImageError, OSError) as e:
+        logging.warning("ignoring PM image: %s" % e)
+        return None
+    if not image.is_current(cib_dir, pib_dir):
+        logging.info("PM image %s is out of date" % filename)
+        image.close()
+        return None
+    return image
+
+
+def loaded_sources(directory, extensions, loaded):
+    """
+    Return the modification times of the source files, using the times of the loaded versions of the files given in
+    loaded, so that files modified since they were loaded make the image out of date.
+    """
+    sources = source_files(directory, extensions)
+    sources.update((f, t) for f, t in loaded.items() if f in sources)
+    return sources
+
+
+def cib_image_state(cib):
+    """Return the records, files and source files of the published CIB snapshot. Runs on the CIB update thread."""
+    snapshot = cib.snapshot
+    records = {'cib_nodes': [n.dict() for n in snapshot.nodes.values()],
+               'cib_rows': [row_to_record(r) for r in snapshot.rows]}
+    files = {'cib': dict(cib.files)}
+    return records, files, {'cib': loaded_sources(cib.cib_dir, CIB.CIB_EXTENSIONS, files['cib'])}
+
+
+def pib_image_state(pib, profiles):
+    """
+    Return the records, files and source files of the published PIB and profiles snapshots. Runs on the PIB update
+    thread.
+    """
+    records = {'pib': [policy_to_record(p) for p in pib.snapshot.policies],
+               'profiles': [policy_to_record(p) for p in profiles.snapshot.policies]}
+    files = {'pib': {f: list(v) for f, v in pib.files.items()},
+             'profiles': {f: list(v) for f, v in profiles.files.items()}}
+    loaded = {f: v.mtime for p in (pib, profiles) for f, v in p.files.items()}
+    return records, files, {'pib': loaded_sources(pib.policy_dir, ('.policy', '.profile'), loaded)}
+
+
+def write_image(filename, *states):
+    """
+    Compile the CIB and PIB states returned by cib_image_state() and pib_image_state() into an image. The image is
+    written to a temporary file which atomically replaces filename, so that processes reading the previous image are
+    not affected.
+    """
+    records, files, sources = {}, {}, {}
+    for state_records, state_files, state_sources in states:
+        records.update(state_records)
+        files.update(state_files)
+        sources.update(state_sources)
+
+    sections = {name: json.dumps(records[name], separators=(',', ':')).encode('utf-8') for name in Image.SECTIONS}
+    header = {'version': VERSION, 'created': time.time(), 'config': image_config(), 'sources': sources,
+              'files': files, 'sections': {}}
+    # the header is padded to a fixed width, the section offsets depend on the width
+    width = 20
+    while True:
+        offset = PREFIX.size + width
+        for name, data in sections.items():
+            header['sections'][name] = [offset, len(data)]
+            offset += len(data)
+        header_data = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        if len(header_data) <= width:
+            break
+        width = len(header_data)
+
+    tmp_name = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, width))
+        f.write(header_data.ljust(width))
+        for data in sections.values():
+            f.write(data)
+    os.replace(tmp_name, filename)
+    logging.info("PM image written to %s (%d CIB rows, %d policies, %d profiles)" % (
+        filename, len(records['cib_rows']), len(records['pib']), len(records['profiles'])))
@@ -0,0 +1,104 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import Counter
+
+import pmdefaults as PM
+
+
+class Lanes(object):
+    """
+    Scheduling lanes giving PM lookups priority over bulk CIB/PIB ingest.
+
+    Lookups run in the lookup lane through lookup(). Ingest work (file loading, row expansion) runs on the update
+    threads in batches wrapped by ingest() and calls checkpoint() before each chunk of real work. A checkpoint blocks
+    while lookups are running and releases the interpreter lock to the lookup threads. All checkpoints of a batch wait
+    for at most INGEST_MAX_YIELD seconds in total, so that ingest is never starved.
+
+    Lookups submitted to the executor using submit() are counted as queued until they start. The queue of the ingest
+    lane is counted by the updaters (see pmupdate.Updater).
+    """
+
+    def __init__(self, max_yield=None):
+        self.max_yield = PM.INGEST_MAX_YIELD if max_yield is None else max_yield
+        self.condition = threading.Condition()
+        self.active = 0
+        # lookups submitted to the executor which have not started yet
+        self.queued = 0
+        # remaining yield time of the ingest batch running on the current thread
+        self.local = threading.local()
+        self.stats = Counter()
+
+    def lookup(self, func):
+        """Return a version of func which runs in the lookup lane."""
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            with self.condition:
+                self.active += 1
+                self.stats['lookups'] += 1
+                self.stats['max_active_lookups'] = max(self.stats['max_active_lookups'], self.active)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    if not self.active:
+                        self.condition.notify_all()
+        return run
+
+    def submit(self, func, *args):
+        """Run func(*args) in the default executor, counting the lookup queue depth and wait. Returns a future."""
+        with self.condition:
+            self.queued += 1
+            self.stats['lookup_depth'] = self.queued
+            self.stats['lookup_max_depth'] = max(self.stats['lookup_max_depth'], self.queued)
+        return asyncio.get_event_loop().run_in_executor(None, self._dequeue, time.perf_counter(), func, *args)
+
+    def _dequeue(self, submitted, func, *args):
+        """Run a submitted lookup on an executor thread, recording the time it waited for the thread."""
+        wait = round((time.perf_counter() - submitted) * 1000, 3)
+        with self.condition:
+            self.queued -= 1
+            self.stats['lookup_depth'] = self.queued
+            self.stats['lookup_wait_ms'] += wait
+            self.stats['lookup_max_wait_ms'] = max(self.stats['lookup_max_wait_ms'], wait)
+        return func(*args)
+
+    def ingest(self, func):
+        """Return a version of func which runs as one batch of ingest work."""
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            self.local.budget = self.max_yield
+            try:
+                return func(*args, **kwargs)
+            finally:
+                del self.local.budget
+        return run
+
+    def checkpoint(self):
+        """
+        Called by ingest work before each chunk. Waits until no lookups are running, or until the yield time of the
+        current batch (max_yield outside of batches) is used up.
+        """
+        if threading.current_thread() is threading.main_thread():
+            # never block the asyncio loop
+            return
+        budget = getattr(self.local, 'budget', self.max_yield)
+        with self.condition:
+            self.stats['ingest_chunks'] += 1
+            if not self.active:
+                return
+            if budget <= 0:
+                self.stats['ingest_budget_exhausted'] += 1
+                return
+            start = time.perf_counter()
+            self.condition.wait_for(lambda: not self.active, timeout=budget)
+
+            elapsed = time.perf_counter() - start
+            if hasattr(self.local, 'budget'):
+                self.local.budget -= elapsed
+            wait = round(elapsed * 1000, 3)
+            self.stats['ingest_yields'] += 1
+            self.stats['ingest_wait_ms'] += wait
+            self.stats['ingest_max_wait_ms'] = max(self.stats['ingest_max_wait_ms'], wait)
@@ -0,0 +1,125 @@
+import functools
+import ipaddress
+
+
+@functools.lru_cache(maxsize=4096)
+def ip_prefix(value):
+    """
+    Return value as an IPv4/IPv6 network if it is an address (10.1.2.3) or an address prefix (10.1.0.0/16).
+    Returns None for all other values.
+    """
+    if not isinstance(value, str) or not ('.' in value or ':' in value):
+        return None
+    try:
+        return ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        return None
+
+
+def prefix_contains(outer, inner):
+    """Return True if the network inner is equal to or a subnet of the network outer."""
+    if outer.version != inner.version or outer.prefixlen > inner.prefixlen:
+        return False
+    shift = outer.max_prefixlen - outer.prefixlen
+    return int(outer.network_address) >> shift == int(inner.network_address) >> shift
+
+
+class PrefixTree(object):
+    """
+    Binary radix tree mapping IPv4/IPv6 prefixes to sets of items.
+
+    Lookups walk at most one node per address bit, i.e., they are independent of the number of stored prefixes.
+    """
+
+    def __init__(self):
+        # nodes are [zero child, one child, items] lists, one tree per IP version
+        self.roots = {4: [None, None, set()], 6: [None, None, set()]}
+        self.size = 0
+
+    @staticmethod
+    def _bits(network):
+        address = int(network.network_address)
+        for i in range(network.max_prefixlen - 1, network.max_prefixlen - 1 - network.prefixlen, -1):
+            yield (address >> i) & 1
+
+    def add(self, network, item):
+        node = self.roots[network.version]
+        for bit in self._bits(network):
+            if node[bit] is None:
+                node[bit] = [None, None, set()]
+            node = node[bit]
+        node[2].add(item)
+        self.size += 1
+
+    def matches(self, network):
+        """Return the items of all prefixes containing network."""
+        node = self.roots[network.version]
+        found = set(node[2])
+        for bit in self._bits(network):
+            node = node[bit]
+            if node is None:
+                break
+            found.update(node[2])
+        return found
+
+    def overlapping(self, network):
+        """Return the items of all prefixes containing network or contained in network."""
+        node = self.roots[network.version]
+        found = set(node[2])
+        for bit in self._bits(network):
+            node = node[bit]
+            if node is None:
+                return found
+            found.update(node[2])
+
+        # add all more specific prefixes
+        stack = [node[0], node[1]]
+        while stack:
+            node = stack.pop()
+            if node is not None:
+                found.update(node[2])
+                stack.extend(node[:2])
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+class AddressIndex(object):
+    """
+    Index of property array positions by the address or address prefix value of one property.
+
+    select() returns the positions of all arrays whose value may overlap with a given address or prefix, in
+    O(address bits) using a radix tree.
+    """
+
+    def __init__(self, key, immutable=False):
+        self.key = key
+        # index only immutable values, as an immutable property of a lookup overrides other values
+        self.immutable = immutable
+        self.tree = PrefixTree()
+        # positions of arrays whose value is not an indexed address, e.g., a set of addresses or a host name
+        self.unindexed = set()
+        # positions of arrays without the property
+        self.without = set()
+
+    def add(self, position, properties):
+        p = properties.get(self.key)
+        if p is None:
+            self.without.add(position)
+            return
+        network = ip_prefix(p.value) if p._value.is_single else None
+        if network is None or (self.immutable and p.precedence != p.IMMUTABLE):
+            self.unindexed.add(position)
+        else:
+            self.tree.add(network, position)
+
+    def select(self, p):
+        """
+        Return the positions of all arrays with a value of the indexed property which may overlap with the property
+        p, or None if p is not an address.
+        """
+        network = ip_prefix(p.value) if p._value.is_single else None
+        if network is None:
+            return None
+        return self.tree.overlapping(network) | self.unindexed
@@ -0,0 +1,147 @@
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+import pmdefaults as PM
+
+
+class ProfilerError(Exception):
+    pass
+
+
+def collapse_stack(frame):
+    """Return the stack of frame in collapsed format, i.e., the frames from the outermost inwards separated by ';'."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Profiler(object):
+    """
+    On-demand profiling of the running PM.
+
+    Two modes are supported:
+
+    * cprofile: all requests passed through call() while the profiler is running are profiled with cProfile. The
+      merged statistics are dumped to a .pstats file (see the pstats module).
+    * sample: a background thread samples the stacks of all threads every PROFILE_SAMPLE_INTERVAL seconds. The
+      samples are written to a .folded file in the collapsed stack format used by flamegraph.pl and speedscope.
+
+    Neither mode blocks request processing. A profiling run stops after the given number of seconds or when stop()
+    is called.
+    """
+
+    MODES = ('cprofile', 'sample')
+
+    def __init__(self, output_dir=None, interval=None):
+        self.output_dir = output_dir or PM.PROFILE_DIR
+        self.interval = interval or PM.PROFILE_SAMPLE_INTERVAL
+
+        self.mode = None
+        self.started = None
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.samples = Counter()
+        self.timer = None
+        self.sampler = None
+        self.stopped = threading.Event()
+        # file written by the last profiling run
+        self.last_output = None
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    def status(self):
+        return {'mode': self.mode, 'running_for': time.time() - self.started if self.running else None,
+                'last_output': self.last_output}
+
+    def start(self, mode='sample', seconds=None):
+        """Start profiling for the given number of seconds."""
+        if mode not in self.MODES:
+            raise ProfilerError("unknown profiler mode %s" % mode)
+        seconds = PM.PROFILE_SECONDS if seconds is None else float(seconds)
+        if seconds <= 0:
+            raise ProfilerError("invalid profiling duration %s" % seconds)
+
+        with self.lock:
+            if self.running:
+                raise ProfilerError("profiler already running (%s)" % self.mode)
+            self.mode = mode
+            self.started = time.time()
+            self.profiles = []
+            self.samples = Counter()
+            self.stopped.clear()
+
+        if mode == 'sample':
+            self.sampler = threading.Thread(target=self._sample, name='PM profiler', daemon=True)
+            self.sampler.start()
+
+        self.timer = threading.Timer(seconds, self.stop)
+        self.timer.daemon = True
+        self.timer.start()
+        logging.info("started %s profiler for %.1fs" % (mode, seconds))
+
+    def stop(self):
+        """Stop profiling and write the collected profile. Returns the name of the written file."""
+        with self.lock:
+            if not self.running:
+                return None
+            mode, self.mode = self.mode, None
+            self.stopped.set()
+
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        filename = os.path.join(self.output_dir, 'pm-%s.%s' % (time.strftime('%Y%m%d-%H%M%S'),
+                                                              'pstats' if mode == 'cprofile' else 'folded'))
+        if mode == 'cprofile':
+            if not self.profiles:
+                logging.info("no requests were profiled")
+                return None
+            stats = pstats.Stats(*self.profiles)
+            stats.dump_stats(filename)
+        else:
+            with open(filename, 'w') as f:
+                for stack, count in self.samples.most_common():
+                    f.write('%s %d\n' % (stack, count))
+
+        self.last_output = filename
+        logging.info("%s profile written to %s" % (mode, filename))
+        return filename
+
+    def call(self, func, *args):
+        """Run func(*args), profiling the call if the cprofile profiler is running."""
+        if self.mode != 'cprofile':
+            return func(*args)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            with self.lock:
+                self.profiles.append(profile)
+
+    def wrap(self, func):
+        """Return a version of func which is profiled while the cprofile profiler is running."""
+        return functools.wraps(func)(functools.partial(self.call, func))
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.samples[collapse_stack(frame)] += 1
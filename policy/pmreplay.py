@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Replay socket messages recorded by neatpmd --capture against a running PM.
+
+Example:
+
+    ./pmreplay.py capture.jsonl --speed 10 --concurrency 32
+
+replays the capture ten times faster than recorded, with at most 32 open connections.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from collections import Counter, defaultdict
+
+import pmdefaults as PM
+from pmcapture import read_capture
+from pmencoding import BINARY_ENCODING, EncodingError, decode_binary, split_encoding
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a sorted list using the nearest-rank method."""
+    if not values:
+        return float('nan')
+    rank = max(math.ceil(p / 100.0 * len(values)), 1)
+    return values[rank - 1]
+
+
+def valid_reply(request, reply):
+    """Return True if reply is a list of candidates in the reply encoding requested by the PM request."""
+    try:
+        if split_encoding(request)[0] == BINARY_ENCODING:
+            return isinstance(decode_binary(reply), list)
+        return isinstance(json.loads(reply.decode('utf-8')), list)
+    except (ValueError, EncodingError):
+        return False
+
+
+class Replay(object):
+    def __init__(self, messages, sockets, speed=1.0, concurrency=16, timeout=5.0):
+        self.messages = messages
+        self.sockets = sockets
+        # replay speed relative to the recorded rate, 0 replays messages as fast as possible
+        self.speed = speed
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    async def send(self, socket, data):
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.sockets[socket]),
+                                                        self.timeout)
+                writer.write(data.encode('utf-8'))
+                writer.write_eof()
+                reply = await asyncio.wait_for(reader.read(), self.timeout)
+                writer.close()
+            except asyncio.TimeoutError:
+                self.errors[socket, 'timeout'] += 1
+                return
+            except OSError:
+                self.errors[socket, 'connection'] += 1
+                return
+
+            if socket == 'pm' and not valid_reply(data, reply):
+                self.errors[socket, 'invalid reply'] += 1
+                return
+            self.latencies[socket].append((time.perf_counter() - start) * 1000)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        t0 = self.messages[0][0] if self.messages else 0
+        start = loop.time()
+        tasks = []
+        for t, socket, data in self.messages:
+            if self.speed:
+                delay = start + (t - t0) / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.send(socket, data)))
+        await asyncio.gather(*tasks)
+        return loop.time() - start
+
+    def report(self, duration):
+        print('replayed %d messages in %.3fs' % (len(self.messages), duration))
+        for socket in sorted(self.latencies.keys() | {s for s, _ in self.errors}):
+            latencies = sorted(self.latencies[socket])
+            errors = sum(n for (s, _), n in self.errors.items() if s == socket)
+            print('%-4s %6d ok %6d errors %8.1f/s   latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (
+                socket, len(latencies), errors, len(latencies) / duration if duration else 0.0,
+                percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+                latencies[-1] if latencies else float('nan')))
+        for (socket, error), n in sorted(self.errors.items()):
+            print('     %s: %d %s errors' % (socket, n, error))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay captured NEAT Policy Manager socket messages')
+    parser.add_argument('capture', type=str, help='capture file written by neatpmd --capture')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed relative to the recorded rate (0: as fast as possible)')
+    parser.add_argument('--concurrency', type=int, default=16, help='maximum number of concurrent connections')
+    parser.add_argument('--timeout', type=float, default=5.0, help='timeout of each message in seconds')
+    parser.add_argument('--only', type=str, choices=('pm', 'cib', 'pib'), default=None,
+                        help='replay only the messages of one socket')
+    parser.add_argument('--sock', type=str, default=PM.DOMAIN_SOCK, help='PM request socket path')
+    parser.add_argument('--cib-sock', type=str, default=PM.CIB_SOCK, help='CIB socket path')
+    parser.add_argument('--pib-sock', type=str, default=PM.PIB_SOCK, help='PIB socket path')
+    args = parser.parse_args()
+
+    messages = [m for m in read_capture(args.capture) if args.only in (None, m[1])]
+    messages.sort(key=lambda m: m[0])
+    sockets = {'pm': os.path.expanduser(args.sock), 'cib': os.path.expanduser(args.cib_sock),
+               'pib': os.path.expanduser(args.pib_sock)}
+
+    replay = Replay(messages, sockets, speed=args.speed, concurrency=args.concurrency, timeout=args.timeout)
+    loop = asyncio.get_event_loop()
+    duration = loop.run_until_complete(replay.run())
+    replay.report(duration)
+    loop.close()
@@ -2,9 +2,13 @@ import asyncio
 import json
 import logging
 import random
+import time
 from contextlib import suppress
 
 import pmdefaults as PM
+from cib import CIBEntryError
+from pib import NEATPIBError
+from pmprofile import ProfilerError
 
 try:
     import aiohttp
@@ -17,12 +21,30 @@ except ImportError as e:
 profiles = None
 cib = None
 pib = None
+# callable used to run a JSON request through the PM lookup pipeline
+process_request = None
+# background updaters applying CIB/PIB changes (see pmupdate.Updater)
+cib_updater = None
+pib_updater = None
+# counters reported by the /stats route, keyed by component name
+stats = {}
+# live profiler (see pmprofile.Profiler)
+profiler = None
+# sampled request traces (see pmtrace.Tracer)
+tracer = None
+# per-client admission control of the PM socket (see pmadmission.AdmissionControl)
+admission = None
+# lookup and ingest scheduling lanes (see pmlanes.Lanes)
+lanes = None
 
 server = None
 
 app = None
 loop = None
 
+# persistent HTTP client session used for all controller requests
+session = None
+
 
 def gen_hello_msg():
     host_info = {'host-uid': PM.CLIENT_UID,
@@ -33,6 +55,20 @@ def gen_hello_msg():
     return x
 
 
+def get_session():
+    """
+    Return the pooled HTTP client session for controller requests. The session is created on first use and its
+    connections are kept alive between requests.
+    """
+    global session
+
+    if session is None or session.closed:
+        conn = aiohttp.TCPConnector(local_addr=(PM.REST_IP, 0), limit=PM.CONTROLLER_MAX_CONNECTIONS)
+        auth = aiohttp.BasicAuth(PM.CONTROLLER_USER, PM.CONTROLLER_PASS)
+        session = aiohttp.ClientSession(connector=conn, auth=auth)
+    return session
+
+
 async def controller_announce():
     """
     Register NEAT client with a remote controller
@@ -47,41 +83,135 @@ async def controller_announce():
 
         print("Notifying controller at %s (repeat in %1.0fs)" % (PM.CONTROLLER_REST, sleep_time))
 
-        conn = aiohttp.TCPConnector(local_addr=(PM.REST_IP, 0))
-        auth = aiohttp.BasicAuth(PM.CONTROLLER_USER, PM.CONTROLLER_PASS)
-
-        async with aiohttp.ClientSession(connector=conn, auth=auth) as session:
-            try:
-                async with session.post(PM.CONTROLLER_REST, data=gen_hello_msg(),
-                                        headers={'content-type': 'application/json'}) as resp:
-                    logging.debug(
-                        'announce addr: %s:%s' % resp.connection._protocol.transport.get_extra_info('sockname'))
-                    assert resp.status == 200
-                    html = await resp.text()
-                    #logging.debug(html)
+        try:
+            async with get_session().post(PM.CONTROLLER_REST, data=gen_hello_msg(),
+                                          headers={'content-type': 'application/json'}) as resp:
+                logging.debug(
+                    'announce addr: %s:%s' % resp.connection._protocol.transport.get_extra_info('sockname'))
+                assert resp.status == 200
+                html = await resp.text()
+                #logging.debug(html)
 
-            except (ValueError, aiohttp.errors.ClientOSError) as e:
-                print(e)
+        except (ValueError, AssertionError, aiohttp.ClientError) as e:
+            print(e)
 
         await asyncio.sleep(sleep_time)
 
 
+class CIBFeed(object):
+    """
+    Pull CIB updates from a controller.
+
+    Each poll issues a conditional GET using the ETag of the previous reply (If-None-Match) and the cursor returned
+    by the controller (since=<cursor>). The controller replies with 304 if nothing has changed, or with a JSON object
+    containing the changes since the cursor:
+
+        {"cursor": "42", "updated": [<CIB node>, ...], "removed": [<uid>, ...]}
+
+    A plain list of CIB nodes is accepted as well. Changes are applied to the CIB as a delta.
+    """
+
+    def __init__(self, url, cib_ref, updater=None):
+        self.url = url
+        self.cib = cib_ref
+        self.updater = updater
+        self.etag = None
+        self.cursor = None
+
+    async def poll(self, client_session):
+        """Fetch and apply pending CIB updates. Returns True if the CIB was changed."""
+        headers = {'accept': 'application/json'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        params = {'since': self.cursor} if self.cursor is not None else {}
+
+        async with client_session.get(self.url, params=params, headers=headers) as resp:
+            if resp.status == 304:
+                return False
+            if resp.status != 200:
+                logging.warning("CIB feed returned status %d" % resp.status)
+                return False
+            feed = json.loads(await resp.text())
+            etag = resp.headers.get('ETag')
+
+        cursor = self.cursor
+        if isinstance(feed, list):
+            updated, removed = feed, []
+        elif isinstance(feed, dict):
+            updated, removed = feed.get('updated', []), feed.get('removed', [])
+            cursor = feed.get('cursor', cursor)
+        else:
+            raise ValueError("invalid CIB feed reply")
+
+        changed = bool(updated or removed)
+        if changed:
+            logging.info("CIB feed: %d updated, %d removed nodes" % (len(updated), len(removed)))
+            await run_update(self.updater, self.cib.apply_delta, updated, removed)
+
+        # only advance once the changes have been applied, so that failed updates are fetched again
+        self.etag, self.cursor = etag, cursor
+        return changed
+
+
+async def controller_feed():
+    """
+    Poll the controller CIB feed every PM.CONTROLLER_FEED_INTERVAL seconds, backing off after failed polls
+    """
+    if not PM.CONTROLLER_CIB_FEED:
+        return
+
+    feed = CIBFeed(PM.CONTROLLER_CIB_FEED, cib, cib_updater)
+    interval = PM.CONTROLLER_FEED_INTERVAL
+    while True:
+        try:
+            await feed.poll(get_session())
+            interval = PM.CONTROLLER_FEED_INTERVAL
+        except (ValueError, aiohttp.ClientError) as e:
+            print(e)
+            interval = min(interval * 2, PM.CONTROLLER_FEED_MAX_INTERVAL)
+        except Exception:
+            logging.exception("CIB feed update failed")
+            interval = min(interval * 2, PM.CONTROLLER_FEED_MAX_INTERVAL)
+
+        await asyncio.sleep(interval)
+
+
+async def run_update(updater, func, *args):
+    """Run a CIB/PIB update on its background updater, or directly if no updater is set."""
+    if updater is None:
+        return func(*args)
+    return await updater.call(func, *args)
+
+
+async def run_import(updater, target, slim, uid):
+    """Import JSON into the CIB/PIB. Imports queued on an updater are coalesced into a single reload."""
+    if updater is None:
+        return target.import_json(slim, uid)
+    return await updater.import_json(slim, uid)
+
+
 async def handle_pib(request):
     uid = request.match_info.get('uid')
     if uid is None:
-        text = json.dumps(list(pib.index.keys()))
+        text = json.dumps(list(pib.snapshot.index.keys()))
         return web.Response(text=text)
 
     logging.info("PIB request for uid %s" % (uid))
 
     try:
-        text = pib.index[uid].json()
+        text = pib.snapshot.index[uid].json()
     except KeyError as e:
         return web.Response(status=404, text='unknown UID')
 
     return web.Response(text=text)
 
 
+async def handle_pib_analysis(request):
+    """Return the conflicting, dead, shadowed and no-op policies found by the PIB analysis."""
+    text = json.dumps(pib.snapshot.analysis.report(), indent=4, sort_keys=True)
+    return web.Response(text=text)
+
+
 async def handle_pib_put(request):
     """
 
@@ -95,10 +225,29 @@ async def handle_pib_put(request):
     logging.info("Received new policy entry with uid %s" % (uid))
 
     new_cib = await request.text()
-    pib.import_json(new_cib, uid)
+    await run_import(pib_updater, pib, new_cib, uid)
     return web.Response(text="OK")
 
 
+async def handle_pib_patch(request):
+    """
+    Apply a JSON patch (RFC 6902) to an existing policy.
+
+    Test using: curl -X PATCH -d '[{"op": "replace", "path": "/priority", "value": 5}]' localhost:45888/pib/23423
+    """
+    uid = request.match_info.get('uid')
+
+    try:
+        ops = json.loads(await request.text())
+        policy = await run_update(pib_updater, pib.patch, uid, ops)
+    except KeyError:
+        return web.Response(status=404, text='unknown UID')
+    except (ValueError, NEATPIBError) as e:
+        return web.Response(status=400, text=str(e))
+
+    return web.Response(text=policy.json())
+
+
 async def handle_cib_rows(request):
     rows = []
     for i in cib.rows:
@@ -107,6 +256,18 @@ async def handle_cib_rows(request):
     return web.Response(text=text)
 
 
+async def handle_cib_paths(request):
+    """Return the number of CIB paths and rows generated for each CIB root node."""
+    text = json.dumps(dict(cib.snapshot.path_stats), indent=4, sort_keys=True)
+    return web.Response(text=text)
+
+
+async def handle_cib_shards(request):
+    """Return the number of CIB rows in each CIB shard."""
+    text = json.dumps({str(shard.key): len(shard.rows) for shard in cib.snapshot.shards}, indent=4, sort_keys=True)
+    return web.Response(text=text)
+
+
 async def handle_cib(request):
     uid = request.match_info.get('uid')
     if uid is None:
@@ -133,10 +294,149 @@ async def handle_cib_put(request):
     logging.info("new CIB entry with uid %s" % (uid))
 
     new_cib = await request.text()
-    cib.import_json(new_cib, uid)
+    await run_import(cib_updater, cib, new_cib, uid)
     return web.Response(text="OK")
 
 
+async def timed_lookup(json_str):
+    """
+    Run a single JSON request through the PM pipeline. Returns the candidates, or None if the request is invalid, and
+    the elapsed time in ms.
+    """
+    start = time.perf_counter()
+    try:
+        if lanes is not None:
+            candidates = await lanes.submit(process_request, json_str)
+        else:
+            candidates = await loop.run_in_executor(None, process_request, json_str)
+    except Exception:
+        # malformed requests may fail anywhere in the pipeline, they are reported as invalid
+        logging.exception("REST lookup failed")
+        candidates = None
+    return candidates, (time.perf_counter() - start) * 1000
+
+
+async def handle_lookup(request):
+    """
+    Run NEAT requests through the PM lookup pipeline and return the generated candidates.
+
+    The body is either a single NEAT request, i.e., the JSON accepted by the PM socket, or a batch of requests
+    of the form {"requests": [<request>, <request>, ...]}. Batched requests are processed concurrently and the
+    reply contains one candidate list per request (null for invalid requests). The processing time of each
+    request is returned in the Server-Timing header.
+
+    Test using: curl -H 'Content-Type: application/json' -d @request.json localhost:45888/lookup
+    """
+    if process_request is None:
+        return web.Response(status=503, text='lookups not available')
+
+    body = await request.text()
+    try:
+        body_json = json.loads(body)
+    except ValueError:
+        return web.Response(status=400, text='invalid JSON')
+
+    batch = isinstance(body_json, dict) and isinstance(body_json.get('requests'), list)
+    if batch:
+        json_requests = [json.dumps(r) for r in body_json['requests']]
+    else:
+        json_requests = [body]
+
+    logging.info("REST lookup for %d request(s)" % len(json_requests))
+    results = await asyncio.gather(*(timed_lookup(r) for r in json_requests))
+
+    replies = []
+    for candidates, _ in results:
+        if candidates is None:
+            replies.append(None)
+        else:
+            replies.append([c.dict() for c in candidates])
+
+    if not batch and replies[0] is None:
+        return web.Response(status=400, text='invalid NEAT request')
+
+    timing = ', '.join('req%d;dur=%.3f' % (i, t) for i, (_, t) in enumerate(results))
+    text = json.dumps(replies if batch else replies[0], sort_keys=True)
+    return web.Response(text=text, content_type='application/json', headers={'Server-Timing': timing})
+
+
+async def handle_cib_patch(request):
+    """
+    Apply a JSON patch (RFC 6902) to an existing CIB node.
+
+    Test using: curl -X PATCH -d '[{"op": "replace", "path": "/properties/capacity/value", "value": 500}]' localhost:45888/cib/A
+    """
+    uid = request.match_info.get('uid')
+
+    try:
+        ops = json.loads(await request.text())
+        node = await run_update(cib_updater, cib.patch, uid, ops)
+    except KeyError:
+        return web.Response(status=404, text='unknown UID')
+    except (ValueError, CIBEntryError) as e:
+        return web.Response(status=400, text=str(e))
+
+    return web.Response(text=node.json())
+
+
+async def handle_stats(request):
+    """Return the counters of all PM components."""
+    text = json.dumps({name: dict(counters) for name, counters in stats.items()}, indent=4, sort_keys=True)
+    return web.Response(text=text)
+
+
+async def handle_profile(request):
+    """
+    Return the profiler status (GET), start a profiling run (POST) or stop the running profiler (DELETE).
+
+    Test using: curl -X POST 'localhost:45888/profile?mode=cprofile&seconds=10'
+    """
+    if profiler is None:
+        return web.Response(status=503, text='profiler not available')
+
+    if request.method == 'POST':
+        try:
+            profiler.start(request.query.get('mode', 'sample'), request.query.get('seconds'))
+        except ValueError as e:
+            return web.Response(status=400, text=str(e))
+        except ProfilerError as e:
+            return web.Response(status=409 if profiler.running else 400, text=str(e))
+    elif request.method == 'DELETE':
+        # writing the profile may take a moment
+        await loop.run_in_executor(None, profiler.stop)
+
+    text = json.dumps(profiler.status(), indent=4)
+    return web.Response(text=text)
+
+
+async def handle_clients(request):
+    """Return the queued and running requests and the counters of each client of the PM socket."""
+    if admission is None:
+        return web.Response(status=503, text='admission control not available')
+    text = json.dumps(admission.dict(), indent=4, sort_keys=True)
+    return web.Response(text=text)
+
+
+async def handle_traces(request):
+    """Return the buffered request traces, most recent first, or a single trace if a trace id is given."""
+    if tracer is None:
+        return web.Response(status=503, text='tracing not available')
+
+    trace_id = request.match_info.get('id')
+    if trace_id is None:
+        text = json.dumps([t.dict() for t in tracer.get()], indent=4)
+        return web.Response(text=text)
+
+    try:
+        trace = tracer.get(int(trace_id))
+    except ValueError:
+        trace = None
+    if trace is None:
+        return web.Response(status=404, text='unknown trace')
+    text = json.dumps(trace.dict(), indent=4)
+    return web.Response(text=text)
+
+
 async def handle_rest(request):
     name = str(request.match_info.get('name')).lower()
     if name not in ('pib', 'cib'):
@@ -148,7 +448,9 @@ async def handle_rest(request):
     return web.Response(text=text)
 
 
-def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=None):
+def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=None, process_request_ref=None,
+                     cib_updater_ref=None, pib_updater_ref=None, stats_ref=None, profiler_ref=None,
+                     tracer_ref=None, admission_ref=None, lanes_ref=None):
     """ Initialize and register REST server
 
     curl  -H 'Content-Type: application/json' -X PUT -d'["abc",123]' localhost:45888/c3b/23423
@@ -157,13 +459,22 @@ def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=Non
         logging.info("REST server not available because the aiohttp module is not installed.")
         return
 
-    global pib, cib, port, server, loop, app
+    global profiles, pib, cib, process_request, cib_updater, pib_updater, stats, profiler, tracer, admission, lanes
+    global port, server, loop, app
 
     loop = asyncio_loop
 
     profiles = profiles_ref
     cib = cib_ref
     pib = pib_ref
+    process_request = process_request_ref
+    cib_updater = cib_updater_ref
+    pib_updater = pib_updater_ref
+    stats = stats_ref or {}
+    profiler = profiler_ref
+    tracer = tracer_ref
+    admission = admission_ref
+    lanes = lanes_ref
 
     if rest_port:
         PM.REST_PORT = rest_port
@@ -173,15 +484,34 @@ def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=Non
 
     pmrest.router.add_get('/', handle_rest)
     pmrest.router.add_get('/pib', handle_pib)
+    pmrest.router.add_get('/pib/analysis', handle_pib_analysis)
     pmrest.router.add_get('/pib/{uid}', handle_pib)
 
     pmrest.router.add_get('/cib', handle_cib)
     pmrest.router.add_get('/cib/rows', handle_cib_rows)
+    pmrest.router.add_get('/cib/paths', handle_cib_paths)
+    pmrest.router.add_get('/cib/shards', handle_cib_shards)
     pmrest.router.add_get('/cib/{uid}', handle_cib)
 
     pmrest.router.add_put('/cib/{uid}', handle_cib_put)
     pmrest.router.add_put('/pib/{uid}', handle_pib_put)
 
+    pmrest.router.add_patch('/cib/{uid}', handle_cib_patch)
+    pmrest.router.add_patch('/pib/{uid}', handle_pib_patch)
+
+    pmrest.router.add_post('/lookup', handle_lookup)
+
+    pmrest.router.add_get('/stats', handle_stats)
+
+    pmrest.router.add_get('/profile', handle_profile)
+    pmrest.router.add_post('/profile', handle_profile)
+    pmrest.router.add_delete('/profile', handle_profile)
+
+    pmrest.router.add_get('/traces', handle_traces)
+    pmrest.router.add_get('/traces/{id}', handle_traces)
+
+    pmrest.router.add_get('/clients', handle_clients)
+
     handler = pmrest.make_handler()
 
     f = asyncio_loop.create_server(handler, PM.REST_IP, PM.REST_PORT)
@@ -193,6 +523,7 @@ def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=Non
         return
 
     asyncio.ensure_future(controller_announce())
+    asyncio.ensure_future(controller_feed())
 
 
 def close():
@@ -211,3 +542,6 @@ def close():
 
     loop.run_until_complete(app.shutdown())
     loop.run_until_complete(app.cleanup())
+
+    if session is not None:
+        loop.run_until_complete(session.close())
@@ -1,14 +1,59 @@
 #!/usr/bin/env python3.5
 
+import asyncio
+import concurrent.futures
+import functools
+import json
 import locale
+import os
+import socket
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
+import pmdefaults as PM
+from cib import CIB
+import pib
+from pib import PIB, NEATPolicy
+from pmadmission import AdmissionControl, TokenBucket
+from pmcache import NegativeCache, SingleFlight, canonical_request
+from pmcapture import Capture, read_capture
+from pmdeadline import Deadline, peer_closed, request_budget
+from pmencoding import BINARY_ENCODING, EncodingError, decode_binary, encode_reply, split_encoding
+from pmencoding import split_headers
+from pmencoding import synthetic_candidates
+from pmimage import cib_image_state, open_image, pib_image_state, write_image
+from pmlanes import Lanes
+from pmprefix import PrefixTree, ip_prefix
+from pmprofile import Profiler, ProfilerError
+from pmreplay import percentile, valid_reply
+from pmtrace import Tracer
+from pmupdate import Updater
 from policy import *
 
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
 locale.setlocale(locale.LC_ALL, ('en', 'utf-8'))
 
 
+class AsyncTestCase(unittest.TestCase):
+    """Test case running each test with a new asyncio event loop in self.loop."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+
 class PropertyTests(unittest.TestCase):
     # TODO extend tests
 
@@ -97,6 +142,917 @@ class PropertyTests(unittest.TestCase):
             print(pma)
             pma_list.append(pma)
 
+    def test_address_prefix(self):
+        self.assertEqual(PropertyValue('10.10.0.0/16') & PropertyValue('10.10.3.4'), '10.10.3.4')
+        self.assertEqual(PropertyValue('10.10.1.0/24') & PropertyValue('10.10.0.0/16'), '10.10.1.0/24')
+        self.assertFalse(PropertyValue('10.10.0.0/16') & PropertyValue('10.11.0.1'))
+        self.assertFalse(PropertyValue('10.10.0.0/16') & PropertyValue('2001:db8::1'))
+        self.assertTrue(NEATProperty(('remote_ip', '2001:db8::/32')) == NEATProperty(('remote_ip', '2001:db8::5')))
+
+        p = NEATProperty(('remote_ip', '10.10.0.0/16'), precedence=NEATProperty.IMMUTABLE)
+        p.update(NEATProperty(('remote_ip', '10.10.7.7'), precedence=NEATProperty.IMMUTABLE))
+        self.assertEqual(p.value, '10.10.7.7')
+
+        tree = PrefixTree()
+        for item, prefix in enumerate(['10.0.0.0/8', '10.10.0.0/16', '10.10.1.1', '192.168.0.0/16', '::/0']):
+            tree.add(ip_prefix(prefix), item)
+        self.assertEqual(tree.matches(ip_prefix('10.10.1.1')), {0, 1, 2})
+        self.assertEqual(tree.overlapping(ip_prefix('10.10.0.0/16')), {0, 1, 2})
+        self.assertEqual(tree.overlapping(ip_prefix('2001:db8::1')), {4})
+        self.assertIsNone(ip_prefix('10:54:1.23'))
+
+    def test_json_patch(self):
+        doc = {'foo': {'value': 1}, 'bar': [1, 2]}
+        patched = apply_json_patch(doc, [{'op': 'replace', 'path': '/foo/value', 'value': 2},
+                                         {'op': 'add', 'path': '/bar/-', 'value': 3},
+                                         {'op': 'remove', 'path': '/bar/0'},
+                                         {'op': 'test', 'path': '/bar', 'value': [2, 3]}])
+        self.assertEqual(patched, {'foo': {'value': 2}, 'bar': [2, 3]})
+        self.assertEqual(doc['foo']['value'], 1)
+
+        with self.assertRaises(JSONPatchError):
+            apply_json_patch(doc, [{'op': 'replace', 'path': '/baz/value', 'value': 2}])
+        with self.assertRaises(JSONPatchError):
+            apply_json_patch(doc, [{'op': 'test', 'path': '/foo/value', 'value': 2}])
+
+
+def cib_node_dict(uid, properties, **attrs):
+    node = {'uid': uid, 'expire': -1, 'properties': properties}
+    node.update(attrs)
+    return node
+
+
+class CIBTests(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cib_dir = tempfile.TemporaryDirectory()
+        self.cib = CIB(self.cib_dir.name)
+
+    def tearDown(self):
+        self.cib_dir.cleanup()
+        super().tearDown()
+
+    def test_apply_delta(self):
+        local = cib_node_dict('eth0', {'interface': {'value': 'eth0'}, 'local_ip': {'value': '10.0.0.1'}}, root=True)
+        remote = cib_node_dict('remote', {'remote_ip': {'value': '10.1.1.1'}}, link=True,
+                               match=[{'local_ip': {'value': '10.0.0.1'}}])
+
+        self.cib.apply_delta([local, remote])
+        self.assertEqual(self.cib.graph, {'eth0': ['remote']})
+        self.assertEqual(len(list(self.cib.rows)), 1)
+        self.assertEqual(len(os.listdir(self.cib_dir.name)), 2)
+
+        # moving the local address must drop the link without touching the remote node
+        local['properties']['local_ip']['value'] = '10.0.0.2'
+        self.cib.apply_delta([local])
+        self.assertEqual(self.cib.graph, {})
+
+        self.cib.apply_delta(removed=['remote'])
+        self.assertNotIn('remote', self.cib.nodes)
+        self.assertEqual(os.listdir(self.cib_dir.name), ['eth0.cib'])
+
+    def test_patch(self):
+        local = cib_node_dict('eth0', {'interface': {'value': 'eth0'}, 'local_ip': {'value': '10.0.0.1'},
+                                       'capacity': {'value': 100}}, root=True)
+        remote = cib_node_dict('remote', {'remote_ip': {'value': '10.1.1.1'}}, link=True,
+                               match=[{'local_ip': {'value': '10.0.0.2'}}])
+        self.cib.apply_delta([local, remote])
+        self.assertEqual(self.cib.graph, {})
+
+        node = self.cib.patch('eth0', [{'op': 'replace', 'path': '/properties/capacity/value', 'value': 500}])
+        self.assertIs(node, self.cib['eth0'])
+        self.assertEqual(node.properties[0]['capacity'][0].value, 500)
+
+        # patching a matched property updates the links of dependent nodes
+        self.cib.patch('eth0', [{'op': 'replace', 'path': '/properties/local_ip/value', 'value': '10.0.0.2'}])
+        self.assertEqual(self.cib.graph, {'eth0': ['remote']})
+
+        # nodes are patched in memory only
+        with open(os.path.join(self.cib_dir.name, 'eth0.cib')) as f:
+            self.assertEqual(json.load(f)['properties']['capacity']['value'], 100)
+
+    def test_snapshot(self):
+        local = cib_node_dict('eth0', {'interface': {'value': 'eth0'}, 'local_ip': {'value': '10.0.0.1'}}, root=True)
+        remote = cib_node_dict('remote', {'remote_ip': {'value': '10.1.1.1'}}, link=True,
+                               match=[{'local_ip': {'value': '10.0.0.1'}}])
+        self.cib.apply_delta([local, remote])
+        snapshot = self.cib.snapshot
+
+        self.cib.apply_delta(removed=['remote'])
+        self.assertEqual(self.cib.snapshot.generation, snapshot.generation + 1)
+        self.assertIn('remote', snapshot.nodes)
+        self.assertIn('remote_ip', snapshot.rows[0])
+        self.assertNotIn('remote_ip', self.cib.rows[0])
+
+        # incrementally published rows must match a full expansion
+        self.cib.apply_delta([remote])
+        self.cib.patch('remote', [{'op': 'add', 'path': '/properties/remote_port', 'value': {'value': 80}}])
+        rows = [r.dict() for r in self.cib.rows]
+        self.cib.publish()
+        self.assertEqual(rows, [r.dict() for r in self.cib.rows])
+        self.assertEqual(rows[0]['remote_port']['value'], 80)
+
+    def test_paths(self):
+        # two link nodes matching the root and each other form a cycle
+        nodes = [cib_node_dict('root', {'interface': {'value': 'eth0'}}, root=True),
+                 cib_node_dict('a', {'foo': [{'value': 1}, {'value': 2}]}, link=True,
+                               match=[{'uid': {'value': 'root'}}, {'uid': {'value': 'b'}}]),
+                 cib_node_dict('b', {'bar': {'value': 3}}, link=True,
+                               match=[{'uid': {'value': 'root'}}, {'uid': {'value': 'a'}}])]
+        self.cib.apply_delta(nodes)
+
+        self.assertEqual(sorted(self.cib.paths('root')), [('root', 'a', 'b'), ('root', 'b', 'a')])
+        self.assertEqual(self.cib.path_count('root'), 2)
+        self.assertEqual(self.cib.row_count('root'), 4)
+        self.assertEqual(len(self.cib.rows), 4)
+
+        # rows are limited to the configured budget
+        self.cib.max_rows = 3
+        self.cib.publish()
+        self.assertEqual(len(self.cib.rows), 3)
+        self.assertEqual(self.cib.snapshot.path_stats['root']['rows'], 4)
+
+    def test_extender_index(self):
+        nodes = [cib_node_dict('eth0', {'interface': {'value': 'eth0'}, 'MTU': {'value': [1500, 9000]},
+                                        'RTT': {'value': {'start': 10, 'end': 50}}}, root=True),
+                 cib_node_dict('if', {'x': {'value': 1}}, match=[{'interface': {'value': 'eth0'}}]),
+                 cib_node_dict('mtu', {'x': {'value': 2}}, match=[{'MTU': {'value': 1500}}]),
+                 cib_node_dict('rtt', {'x': {'value': 3}}, match=[{'RTT': {'value': 20}}]),
+                 cib_node_dict('range', {'x': {'value': 4}}, match=[{'RTT': {'value': {'start': 0, 'end': 5}}}]),
+                 cib_node_dict('other', {'x': {'value': 5}}, match=[{'interface': {'value': 'eth1'}},
+                                                                    {'MTU': {'value': [100, 200]}}])]
+        self.cib.apply_delta(nodes)
+
+        row = self.cib['eth0'].expand_rows(apply_extended=False)[0]
+        candidates = [xs.uid for xs, _ in self.cib.extender_index.candidates(row)]
+        self.assertEqual(candidates, ['if', 'mtu', 'rtt', 'range'])
+
+        extended = sorted(r['x'].value for r in self.cib.rows if 'x' in r)
+        self.assertEqual(extended, [1, 2, 3])
+
+    def test_ranked_lookup(self):
+        nodes = [cib_node_dict('if%d' % n, {'interface': {'value': 'if%d' % n, 'score': n % 3},
+                                            'MTU': {'value': 1500 if n % 2 else 9000, 'score': n % 4 - 1},
+                                            'transport': {'value': 'TCP', 'score': -n}}, root=True)
+                 for n in range(8)]
+        self.cib.apply_delta(nodes)
+        snapshot = self.cib.snapshot
+
+        request = PropertyArray(NEATProperty(('MTU', 1500), score=2), NEATProperty(('transport', 'TCP'), score=1))
+        everything = [request] + [e + request for e in snapshot.rows]
+        expected = sorted(everything, key=lambda c: c.score, reverse=True)
+        for candidate_num in range(1, 11):
+            candidates = snapshot.lookup(request, candidate_num=candidate_num)
+            self.assertEqual([c.dict() for c in candidates], [c.dict() for c in expected[:candidate_num]])
+
+    def test_shards(self):
+        nodes = [cib_node_dict('eth%d' % n, {'interface': {'value': 'eth%d' % n, 'precedence': NEATProperty.IMMUTABLE},
+                                             'local_ip': {'value': '10.0.0.%d' % n, 'score': n},
+                                             'transport': {'value': 'TCP'}}, root=True)
+                 for n in range(3)]
+        nodes.append(cib_node_dict('any', {'transport': {'value': 'UDP'}}, root=True))
+        self.cib.apply_delta(nodes)
+        snapshot = self.cib.snapshot
+        self.assertEqual(sorted(str(s.key) for s in snapshot.shards), ['None', 'eth0', 'eth1', 'eth2'])
+
+        request = PropertyArray(NEATProperty(('interface', 'eth1'), precedence=NEATProperty.IMMUTABLE))
+        self.assertEqual([s.key for s in snapshot.shards if s.matches(request)], ['eth1'])
+        candidates = snapshot.lookup(request)
+        self.assertEqual([c.get('local_ip') and c['local_ip'].value for c in candidates], ['10.0.0.1', None])
+
+        # optional properties do not restrict the searched shards
+        request = PropertyArray(NEATProperty(('local_ip', '10.0.0.2')))
+        self.assertEqual(len(snapshot.lookup(request)), 5)
+
+    def test_optional_shard_values(self):
+        nodes = [cib_node_dict('eth0', {'interface': {'value': 'eth0'}, 'transport': {'value': 'TCP'}}, root=True),
+                 cib_node_dict('eth1', {'interface': {'value': 'eth1', 'precedence': NEATProperty.IMMUTABLE}},
+                               root=True)]
+        self.cib.apply_delta(nodes)
+        snapshot = self.cib.snapshot
+
+        # an immutable request value overrides the optional interface value of the eth0 row
+        request = PropertyArray(NEATProperty(('interface', 'eth2'), precedence=NEATProperty.IMMUTABLE))
+        self.assertEqual([s.key for s in snapshot.shards if s.matches(request)], ['eth0'])
+        candidates = snapshot.lookup(request)
+        self.assertEqual([(c['interface'].value, c.get('transport') and c['transport'].value) for c in candidates],
+                         [('eth2', None), ('eth2', 'TCP')])
+
+    def test_address_prefixes(self):
+        immutable = NEATProperty.IMMUTABLE
+        nodes = [cib_node_dict('eth0', {'interface': {'value': 'eth0'}}, root=True),
+                 cib_node_dict('subnet', {'remote_ip': {'value': '10.10.0.0/16', 'precedence': immutable},
+                                          'RTT': {'value': 20}}, link=True, match=[{'interface': {'value': 'eth0'}}]),
+                 cib_node_dict('host', {'remote_ip': {'value': '10.20.0.1', 'precedence': immutable},
+                                        'RTT': {'value': 50}}, link=True, match=[{'interface': {'value': 'eth0'}}]),
+                 cib_node_dict('sdn', {'sdn': {'value': True}}, match=[{'remote_ip': {'value': '10.10.128.0/17'}}])]
+        self.cib.apply_delta(nodes)
+
+        request = PropertyArray(NEATProperty(('remote_ip', '10.10.200.1'), precedence=NEATProperty.IMMUTABLE))
+        rows = [c for c in self.cib.lookup(request) if hasattr(c, 'cib_node')]
+        self.assertEqual(sorted(c['remote_ip'].value for c in rows), ['10.10.200.1', '10.10.200.1'])
+        self.assertEqual(sorted('sdn' in c for c in rows), [False, True])
+
+        request = PropertyArray(NEATProperty(('remote_ip', '10.30.0.1'), precedence=NEATProperty.IMMUTABLE))
+        self.assertEqual(self.cib.lookup(request), [request])
+
+    def test_optional_addresses(self):
+        nodes = [cib_node_dict('eth0', {'interface': {'value': 'eth0'}, 'remote_ip': {'value': '10.0.0.1'}},
+                               root=True),
+                 cib_node_dict('eth1', {'interface': {'value': 'eth1'},
+                                        'remote_ip': {'value': '10.0.1.1', 'precedence': NEATProperty.IMMUTABLE}},
+                               root=True)]
+        self.cib.apply_delta(nodes)
+
+        # an immutable request address overrides the optional address of the eth0 row
+        request = PropertyArray(NEATProperty(('remote_ip', '10.0.0.2'), precedence=NEATProperty.IMMUTABLE))
+        rows = [c for c in self.cib.lookup(request) if hasattr(c, 'cib_node')]
+        self.assertEqual([(c['interface'].value, c['remote_ip'].value) for c in rows], [('eth0', '10.0.0.2')])
+
+    def test_updater(self):
+        updater = Updater(self.cib.import_json, self.cib.reload_files)
+        self.addCleanup(updater.close)
+
+        async def update():
+            nodes = [cib_node_dict('n%d' % i, {'interface': {'value': 'eth%d' % i}}, root=True) for i in range(3)]
+            futures = [updater.import_json(json.dumps(n)) for n in nodes]
+            patch = {'uid': 'n0', 'patch': [{'op': 'replace', 'path': '/properties/interface/value', 'value': 'lo'}]}
+            futures.append(updater.import_json(json.dumps(patch)))
+            await asyncio.gather(*futures)
+
+        self.loop.run_until_complete(update())
+
+        # concurrent imports are applied with a single reload
+        self.assertEqual(updater.stats['batches'], 1)
+        self.assertEqual(updater.stats['reloads'], 1)
+        self.assertEqual(sorted(self.cib.keys()), ['n0', 'n1', 'n2'])
+        self.assertEqual(self.cib['n0'].properties[0]['interface'][0].value, 'lo')
+
+    def test_updater_failure(self):
+        updater = Updater(self.cib.import_json, mock.Mock(side_effect=OSError('disk full')))
+        self.addCleanup(updater.close)
+
+        async def update():
+            node = cib_node_dict('n0', {'interface': {'value': 'eth0'}}, root=True)
+            return await asyncio.gather(updater.import_json(json.dumps(node)), return_exceptions=True)
+
+        # imports complete with the error of the failed reload
+        results = self.loop.run_until_complete(asyncio.wait_for(update(), 5))
+        self.assertIsInstance(results[0], OSError)
+
+
+class PIBTests(unittest.TestCase):
+    def setUp(self):
+        self.pib_dir = tempfile.TemporaryDirectory()
+        self.pib = PIB(self.pib_dir.name, file_extension='.policy')
+
+    def tearDown(self):
+        self.pib_dir.cleanup()
+
+    def test_patch(self):
+        for uid, priority in (('a', 1), ('b', 2)):
+            self.pib.register(NEATPolicy({'uid': uid, 'priority': priority, 'properties': {'foo': {'value': uid}}}))
+
+        self.pib.patch('a', [{'op': 'replace', 'path': '/priority', 'value': 3},
+                             {'op': 'replace', 'path': '/properties/foo/value', 'value': 'c'}])
+        self.assertEqual([p.uid for p in self.pib.policies], ['b', 'a'])
+        self.assertEqual(self.pib.index['a'].properties['foo'][0].value, 'c')
+
+    def test_register(self):
+        for uid, priority in (('c', 1), ('b', 1), ('a', 2)):
+            self.pib.register(NEATPolicy({'uid': uid, 'priority': priority, 'properties': {'foo': {'value': uid}}}))
+        self.assertEqual([p.uid for p in self.pib.policies], ['b', 'c', 'a'])
+
+        # policies with the same uid are replaced
+        self.pib.register(NEATPolicy({'uid': 'c', 'priority': 0, 'properties': {'foo': {'value': 'd'}}}))
+        self.assertEqual([p.uid for p in self.pib.snapshot.policies], ['c', 'b', 'a'])
+        self.assertEqual(self.pib.index['c'].properties['foo'][0].value, 'd')
+
+        self.pib.unregister('b')
+        self.assertEqual([p.uid for p in self.pib.snapshot.policies], ['c', 'a'])
+        self.assertEqual(len(self.pib.policies), len(self.pib.index))
+
+    def test_reload(self):
+        def write(name, uid, value):
+            with open(os.path.join(self.pib_dir.name, name), 'w') as f:
+                json.dump({'uid': uid, 'properties': {'foo': {'value': value}}}, f)
+
+        write('a.policy', 'a', 1)
+        write('b.policy', 'b', 1)
+        write('c.policy', 'c', 1)
+        write('d.profile', 'd', 1)
+        self.pib.reload()
+        self.assertEqual(sorted(self.pib.index), ['a', 'b', 'c'])
+
+        with mock.patch('pib.load_policy_json', wraps=pib.load_policy_json) as load:
+            # files with unchanged contents are not parsed again
+            os.utime(os.path.join(self.pib_dir.name, 'a.policy'), ns=(0, 0))
+            write('b.policy', 'b2', 2)
+            write('e.policy', 'e', 3)
+            os.remove(os.path.join(self.pib_dir.name, 'c.policy'))
+            self.pib.reload()
+            self.assertEqual(load.call_count, 2)
+
+        self.assertEqual([p.uid for p in self.pib.snapshot.policies], ['a', 'b2', 'e'])
+        self.assertEqual(self.pib.index['b2'].properties['foo'][0].value, 2)
+
+    def test_address_select(self):
+        policies = [('subnet', {'remote_ip': {'value': '10.10.0.0/16'}}),
+                    ('host', {'remote_ip': {'value': '10.20.0.1'}}),
+                    ('named', {'remote_ip': {'value': 'example.org'}}),
+                    ('any', {})]
+        for uid, match in policies:
+            self.pib.register(NEATPolicy({'uid': uid, 'match': match, 'properties': {'foo': {'value': uid}}}))
+        snapshot = self.pib.snapshot
+
+        def selected(request):
+            return sorted(p.uid for p in snapshot.select(request))
+
+        self.assertEqual(selected(PropertyArray(NEATProperty(('remote_ip', '10.10.1.1')))), ['any', 'named', 'subnet'])
+        self.assertEqual(selected(PropertyArray(NEATProperty(('transport', 'TCP')))), ['any'])
+        self.assertEqual(selected(PropertyArray(NEATProperty(('remote_ip', 'example.org')))), sorted(snapshot.index))
+
+        matched = [p.uid for p in snapshot.policies
+                   if p.match_query(PropertyArray(NEATProperty(('remote_ip', '10.10.1.1'))))]
+        self.assertEqual(sorted(matched), ['any', 'subnet'])
+
+    def test_analysis(self):
+        immutable = NEATProperty.IMMUTABLE
+        policies = [('tcp', 1, {}, {'transport': {'value': 'TCP', 'precedence': immutable}}),
+                    ('udp', 2, {}, {'transport': {'value': 'UDP', 'precedence': immutable}}),
+                    ('mtu', 3, {'interface': {'value': 'en0'}}, {'mtu': {'value': 1500}}),
+                    ('jumbo', 4, {'interface': {'value': 'en0'}}, {'mtu': {'value': 9000}}),
+                    ('empty', 5, {'interface': {'value': 'en1'}}, {})]
+        for uid, priority, match, properties in policies:
+            self.pib.register(NEATPolicy({'uid': uid, 'priority': priority, 'match': match,
+                                          'properties': properties}))
+        analysis = self.pib.snapshot.analysis
+
+        self.assertEqual(analysis.conflicts, {'udp': {'tcp'}})
+        self.assertEqual(analysis.dead, {'tcp': 'udp', 'udp': 'tcp'})
+        self.assertEqual(analysis.shadowed, {'mtu': 'jumbo'})
+        self.assertEqual(analysis.noop, {'empty'})
+
+        trace = []
+        request = PropertyArray(NEATProperty(('interface', 'en1')))
+        self.assertEqual(self.pib.lookup(request, trace=trace), [])
+        self.assertEqual(trace, [('tcp', 'matched'), ('udp', 'rejected')])
+
+        # patched policies are analyzed again, the results of the unchanged policies are kept
+        self.pib.patch('udp', [{'op': 'replace', 'path': '/properties/transport/value', 'value': 'TCP'}])
+        self.assertEqual(self.pib.snapshot.analysis.conflicts, {})
+        self.assertEqual(self.pib.snapshot.analysis.report(), pib.PIBAnalysis(self.pib.snapshot.policies).report())
+        self.assertIs(self.pib.snapshot.analysis.immutables['tcp'], analysis.immutables['tcp'])
+        self.pib.patch('udp', [{'op': 'replace', 'path': '/properties/transport/value', 'value': 'UDP'}])
+        self.assertEqual(self.pib.snapshot.analysis.conflicts, {'udp': {'tcp'}})
+
+        # conflicts with immutable request properties are detected before merging
+        self.pib.unregister('udp')
+        request = PropertyArray(NEATProperty(('transport', 'UDP'), precedence=immutable))
+        self.assertEqual(self.pib.lookup(request), [])
+
+    def test_candidate_limit(self):
+        self.pib.register(NEATPolicy({'uid': 'a', 'priority': 1, 'properties': {
+            'transport': [{'value': 'TCP', 'score': 1}, {'value': 'UDP', 'score': 3}, {'value': 'SCTP', 'score': 2}]}}))
+        self.pib.register(NEATPolicy({'uid': 'b', 'priority': 2, 'properties': {
+            'MTU': [{'value': 1500}, {'value': 9000, 'score': 5}]}}))
+        policy = self.pib.index['a']
+        self.assertEqual(len(policy.expansions), 3)
+
+        request = PropertyArray(NEATProperty(('remote_ip', '10.1.1.1')))
+        self.assertEqual(len(self.pib.lookup(request)), 6)
+
+        with mock.patch.object(PM, 'PIB_MAX_CANDIDATES', 2):
+            candidates = self.pib.lookup(request)
+        self.assertEqual(sorted((c['transport'].value, c['MTU'].value) for c in candidates),
+                         [('SCTP', 9000), ('UDP', 9000)])
+
+        # expansions are not modified by lookups
+        self.assertEqual(sorted(e['transport'].score for e in policy.expansions), [1, 2, 3])
+
+
+class NegativeCacheTests(unittest.TestCase):
+    def test_negative_cache(self):
+        cache = NegativeCache(size=2)
+        key = canonical_request('{"transport": {"value": "TCP"}, "remote_ip": {"value": "10.1.1.1"}}')
+        self.assertEqual(key, canonical_request('{"remote_ip": {"value": "10.1.1.1"}, "transport": {"value": "TCP"}}'))
+        self.assertIsNone(canonical_request('{"remote_ip": '))
+
+        cache.add(key, (1, 1, 1), 0.5)
+        self.assertTrue(cache.get(key, (1, 1, 1)))
+        self.assertEqual(cache.stats['avoided_seconds'], 0.5)
+
+        # any profile/CIB/PIB update invalidates the entry
+        self.assertFalse(cache.get(key, (1, 2, 1)))
+        self.assertFalse(cache.get(key, (1, 1, 1)))
+        self.assertEqual(cache.stats['invalidated'], 1)
+
+        for n in range(3):
+            cache.add(n, (1, 1, 1))
+        self.assertEqual(list(cache.entries), [1, 2])
+        self.assertEqual(cache.stats['evicted'], 1)
+
+
+class SingleFlightTests(AsyncTestCase):
+    def test_single_flight(self):
+        flights = SingleFlight()
+        calls = []
+
+        def process(request):
+            calls.append(request)
+            return [request]
+
+        async def run_requests():
+            futures = [flights.run(key, process, key) for key in ('a', 'a', 'b', 'a')]
+            results = await asyncio.gather(*futures)
+            # completed requests are not reused
+            results.append(await flights.run('a', process, 'a'))
+            return results
+
+        results = self.loop.run_until_complete(run_requests())
+        self.assertEqual(results, [['a'], ['a'], ['b'], ['a'], ['a']])
+        self.assertEqual(sorted(calls), ['a', 'a', 'b'])
+        self.assertEqual(flights.stats['coalesced'], 2)
+        self.assertEqual(flights.pending, {})
+
+    def test_shared_deadline(self):
+        flights = SingleFlight()
+        first, second = Deadline(10), Deadline(5)
+        coalesced = threading.Event()
+
+        def process(deadline):
+            coalesced.wait(5)
+            return deadline.remaining()
+
+        async def run_requests():
+            futures = [flights.run('a', process, deadline, deadline=deadline) for deadline in (first, second)]
+            coalesced.set()
+            return await asyncio.gather(*futures)
+
+        # a coalesced request with a shorter budget does not truncate the running request
+        results = self.loop.run_until_complete(run_requests())
+        self.assertGreater(results[0], 5)
+        self.assertIs(second.leader, first)
+        self.assertEqual(first.waiters, [first, second])
+        self.assertEqual(flights.deadlines, {})
+
+
+class DeadlineTests(unittest.TestCase):
+    def test_deadline(self):
+        deadline = Deadline(60)
+        self.assertFalse(deadline.expired('pib'))
+        self.assertIsNone(deadline.truncated)
+
+        deadline = Deadline(0.5, start=time.monotonic() - 1)
+        self.assertTrue(deadline.expired('cib'))
+        self.assertTrue(deadline.expired('pib'))
+        # the first stage which found the deadline expired is recorded
+        self.assertEqual(deadline.truncated, 'cib')
+
+        self.assertEqual(request_budget({'timeout': '500'}), 0.5)
+        self.assertEqual(request_budget({'timeout': 'soon'}), PM.REQUEST_TIMEOUT)
+
+    def test_disconnect(self):
+        pm_sock, client_sock = socket.socketpair(socket.AF_UNIX)
+        self.addCleanup(pm_sock.close)
+        deadline = Deadline(60, sock=pm_sock)
+
+        # NEAT shuts down writing after sending its request
+        client_sock.shutdown(socket.SHUT_WR)
+        self.assertFalse(peer_closed(pm_sock))
+        self.assertFalse(deadline.expired())
+
+        client_sock.close()
+        self.assertTrue(peer_closed(pm_sock))
+        self.assertTrue(deadline.expired('profile'))
+        self.assertEqual(deadline.truncated, 'profile')
+
+    def test_shared_disconnect(self):
+        sockets = [socket.socketpair(socket.AF_UNIX) for _ in range(2)]
+        for pm_sock, client_sock in sockets:
+            self.addCleanup(pm_sock.close)
+        first, second = Deadline(60, sock=sockets[0][0]), Deadline(60, sock=sockets[1][0])
+        first.share(second)
+
+        # processing continues while any client waits for the result
+        sockets[0][1].close()
+        self.assertTrue(first.closed())
+        self.assertFalse(first.expired())
+        sockets[1][1].close()
+        self.assertTrue(first.expired('cib'))
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.profiler = Profiler(self.output_dir.name, interval=0.001)
+
+    def tearDown(self):
+        self.profiler.stop()
+        self.output_dir.cleanup()
+
+    def test_cprofile(self):
+        self.assertEqual(self.profiler.call(sorted, [2, 1]), [1, 2])
+        self.profiler.start('cprofile', seconds=60)
+        self.assertRaises(ProfilerError, self.profiler.start, 'sample')
+
+        self.assertEqual(self.profiler.wrap(sorted)([3, 1, 2]), [1, 2, 3])
+        filename = self.profiler.stop()
+        self.assertTrue(filename.endswith('.pstats'))
+        self.assertFalse(self.profiler.running)
+
+    def test_sample(self):
+        self.assertRaises(ProfilerError, self.profiler.start, 'unknown')
+        self.profiler.start('sample', seconds=0.05)
+        # the timer stops the profiler and writes the samples
+        self.profiler.timer.join()
+
+        with open(self.profiler.last_output) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        # collapsed stack format: frame;frame;... count
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+
+
+class TracerTests(unittest.TestCase):
+    def test_sampling(self):
+        self.assertIsNone(Tracer(rate=0).start('{}'))
+
+        tracer = Tracer(size=2, rate=1)
+        for n in range(3):
+            trace = tracer.start('{"n": %d}' % n)
+            trace.stage('parse', requests=1)
+            tracer.finish(trace)
+        tracer.finish(None)
+
+        # the ring buffer only keeps the most recent traces
+        self.assertEqual([t.id for t in tracer.get()], [3, 2])
+        self.assertIsNone(tracer.get(1))
+        trace = tracer.get(3).dict()
+        self.assertEqual(trace['request'], '{"n": 2}')
+        self.assertEqual([s['name'] for s in trace['stages']], ['parse'])
+        self.assertEqual(tracer.stats['sampled'], 3)
+
+    def test_pib_trace(self):
+        pib = PIB(None, load=False)
+        pib.register(NEATPolicy({'uid': 'tcp', 'match': {'transport': {'value': 'TCP'}},
+                                 'properties': {'low_latency': {'value': True}}}))
+        pib.register(NEATPolicy({'uid': 'udp', 'match': {'transport': {'value': 'UDP'}},
+                                 'properties': {'low_latency': {'value': True}}}))
+        pib.register(NEATPolicy({'uid': 'mtu', 'priority': 1, 'match': {'transport': {'value': 'TCP'}},
+                                 'properties': {'MTU': {'value': 9000, 'precedence': 2}}}))
+
+        trace = []
+        request = PropertyArray(NEATProperty(('transport', 'TCP')), NEATProperty(('MTU', 1500), precedence=2))
+        self.assertEqual(pib.lookup(request, trace=trace), [])
+        self.assertEqual(trace, [('tcp', 'matched'), ('mtu', 'rejected')])
+
+
+class LanesTests(AsyncTestCase):
+    def test_ingest_yields_to_lookups(self):
+        lanes = Lanes(max_yield=5)
+        started, release = threading.Event(), threading.Event()
+        events = []
+
+        def lookup():
+            started.set()
+            release.wait(5)
+            events.append('lookup')
+
+        def ingest():
+            started.wait(5)
+            lanes.checkpoint()
+            events.append('ingest')
+
+        threads = [threading.Thread(target=lanes.lookup(lookup)), threading.Thread(target=ingest)]
+        for t in threads:
+            t.start()
+        started.wait(5)
+        time.sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(events, ['lookup', 'ingest'])
+        self.assertEqual(lanes.stats['ingest_yields'], 1)
+        self.assertGreater(lanes.stats['ingest_wait_ms'], 0)
+
+        # ingest is never blocked for longer than max_yield
+        lanes = Lanes(max_yield=0.01)
+        release.clear()
+        lookup_thread = threading.Thread(target=lanes.lookup(release.wait), args=(5,))
+        lookup_thread.start()
+        ingest_thread = threading.Thread(target=lanes.checkpoint)
+        ingest_thread.start()
+        ingest_thread.join(1)
+        self.assertFalse(ingest_thread.is_alive())
+        release.set()
+        lookup_thread.join()
+
+    def test_lookup_queue(self):
+        lanes = Lanes()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        self.loop.set_default_executor(executor)
+
+        release = threading.Event()
+        depths = []
+
+        async def submit():
+            # the second lookup waits for the executor thread until the first one completes
+            futures = [lanes.submit(release.wait, 5), lanes.submit(lambda: depths.append(lanes.queued))]
+            await asyncio.sleep(0.05)
+            depths.append(lanes.stats['lookup_depth'])
+            release.set()
+            await asyncio.gather(*futures)
+
+        self.loop.run_until_complete(submit())
+        self.assertEqual(depths, [1, 0])
+        self.assertIn(lanes.stats['lookup_max_depth'], (1, 2))
+        self.assertEqual(lanes.stats['lookup_depth'], 0)
+        self.assertGreaterEqual(lanes.stats['lookup_max_wait_ms'], 50)
+        self.assertGreaterEqual(lanes.stats['lookup_wait_ms'], lanes.stats['lookup_max_wait_ms'])
+
+    def test_batch_yield_limit(self):
+        lanes = Lanes(max_yield=0.05)
+        release = threading.Event()
+        lookup_thread = threading.Thread(target=lanes.lookup(release.wait), args=(5,))
+        lookup_thread.start()
+
+        # all checkpoints of a batch share the yield time of the batch
+        batch = lanes.ingest(lambda: [lanes.checkpoint() for _ in range(20)])
+        ingest_thread = threading.Thread(target=batch)
+        start = time.perf_counter()
+        ingest_thread.start()
+        ingest_thread.join(5)
+        elapsed = time.perf_counter() - start
+        release.set()
+        lookup_thread.join()
+
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(lanes.stats['ingest_yields'] + lanes.stats['ingest_budget_exhausted'], 20)
+        self.assertGreaterEqual(lanes.stats['ingest_budget_exhausted'], 18)
+
+
+class CaptureTests(unittest.TestCase):
+    def test_capture(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'capture.jsonl')
+            capture = Capture(filename)
+            capture.record('pm', '{"transport": {"value": "TCP"}}\n')
+            capture.record('cib', '[]')
+            capture.close()
+            with open(filename, 'a') as f:
+                f.write('not json\n')
+
+            messages = read_capture(filename)
+        self.assertEqual([m[1:] for m in messages], [('pm', '{"transport": {"value": "TCP"}}\n'), ('cib', '[]')])
+        self.assertLessEqual(messages[0][0], messages[1][0])
+
+    def test_percentile(self):
+        latencies = list(range(1, 101))
+        self.assertEqual(percentile(latencies, 50), 50)
+        self.assertEqual(percentile(latencies, 99), 99)
+        self.assertEqual(percentile(latencies, 100), 100)
+        self.assertEqual(percentile([7], 90), 7)
+
+    def test_valid_reply(self):
+        candidates = synthetic_candidates(2)
+        request = '{"transport": {"value": "TCP"}}'
+        binary_request = 'encoding: neatbin1\n' + request
+        self.assertTrue(valid_reply(request, encode_reply(candidates)))
+        self.assertTrue(valid_reply(binary_request, encode_reply(candidates, BINARY_ENCODING)))
+        self.assertFalse(valid_reply(request, encode_reply(candidates, BINARY_ENCODING)))
+        self.assertFalse(valid_reply(binary_request, encode_reply(candidates, BINARY_ENCODING)[:-1]))
+        # the PM closes the connection without a reply if it cannot process a request
+        self.assertFalse(valid_reply(request, b''))
+
+
+class ImageTests(unittest.TestCase):
+    def test_image(self):
+        with tempfile.TemporaryDirectory() as cib_dir, tempfile.TemporaryDirectory() as pib_dir:
+            cib = CIB(cib_dir)
+            cib.apply_delta([cib_node_dict('eth0', {'interface': {'value': 'eth0'}, 'MTU': {'value': [1500, 9000]},
+                                                    'RTT': {'value': {'start': 5, 'end': 10}, 'score': 2}}, root=True)])
+            with open(os.path.join(pib_dir, 'a.policy'), 'w') as f:
+                json.dump({'uid': 'a', 'description': 'no UDP', 'match': {'interface': {'value': 'eth0'}},
+                           'properties': {'transport': {'value': 'TCP', 'banned': ['UDP']}}}, f)
+            pib = PIB(pib_dir, file_extension='.policy')
+            profiles = PIB(pib_dir, file_extension='.profile')
+
+            filename = os.path.join(pib_dir, 'pm.img')
+            write_image(filename, cib_image_state(cib), pib_image_state(pib, profiles))
+            image = open_image(filename, cib_dir, pib_dir)
+            self.assertIsNotNone(image)
+
+            cib2 = CIB(cib_dir, load=False)
+            cib2.load_image(*image.cib_state())
+            pib2 = PIB(pib_dir, file_extension='.policy', load=False)
+            pib2.load_image(*image.pib_state('pib'))
+            image.close()
+
+            self.assertEqual([(r.dict(), r.score, r.cib_node) for r in cib2.rows],
+                             [(r.dict(), r.score, r.cib_node) for r in cib.rows])
+            self.assertEqual(cib2.files, cib.files)
+            policy = pib2.index['a']
+            self.assertEqual(policy.description, 'no UDP')
+            self.assertEqual(policy.properties['transport'][0].banned[0].value, 'UDP')
+            self.assertEqual(pib2.files, pib.files)
+
+            request = PropertyArray(NEATProperty(('interface', 'eth0')))
+            self.assertEqual([c.dict() for c in pib2.lookup(cib2.lookup(request)[0])],
+                             [c.dict() for c in pib.lookup(cib.lookup(request)[0])])
+
+            # images compiled using other CIB expansion settings are not used
+            with mock.patch.object(PM, 'CIB_MAX_ROWS', PM.CIB_MAX_ROWS + 1):
+                self.assertIsNone(open_image(filename, cib_dir, pib_dir))
+
+            # images are out of date once a source file changes
+            os.utime(os.path.join(pib_dir, 'a.policy'), ns=(0, 0))
+            self.assertIsNone(open_image(filename, cib_dir, pib_dir))
+            # a new image records the modification times of the loaded files, not of the changed files
+            write_image(filename, cib_image_state(cib), pib_image_state(pib, profiles))
+            self.assertIsNone(open_image(filename, cib_dir, pib_dir))
+
+
+class EncodingTests(unittest.TestCase):
+    def test_binary_reply(self):
+        candidates = synthetic_candidates(3)
+        candidates[0].add(NEATProperty(('offset', -300), score=-1.5), NEATProperty(('name', 'ünï'), precedence=0))
+        candidates[0]['offset'].evaluated = True
+
+        data = encode_reply(candidates, BINARY_ENCODING)
+        self.assertEqual(decode_binary(data), json.loads(encode_reply(candidates).decode('utf-8')))
+        self.assertLess(len(data), len(encode_reply(candidates)))
+        with self.assertRaises(EncodingError):
+            decode_binary(data[:-1])
+
+        self.assertEqual(split_encoding('encoding: NEATBIN1\n{"a": 1}'), ('neatbin1', '{"a": 1}'))
+        self.assertEqual(split_encoding('{"a": 1}'), ('json', '{"a": 1}'))
+        self.assertEqual(split_headers('Timeout: 500\nencoding: neatbin1\n[{"a": 1}]'),
+                         ({'timeout': '500', 'encoding': 'neatbin1'}, '[{"a": 1}]'))
+
+
+class AdmissionTests(AsyncTestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        now = bucket.last
+        self.assertEqual([bucket.take(now) for _ in range(3)], [True, True, False])
+        self.assertTrue(bucket.take(now + 0.5))
+        self.assertFalse(bucket.take(now + 0.5))
+
+    def test_fair_scheduling(self):
+        admission = AdmissionControl(concurrency=1, rate=0, queue_limit=4, weights={1001: 2})
+        order = []
+
+        async def request(name):
+            await asyncio.sleep(0)
+            order.append(name)
+
+        flood, app, heavy = (1, 1000, 1000), (2, 1000, 1000), (3, 1001, 1001)
+        admitted = [admission.admit(flood, functools.partial(request, 'f%d' % n)) for n in range(6)]
+        admitted += [admission.admit(app, functools.partial(request, 'a%d' % n)) for n in range(2)]
+        admitted += [admission.admit(heavy, functools.partial(request, 'h%d' % n)) for n in range(4)]
+        self.assertEqual(admitted, [True] * 5 + [False] + [True] * 6)
+
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        # the flooding client does not delay the others, the client with weight 2 gets twice its share
+        self.assertEqual(order, ['f0', 'h0', 'f1', 'a0', 'h1', 'h2', 'f2', 'a1', 'h3', 'f3', 'f4'])
+        self.assertEqual(admission.stats['queue_full'], 1)
+        self.assertEqual(admission.dict()['1000:1']['completed'], 5)
+
+
+@unittest.skipIf(web is None, "aiohttp is not installed")
+class LookupTests(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        import pmrest
+        self.pmrest = pmrest
+
+        def process_request(json_str):
+            """stand-in lookup pipeline returning the request properties as the only candidate"""
+            return [PropertyArray(*properties) for properties in json_to_properties(json_str)]
+
+        patcher = mock.patch.multiple(pmrest, process_request=process_request, loop=self.loop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, body):
+        """POST body to the lookup endpoint. Returns the status, the JSON reply (if any) and the response headers."""
+        async def run():
+            app = web.Application()
+            app.router.add_post('/lookup', self.pmrest.handle_lookup)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = runner.addresses[0][1]
+            try:
+                async with self.pmrest.aiohttp.ClientSession() as session:
+                    async with session.post('http://127.0.0.1:%d/lookup' % port, data=body) as resp:
+                        text = await resp.text()
+                        reply = json.loads(text) if resp.content_type == 'application/json' else None
+                        return resp.status, reply, resp.headers
+            finally:
+                await runner.cleanup()
+
+        return self.loop.run_until_complete(run())
+
+    def test_single_request(self):
+        status, reply, headers = self.post('{"transport": {"value": "TCP", "precedence": 2}}')
+        self.assertEqual(status, 200)
+        self.assertEqual(reply, [{'transport': {'value': 'TCP', 'precedence': 2}}])
+        self.assertRegex(headers['Server-Timing'], r'^req0;dur=\d+\.\d{3}$')
+
+    def test_batch(self):
+        body = json.dumps({'requests': [{'transport': {'value': 'TCP'}}, {'transport': 5}, {'MTU': {'value': 1500}}]})
+        status, reply, headers = self.post(body)
+        self.assertEqual(status, 200)
+        # invalid requests of a batch yield null
+        self.assertEqual(reply, [[{'transport': {'value': 'TCP'}}], None, [{'MTU': {'value': 1500}}]])
+        self.assertEqual([t.split(';')[0] for t in headers['Server-Timing'].split(', ')], ['req0', 'req1', 'req2'])
+
+    def test_invalid_body(self):
+        self.assertEqual(self.post('{"transport": ')[0], 400)
+        self.assertEqual(self.post('{"transport": 5}')[0], 400)
+
+
+@unittest.skipIf(web is None, "aiohttp is not installed")
+class ControllerFeedTests(AsyncTestCase):
+    def test_cib_feed(self):
+        import pmrest
+
+        cib_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cib_dir.cleanup)
+        cib = CIB(cib_dir.name)
+        requests = []
+
+        async def handle_feed(request):
+            """stand-in controller serving a single CIB update"""
+            requests.append((request.query.get('since'), request.headers.get('If-None-Match')))
+            if request.headers.get('If-None-Match') == '"1"':
+                return web.Response(status=304)
+            node = cib_node_dict('eth0', {'interface': {'value': 'eth0'}}, root=True)
+            body = json.dumps({'cursor': '1', 'updated': [node], 'removed': []})
+            return web.Response(text=body, content_type='application/json', headers={'ETag': '"1"'})
+
+        async def run_feed():
+            app = web.Application()
+            app.router.add_get('/cib', handle_feed)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = runner.addresses[0][1]
+
+            feed = pmrest.CIBFeed('http://127.0.0.1:%d/cib' % port, cib)
+            async with pmrest.aiohttp.ClientSession() as session:
+                changes = [await feed.poll(session), await feed.poll(session)]
+            await runner.cleanup()
+            return changes
+
+        self.assertEqual(self.loop.run_until_complete(run_feed()), [True, False])
+        self.assertEqual(requests, [(None, None), ('1', '"1"')])
+        self.assertIn('eth0', cib.nodes)
+
+    def test_cib_feed_failed_update(self):
+        import pmrest
+
+        cib_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cib_dir.cleanup)
+        cib = CIB(cib_dir.name)
+        requests = []
+
+        async def handle_feed(request):
+            requests.append((request.query.get('since'), request.headers.get('If-None-Match')))
+            node = cib_node_dict('eth0', {'interface': {'value': 'eth0'}}, root=True)
+            body = json.dumps({'cursor': '1', 'updated': [node], 'removed': []})
+            return web.Response(text=body, content_type='application/json', headers={'ETag': '"1"'})
+
+        async def run_feed():
+            app = web.Application()
+            app.router.add_get('/cib', handle_feed)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = runner.addresses[0][1]
+
+            feed = pmrest.CIBFeed('http://127.0.0.1:%d/cib' % port, cib)
+            async with pmrest.aiohttp.ClientSession() as session:
+                with mock.patch.object(cib, 'apply_delta', side_effect=OSError('disk full')):
+                    with self.assertRaises(OSError):
+                        await feed.poll(session)
+                changed = await feed.poll(session)
+            await runner.cleanup()
+            return changed
+
+        self.assertTrue(self.loop.run_until_complete(run_feed()))
+        # the failed update is fetched again
+        self.assertEqual(requests, [(None, None), (None, None)])
+        self.assertIn('eth0', cib.nodes)
+
 
 if __name__ == "__main__":
     print(sys.stdout.encoding)
@@ -0,0 +1,72 @@
+import itertools
+import random
+import time
+from collections import Counter, deque
+
+import pmdefaults as PM
+
+
+class Trace(object):
+    """Structured record of a single PM request: the stages of the lookup pipeline and their durations."""
+
+    def __init__(self, trace_id, request):
+        self.id = trace_id
+        self.request = request
+        self.timestamp = time.time()
+        self.stages = []
+        self.duration = None
+
+        self._start = self._last = time.perf_counter()
+
+    def stage(self, name, **info):
+        """Record a completed stage. Its duration is the time elapsed since the previous stage."""
+        now = time.perf_counter()
+        info.update(name=name, ms=round((now - self._last) * 1000, 3))
+        self.stages.append(info)
+        self._last = now
+
+    def finish(self):
+        self.duration = round((time.perf_counter() - self._start) * 1000, 3)
+
+    def dict(self):
+        return {'id': self.id, 'timestamp': self.timestamp, 'request': self.request, 'ms': self.duration,
+                'stages': self.stages}
+
+
+class Tracer(object):
+    """
+    Record traces of a random sample of requests in a bounded ring buffer.
+
+    start() returns None for requests which are not sampled, so that tracing costs a single random draw for these.
+    """
+
+    def __init__(self, size=None, rate=None):
+        self.rate = PM.TRACE_SAMPLE_RATE if rate is None else rate
+        self.traces = deque(maxlen=PM.TRACE_BUFFER_SIZE if size is None else size)
+        self.ids = itertools.count(1)
+        self.stats = Counter()
+
+    def start(self, request):
+        """Return a new Trace if the request is sampled, None otherwise."""
+        self.stats['requests'] += 1
+        if not self.rate or random.random() >= self.rate:
+            return None
+
+        self.stats['sampled'] += 1
+        return Trace(next(self.ids), request)
+
+    def finish(self, trace):
+        """Store a completed trace in the ring buffer, replacing the oldest trace if the buffer is full."""
+        if trace is None:
+            return
+        trace.finish()
+        self.traces.append(trace)
+
+    def get(self, trace_id=None):
+        """Return the trace with the given id, or all buffered traces starting with the most recent one."""
+        traces = list(self.traces)
+        if trace_id is None:
+            return list(reversed(traces))
+        for t in traces:
+            if t.id == trace_id:
+                return t
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Updater(object):
+    """
+    Apply CIB or PIB updates on a background thread.
+
+    All updates of a CIB/PIB are serialized on a single worker thread, so that disk I/O, JSON parsing and link
+    computations never block the asyncio loop. Imports queued while the worker is busy are coalesced: they are written
+    in one batch which is followed by a single reload. Results are handed back to the loop through futures once the
+    new snapshot has been published.
+    """
+
+    def __init__(self, import_json, reload, name='update', batch=None):
+        # import_json(slim, uid, reload=False) must return True if a reload is required to apply the import
+        self.import_json_func = import_json
+        self.reload_func = reload
+        self.name = name
+        # wraps the function applying each batch of updates, e.g., Lanes.ingest
+        self.apply = batch(self._apply) if batch else self._apply
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = []
+        self.task = None
+        self.stats = Counter()
+
+    def import_json(self, slim, uid=None):
+        """Queue a JSON import. Returns a future which is done once the imported entries are visible to lookups."""
+        return self._submit(self.import_json_func, (slim, uid))
+
+    def reload(self):
+        """Queue a reload. Multiple queued reloads are coalesced into one."""
+        return self._submit(self.reload_func, ())
+
+    def call(self, func, *args):
+        """Queue func(*args) to run on the update thread. Returns a future for the result."""
+        return self._submit(func, args)
+
+    def _submit(self, func, args):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.queue.append((func, args, future, time.perf_counter()))
+        self.stats['queued'] += 1
+        self.stats['depth'] = len(self.queue)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while self.queue:
+            batch, self.queue = self.queue, []
+            self.stats['depth'] = 0
+            # time the queued updates waited for the update thread, the first one waited longest
+            now = time.perf_counter()
+            self.stats['wait_ms'] += round(sum(now - b[3] for b in batch) * 1000, 3)
+            self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], round((now - batch[0][3]) * 1000, 3))
+            results = await loop.run_in_executor(self.executor, self.apply, batch)
+
+            for (func, args, future, queued), (result, exc) in zip(batch, results):
+                if future.done():
+                    continue
+                if exc is not None:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+
+    def _apply(self, batch):
+        """Process a batch of queued updates on the update thread."""
+        results = []
+        reload = False
+
+        for func, args, future, queued in batch:
+            result, exc = None, None
+            try:
+                if func is self.import_json_func:
+                    reload |= bool(func(*args, reload=False))
+                elif func is self.reload_func:
+                    reload = True
+                else:
+                    # make sure that preceding imports are visible
+                    if reload:
+                        self._reload()
+                        reload = False
+                    result = func(*args)
+            except Exception as e:
+                logging.exception("%s failed" % self.name)
+                exc = e
+            results.append((result, exc))
+
+        if reload:
+            try:
+                self._reload()
+            except Exception as e:
+                # the imports of the batch were not applied
+                logging.exception("%s failed" % self.name)
+                results = [(result, exc if exc is not None else e) for result, exc in results]
+
+        self.stats['batches'] += 1
+        self.stats['applied'] += len(batch)
+        logging.info("%s: applied %d queued updates" % (self.name, len(batch)))
+        return results
+
+    def _reload(self):
+        self.reload_func()
+        self.stats['reloads'] += 1
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -6,6 +6,7 @@ import shutil
 
 from pmdefaults import *
 from pmdefaults import STYLES, CHARS
+from pmprefix import ip_prefix, prefix_contains
 
 SUB = str.maketrans("0123456789+-", "₀₁₂₃₄₅₆₇₈₉₊₋")
 
@@ -22,6 +23,10 @@ class InvalidPropertyError(NEATPropertyError):
     pass
 
 
+class JSONPatchError(Exception):
+    pass
+
+
 def json_to_properties(json_str):
     """ Import a list of JSON encoded NEAT properties
 
@@ -84,6 +89,93 @@ def properties_to_json(property_array, indent=None):
     return json.dumps(property_dict, sort_keys=True, indent=indent)
 
 
+def _json_pointer(path):
+    """Split a JSON pointer (RFC 6901) into its reference tokens."""
+    if not isinstance(path, str) or (path and not path.startswith('/')):
+        raise JSONPatchError('invalid JSON pointer %s' % path)
+    return [t.replace('~1', '/').replace('~0', '~') for t in path.split('/')[1:]]
+
+
+def _json_index(container, token, append=False):
+    """Convert a JSON pointer token into a key or index of the given container."""
+    if isinstance(container, dict):
+        return token
+    if isinstance(container, list):
+        if append and token == '-':
+            return len(container)
+        try:
+            index = int(token)
+        except ValueError:
+            raise JSONPatchError('invalid list index %s' % token)
+        if not 0 <= index < len(container) + int(append):
+            raise JSONPatchError('list index %s out of range' % token)
+        return index
+    raise JSONPatchError('cannot reference %s in a scalar value' % token)
+
+
+def apply_json_patch(doc, patch):
+    """ Apply a JSON patch (RFC 6902) to a JSON compatible object
+
+    Supports the add, remove, replace and test operations. Returns a patched copy of doc.
+
+    example: apply_json_patch({'foo': {'value': 1}}, [{'op': 'replace', 'path': '/foo/value', 'value': 2}])
+
+    """
+    doc = copy.deepcopy(doc)
+    if isinstance(patch, dict):
+        patch = [patch]
+
+    for operation in patch:
+        try:
+            op = operation['op']
+            tokens = _json_pointer(operation['path'])
+            value = copy.deepcopy(operation.get('value'))
+        except (KeyError, TypeError, AttributeError):
+            raise JSONPatchError('invalid patch operation %s' % operation)
+
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise JSONPatchError('patch operation %s requires a value' % op)
+
+        if not tokens:
+            # operation on the whole document
+            if op in ('add', 'replace'):
+                doc = value
+            elif op == 'test':
+                if doc != value:
+                    raise JSONPatchError('test failed for %s' % operation['path'])
+            else:
+                raise JSONPatchError('unsupported patch operation %s on the whole document' % op)
+            continue
+
+        parent = doc
+        try:
+            for token in tokens[:-1]:
+                parent = parent[_json_index(parent, token)]
+        except (KeyError, IndexError):
+            raise JSONPatchError('path %s does not exist' % operation['path'])
+
+        key = _json_index(parent, tokens[-1], append=(op == 'add'))
+        if op != 'add' and key not in (parent if isinstance(parent, dict) else range(len(parent))):
+            raise JSONPatchError('path %s does not exist' % operation['path'])
+
+        if op == 'add':
+            if isinstance(parent, list):
+                parent.insert(key, value)
+            else:
+                parent[key] = value
+        elif op == 'replace':
+            parent[key] = value
+        elif op == 'remove':
+            del parent[key]
+        elif op == 'test':
+            if parent[key] != value:
+                raise JSONPatchError('test failed for %s' % operation['path'])
+        else:
+            raise JSONPatchError('unsupported patch operation %s' % op)
+
+    return doc
+
+
 def to_inf(inf_str):
     # TODO
     if isinstance(inf_str, str) and inf_str.lower() == 'inf':
@@ -194,6 +286,31 @@ class PropertyValue(object):
 
         if self.value == other.value:
             return self.value
+
+        if self.is_prefix or other.is_prefix:
+            return self._overlapping_prefix(other)
+        else:
+            return False
+
+    @property
+    def is_prefix(self):
+        """True for address prefixes such as 10.1.0.0/16 or 2001:db8::/32"""
+        return self.is_single and isinstance(self._value, str) and '/' in self._value and ip_prefix(self._value) is not None
+
+    def _overlapping_prefix(self, other):
+        """
+        check for overlapping address prefixes. A prefix overlaps with all addresses and prefixes it contains, the
+        more specific value is returned.
+
+        """
+        self_prefix, other_prefix = ip_prefix(self.value), ip_prefix(other.value)
+        if self_prefix is None or other_prefix is None:
+            return False
+
+        if prefix_contains(other_prefix, self_prefix):
+            return self.value
+        elif prefix_contains(self_prefix, other_prefix):
+            return other.value
         else:
             return False
 